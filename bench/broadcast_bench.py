@@ -0,0 +1,161 @@
+"""
+Офлайн-бенчмарк рассылки подписчикам: настоящие SubscriptionPush и BroadcastEngine из
+msk_quiz_bot против поддельного Telegram Bot API и SQLite с синтетическими мероприятиями
+и подписками (см. bench/harness.py).
+
+Печатает число чатов и разных вариантов сообщения (сколько раз содержимое отрисовано),
+время рассылки, сообщений в секунду, исходы delivered/failed/blocked и запросы к БД.
+--blocked-share - доля чатов, заблокировавших бота (API отвечает 403).
+--crash-after N - прервать рассылку после N отправленных сообщений и запустить её снова:
+показывает, с какого места она продолжилась и сколько чатов получили её дважды.
+--rate 0 - без собственного ограничения скорости рассылки; --send-limits - через
+планировщик отправки с лимитами Telegram, как в боте.
+
+Пример:
+    python bench/broadcast_bench.py --subscribers 20000 --blocked-share 0.03 --crash-after 5000
+"""
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+from collections import Counter
+from datetime import date
+
+import harness
+import msk_quiz_bot
+
+
+class CountingEngine(msk_quiz_bot.BroadcastEngine):
+    """Считает попытки доставки по чатам, чтобы увидеть повторы после возобновления."""
+
+    def __init__(self, batch_size: int, rate: float):
+        super().__init__(batch_size, rate)
+        self.attempts: Counter = Counter()
+
+    async def _deliver(self, bot, chat_id: int, texts: list[str]) -> str:
+        self.attempts[chat_id] += 1
+        return await super()._deliver(bot, chat_id, texts)
+
+
+async def push_until(env: harness.BotEnvironment, push: msk_quiz_bot.SubscriptionPush, today: date,
+                     crash_after: int | None) -> msk_quiz_bot.BroadcastRun | None:
+    """Рассылка целиком или до crash_after вызовов sendMessage (тогда задача отменяется, как при падении)."""
+    task = asyncio.create_task(push.push(env.bot, 'daily', today))
+    if crash_after is None:
+        return await task
+    while not task.done() and env.api.calls['sendMessage'] < crash_after:
+        await asyncio.sleep(0.001)
+    if task.done():
+        return task.result()
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    return None
+
+
+async def run(args) -> dict:
+    events_db = harness.create_events_db()
+    events = harness.seed_events(events_db, days=args.days, events_per_day=args.events_per_day, seed=args.seed)
+    subscriptions = harness.seed_subscriptions(events_db, args.subscribers, per_user=args.per_user, seed=args.seed)
+    rate = args.rate if args.rate > 0 else float('inf')
+    engine = CountingEngine(batch_size=args.batch_size, rate=rate)
+    push = msk_quiz_bot.SubscriptionPush(
+        engine, tz=msk_quiz_bot.ZoneInfo(msk_quiz_bot.SCHEDULER_TIMEZONE), push_at=msk_quiz_bot.SUBSCRIPTION_PUSH_AT,
+        weekly_weekday=msk_quiz_bot.SUBSCRIPTION_WEEKLY_WEEKDAY, horizon_days=msk_quiz_bot.SUBSCRIPTION_HORIZON_DAYS)
+
+    async with harness.bot_environment(
+        events_db, api_latency=args.api_latency / 1000, db_latency=args.db_latency / 1000,
+        send_limits=args.send_limits,
+    ) as env:
+        rng = random.Random(args.seed)
+        chats = [row[0] for row in events_db.execute("SELECT DISTINCT chat_id FROM msk_user_subscriptions")]
+        env.api.blocked_chats = {chat_id for chat_id in chats if rng.random() < args.blocked_share}
+        today = date.today()
+        queries_before = env.pool.queries
+
+        started = time.perf_counter()
+        broadcast = await push_until(env, push, today, args.crash_after)
+        resumed_from, payloads = None, 0
+        if broadcast is None:
+            (resumed_from,) = events_db.execute(
+                "SELECT last_chat_id FROM msk_broadcast_runs WHERE run_key = ?", (f"daily:{today.isoformat()}",)
+            ).fetchone() or (None,)
+            broadcast = await push_until(env, push, today, None)
+        payloads += broadcast.payloads
+        elapsed = time.perf_counter() - started
+        messages = env.api.calls['sendMessage']
+        queries = env.pool.queries - queries_before
+
+        # Повторный запуск законченной рассылки ничего не отправляет
+        await push.push(env.bot, 'daily', today)
+        resent_after_done = env.api.calls['sendMessage'] - messages
+
+    return {
+        "config": {
+            "subscribers": args.subscribers, "subscriptions": subscriptions, "events": events,
+            "batch_size": args.batch_size, "rate": args.rate, "send_limits": args.send_limits,
+            "blocked_share": args.blocked_share, "crash_after": args.crash_after,
+            "api_latency_ms": args.api_latency, "db_latency_ms": args.db_latency, "seed": args.seed,
+        },
+        "seconds": round(elapsed, 3),
+        "chats": broadcast.total,
+        "payloads": payloads,
+        "messages": messages,
+        "messages_per_sec": round(messages / elapsed, 1) if elapsed else 0.0,
+        "delivered": broadcast.delivered,
+        "failed": broadcast.failed,
+        "blocked": broadcast.blocked,
+        "db_queries": queries,
+        "resumed_from_chat_id": resumed_from,
+        "chats_sent_twice": sum(1 for count in engine.attempts.values() if count > 1),
+        "sent_after_done": resent_after_done,
+    }
+
+
+def print_result(result: dict) -> None:
+    config = result["config"]
+    print(f"{config['subscribers']} подписчиков, {config['subscriptions']} подписок, {config['events']} мероприятий, "
+          f"пачка {config['batch_size']}, лимиты отправки: {'да' if config['send_limits'] else 'нет'}")
+    print(f"чатов в рассылке: {result['chats']}, разных вариантов сообщения: {result['payloads']}")
+    print(f"{result['messages']} сообщений за {result['seconds']} с: {result['messages_per_sec']} сообщений/с, "
+          f"запросов к БД: {result['db_queries']}")
+    print(f"доставлено: {result['delivered']}, не доставлено: {result['failed']}, бот заблокирован: {result['blocked']}")
+    if config['crash_after'] is not None:
+        print(f"после прерывания продолжено с chat_id {result['resumed_from_chat_id']}, "
+              f"чатов получили рассылку дважды: {result['chats_sent_twice']}")
+    print(f"отправлено повторным запуском законченной рассылки: {result['sent_after_done']}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк рассылки подписчикам")
+    parser.add_argument("--subscribers", type=int, default=5000, help="подписчиков (у каждого свой чат)")
+    parser.add_argument("--per-user", type=int, default=2, help="до стольких подписок у подписчика")
+    parser.add_argument("--days", type=int, default=30, help="на сколько дней вперёд заполнить msk_events")
+    parser.add_argument("--events-per-day", type=int, default=40)
+    parser.add_argument("--batch-size", type=int, default=msk_quiz_bot.BROADCAST_BATCH_SIZE)
+    parser.add_argument("--rate", type=float, default=0.0, help="сообщений рассылки в секунду (0 - без ограничения)")
+    parser.add_argument("--send-limits", action="store_true", help="включить планировщик отправки с лимитами Telegram")
+    parser.add_argument("--blocked-share", type=float, default=0.02, help="доля чатов, заблокировавших бота")
+    parser.add_argument("--crash-after", type=int, help="прервать рассылку после стольких сообщений и продолжить")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="задержка ответа поддельного API, мс")
+    parser.add_argument("--db-latency", type=float, default=0.0, help="задержка каждого запроса к БД, мс")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--json", action="store_true", help="вывести результат в JSON")
+    args = parser.parse_args()
+
+    harness.configure_logging(args.log_level)
+    result = await run(args)
+    if args.json:
+        json.dump(result, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+    else:
+        print_result(result)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
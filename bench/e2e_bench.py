@@ -0,0 +1,219 @@
+"""
+Сквозной офлайн-бенчмарк бота: настоящие dp и хэндлеры msk_quiz_bot против поддельного
+Telegram Bot API и SQLite с синтетическими мероприятиями (см. bench/harness.py).
+
+Виртуальные пользователи одновременно проходят сценарии:
+  today      - /today
+  by_date    - /by_date -> дата
+  organizer  - Организатор -> организатор -> дата
+  location   - Бар -> бар -> дата
+  category   - Тематика -> тематика -> дата
+Кнопки нажимаются из клавиатур, которые бот действительно прислал.
+
+Печатает обновления в секунду, p50/p95/p99 задержки обработки обновления (по шагам и всего),
+длительность сценариев и число вызовов API на сценарий. --json - то же в JSON (для сравнения
+прогонов), --baseline FILE - сравнить с сохранённым JSON.
+
+Пример:
+    python bench/e2e_bench.py --users 200 --journeys 5 --json > before.json
+    python bench/e2e_bench.py --users 200 --journeys 5 --baseline before.json
+"""
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+from collections import Counter, defaultdict
+
+import harness
+
+JOURNEYS = {
+    'today': [('message', '/today')],
+    'by_date': [('message', '/by_date'), ('click', 'date:')],
+    'organizer': [('message', 'Организатор'), ('click', 'select_organizer:'), ('click', 'select_org_date:')],
+    'location': [('message', 'Бар'), ('click', 'select_location_id:'), ('click', 'select_loc_date_id:')],
+    'category': [('message', 'Тематика'), ('click', 'select_category_id:'), ('click', 'select_cat_date_id:')],
+}
+
+DEFAULT_MIX = "today=4,by_date=2,organizer=2,location=1,category=1"
+
+
+def parse_mix(text: str) -> dict[str, float]:
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in JOURNEYS:
+            raise argparse.ArgumentTypeError(f"неизвестный сценарий '{name}', есть: {', '.join(JOURNEYS)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+class JourneyStats:
+    def __init__(self):
+        self.step_latency_ms: dict[str, list[float]] = defaultdict(list)
+        self.journey_ms: dict[str, list[float]] = defaultdict(list)
+        self.journey_calls: dict[str, list[int]] = defaultdict(list)
+        self.dead_ends: Counter = Counter()
+        self.errors: Counter = Counter()
+        self.updates = 0
+
+
+async def run_journey(env: harness.BotEnvironment, user_id: int, name: str, rng: random.Random, stats: JourneyStats) -> None:
+    calls_before = env.api.chat_calls(user_id)
+    started = time.perf_counter()
+    for kind, value in JOURNEYS[name]:
+        if kind == 'message':
+            update = harness.make_message_update(env.bot, user_id, value)
+            step = value
+        else:
+            buttons = [data for data in env.api.last_inline_keyboard.get(user_id, ()) if data.startswith(value)]
+            if not buttons:
+                stats.dead_ends[name] += 1
+                return
+            update = harness.make_callback_update(env.bot, user_id, rng.choice(buttons))
+            step = value
+        env.api.last_inline_keyboard.pop(user_id, None)
+
+        step_started = time.perf_counter()
+        try:
+            await env.feed(update)
+        except Exception as e:
+            stats.errors[type(e).__name__] += 1
+        stats.step_latency_ms[step].append((time.perf_counter() - step_started) * 1000)
+        stats.updates += 1
+    stats.journey_ms[name].append((time.perf_counter() - started) * 1000)
+    stats.journey_calls[name].append(env.api.chat_calls(user_id) - calls_before)
+
+
+async def run_user(env: harness.BotEnvironment, user_id: int, journeys: int, mix: dict[str, float],
+                   seed: int, stats: JourneyStats) -> None:
+    rng = random.Random(seed * 1_000_003 + user_id)
+    names, weights = list(mix), list(mix.values())
+    for _ in range(journeys):
+        await run_journey(env, user_id, rng.choices(names, weights)[0], rng, stats)
+
+
+async def run(args) -> dict:
+    events_db = harness.create_events_db()
+    events = harness.seed_events(events_db, days=args.days, events_per_day=args.events_per_day, seed=args.seed)
+    async with harness.bot_environment(
+        events_db, api_latency=args.api_latency / 1000, db_latency=args.db_latency / 1000,
+        use_snapshot=not args.no_snapshot, send_limits=args.send_limits,
+    ) as env:
+        if args.warmup:
+            warmup_stats = JourneyStats()
+            await asyncio.gather(*(run_journey(env, 1, name, random.Random(0), warmup_stats) for name in JOURNEYS))
+        api_calls_before = sum(env.api.calls.values())
+        db_queries_before = env.pool.queries
+
+        stats = JourneyStats()
+        first_user_id = 100000
+        started = time.perf_counter()
+        await asyncio.gather(*(run_user(env, first_user_id + i, args.journeys, args.mix, args.seed, stats)
+                               for i in range(args.users)))
+        elapsed = time.perf_counter() - started
+        api_calls = sum(env.api.calls.values()) - api_calls_before
+        db_queries = env.pool.queries - db_queries_before
+
+    all_latency = [value for values in stats.step_latency_ms.values() for value in values]
+    journeys_done = sum(len(values) for values in stats.journey_ms.values())
+    return {
+        "config": {
+            "users": args.users, "journeys_per_user": args.journeys, "mix": args.mix, "events": events,
+            "api_latency_ms": args.api_latency, "db_latency_ms": args.db_latency,
+            "snapshot": not args.no_snapshot, "send_limits": args.send_limits, "seed": args.seed,
+        },
+        "seconds": round(elapsed, 3),
+        "updates": stats.updates,
+        "updates_per_sec": round(stats.updates / elapsed, 1) if elapsed else 0.0,
+        "journeys_per_sec": round(journeys_done / elapsed, 1) if elapsed else 0.0,
+        "latency": harness.latency_summary(all_latency),
+        "latency_by_step": {step: harness.latency_summary(values) for step, values in sorted(stats.step_latency_ms.items())},
+        "journeys": {
+            name: {
+                **harness.latency_summary(stats.journey_ms[name]),
+                "api_calls_per_journey": round(sum(stats.journey_calls[name]) / len(stats.journey_calls[name]), 2),
+                "dead_ends": stats.dead_ends[name],
+            }
+            for name in sorted(stats.journey_ms)
+        },
+        "api_calls": api_calls,
+        "api_calls_by_method": dict(env.api.calls),
+        "db_queries": db_queries,
+        "errors": dict(stats.errors),
+    }
+
+
+def print_result(result: dict) -> None:
+    config = result["config"]
+    print(f"{config['users']} пользователей x {config['journeys_per_user']} сценариев, {config['events']} мероприятий, "
+          f"снимок: {'да' if config['snapshot'] else 'нет'}, лимиты отправки: {'да' if config['send_limits'] else 'нет'}")
+    print(f"{result['updates']} обновлений за {result['seconds']} с: {result['updates_per_sec']} обновлений/с, "
+          f"{result['journeys_per_sec']} сценариев/с")
+    print(f"вызовов API: {result['api_calls']}, запросов к БД: {result['db_queries']}, ошибок: {sum(result['errors'].values())}")
+
+    def row(name, stats):
+        return (f"  {name:<22} n={stats['count']:<6} p50={stats['p50_ms']:>8} мс  p95={stats['p95_ms']:>8} мс  "
+                f"p99={stats['p99_ms']:>8} мс  max={stats['max_ms']:>8} мс")
+
+    print("\nОбработка обновления:")
+    print(row("всего", result["latency"]))
+    for step, stats in result["latency_by_step"].items():
+        print(row(step, stats))
+    print("\nСценарии:")
+    for name, stats in result["journeys"].items():
+        print(row(name, stats) + f"  API/сценарий={stats['api_calls_per_journey']}  тупиков={stats['dead_ends']}")
+
+
+def print_comparison(result: dict, baseline: dict, file=sys.stdout) -> None:
+    def change(key_path: list[str], higher_is_better: bool) -> str:
+        old, new = baseline, result
+        for key in key_path:
+            old, new = old.get(key, {}), new.get(key, {})
+        if not old:
+            return "нет в базовом прогоне"
+        delta = (new - old) / old * 100
+        verdict = "лучше" if (delta > 0) == higher_is_better else "хуже"
+        return f"{old} -> {new} ({delta:+.1f}%, {verdict})" if abs(delta) >= 0.05 else f"{old} -> {new} (без изменений)"
+
+    print("\nСравнение с базовым прогоном:", file=file)
+    print(f"  обновлений/с: {change(['updates_per_sec'], True)}", file=file)
+    for key in ("p50_ms", "p95_ms", "p99_ms"):
+        print(f"  {key}: {change(['latency', key], False)}", file=file)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Сквозной офлайн-бенчмарк бота")
+    parser.add_argument("--users", type=int, default=100, help="одновременных виртуальных пользователей")
+    parser.add_argument("--journeys", type=int, default=5, help="сценариев на пользователя")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX), help=f"веса сценариев (по умолчанию {DEFAULT_MIX})")
+    parser.add_argument("--days", type=int, default=30, help="на сколько дней вперёд заполнить msk_events")
+    parser.add_argument("--events-per-day", type=int, default=40)
+    parser.add_argument("--api-latency", type=float, default=0.0, help="задержка ответа поддельного API, мс")
+    parser.add_argument("--db-latency", type=float, default=0.0, help="задержка каждого запроса к БД, мс")
+    parser.add_argument("--no-snapshot", action="store_true", help="не загружать снимок: все выборки через SQL")
+    parser.add_argument("--send-limits", action="store_true", help="включить планировщик отправки с лимитами Telegram")
+    parser.add_argument("--no-warmup", dest="warmup", action="store_false", help="не прогонять сценарии перед замером")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--json", action="store_true", help="вывести результат в JSON")
+    parser.add_argument("--baseline", help="JSON предыдущего прогона для сравнения")
+    args = parser.parse_args()
+
+    harness.configure_logging(args.log_level)
+    result = await run(args)
+    if args.json:
+        json.dump(result, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+    else:
+        print_result(result)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as baseline_file:
+            # При --json сравнение идёт в stderr, чтобы stdout оставался валидным JSON
+            print_comparison(result, json.load(baseline_file), file=sys.stderr if args.json else sys.stdout)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
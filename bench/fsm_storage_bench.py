@@ -0,0 +1,130 @@
+"""
+Бенчмарк FSM-хранилища: N одновременных пользователей (по умолчанию 10 000) проходят
+двухшаговый диалог с состояниями (выбор значения, затем даты): get_state -> set_state ->
+get_data -> set_state -> set_state(None). Фильтры бота состояния больше не хранят (всё нужное
+едет в callback_data), но хранилище по-прежнему читается на каждый апдейт.
+Сравнивает SQLiteStorage бота с MemoryStorage aiogram.
+
+Прогоны:
+  memory  - MemoryStorage aiogram (эталон);
+  warm    - SQLiteStorage, все записи уже в кэше;
+  cold    - новый SQLiteStorage поверх того же файла: первое чтение каждого ключа идёт в SQLite.
+
+Печатает p50/p95/p99 на операцию в микросекундах и операции в секунду; --json - то же в JSON.
+
+Пример:
+    python bench/fsm_storage_bench.py --users 10000 --rounds 3
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from aiogram.fsm.storage.base import StorageKey  # noqa: E402
+from aiogram.fsm.storage.memory import MemoryStorage  # noqa: E402
+
+import msk_quiz_bot  # noqa: E402
+
+BOT_ID = 42
+
+# Состояния двухшагового диалога в формате aiogram ("группа:состояние")
+VALUE_SELECTION = "FilterStates:waiting_for_value_selection"
+DATE_SELECTION = "FilterStates:waiting_for_date_selection"
+
+
+async def user_flow(storage, user_id: int, rounds: int, timings: dict[str, list[int]]):
+    key = StorageKey(bot_id=BOT_ID, chat_id=user_id, user_id=user_id)
+
+    async def timed(name: str, coro):
+        started = time.perf_counter_ns()
+        result = await coro
+        timings[name].append(time.perf_counter_ns() - started)
+        return result
+
+    for _ in range(rounds):
+        await timed("get_state", storage.get_state(key))
+        await timed("set_state", storage.set_state(key, VALUE_SELECTION))
+        await timed("get_data", storage.get_data(key))
+        await timed("set_state", storage.set_state(key, DATE_SELECTION))
+        await timed("get_state", storage.get_state(key))
+        await timed("set_state", storage.set_state(key, None))
+    # Пользователь бросил фильтр на полпути - такие записи и должен убирать TTL
+    await timed("set_state", storage.set_state(key, VALUE_SELECTION))
+
+
+def percentile(sorted_values: list[int], p: float) -> float:
+    index = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index] / 1000
+
+
+async def run(name: str, storage, users: int, rounds: int) -> dict:
+    timings: dict[str, list[int]] = defaultdict(list)
+    started = time.perf_counter()
+    await asyncio.gather(*(user_flow(storage, BOT_ID * 1000 + i, rounds, timings) for i in range(users)))
+    elapsed = time.perf_counter() - started
+
+    result = {"run": name, "users": users, "seconds": round(elapsed, 3), "ops": {}}
+    total_ops = 0
+    for op, values in sorted(timings.items()):
+        values.sort()
+        total_ops += len(values)
+        result["ops"][op] = {
+            "count": len(values),
+            "p50_us": round(percentile(values, 50), 1),
+            "p95_us": round(percentile(values, 95), 1),
+            "p99_us": round(percentile(values, 99), 1),
+            "mean_us": round(statistics.fmean(values) / 1000, 1),
+        }
+    result["ops_per_sec"] = round(total_ops / elapsed)
+    if isinstance(storage, msk_quiz_bot.SQLiteStorage):
+        result["cache_hits"] = storage.cache_hits
+        result["cache_misses"] = storage.cache_misses
+        result["entries"] = storage.entries
+    return result
+
+
+def print_result(result: dict) -> None:
+    print(f"\n[{result['run']}] {result['users']} пользователей за {result['seconds']} с, {result['ops_per_sec']} операций/с")
+    for op, stats in result["ops"].items():
+        print(f"  {op:<10} n={stats['count']:<7} p50={stats['p50_us']:>8} мкс  p95={stats['p95_us']:>8} мкс  "
+              f"p99={stats['p99_us']:>8} мкс  mean={stats['mean_us']:>8} мкс")
+    if "cache_misses" in result:
+        print(f"  кэш: попаданий {result['cache_hits']}, промахов {result['cache_misses']}, записей {result['entries']}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк FSM-хранилища бота")
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--rounds", type=int, default=3, help="сколько раз каждый пользователь проходит фильтр")
+    parser.add_argument("--json", action="store_true", help="вывести результаты в JSON")
+    args = parser.parse_args()
+
+    results = [await run("memory", MemoryStorage(), args.users, args.rounds)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "fsm_bench.sqlite3")
+        storage = msk_quiz_bot.SQLiteStorage(path, ttl=3600, max_entries=msk_quiz_bot.FSM_STORAGE_MAX_ENTRIES, flush_interval=1.0)
+        await run("warm-up", storage, args.users, 1)
+        results.append(await run("warm", storage, args.users, args.rounds))
+        await storage.close()
+
+        storage = msk_quiz_bot.SQLiteStorage(path, ttl=3600, max_entries=msk_quiz_bot.FSM_STORAGE_MAX_ENTRIES, flush_interval=1.0)
+        results.append(await run("cold", storage, args.users, args.rounds))
+        await storage.close()
+
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+    else:
+        for result in results:
+            print_result(result)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
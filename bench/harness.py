@@ -0,0 +1,431 @@
+"""
+Общие заглушки для офлайн-бенчмарков бота:
+  FakeTelegramApi  - локальный aiohttp-сервер, изображающий Telegram Bot API;
+  StandInPool      - SQLite в памяти вместо MySQL, с тем же интерфейсом, что у db_pool;
+  seed_events      - синтетические строки msk_events;
+  seed_subscriptions - синтетические подписки в msk_user_subscriptions;
+  bot_environment  - настоящие dp и хэндлеры msk_quiz_bot, подключённые к заглушкам.
+
+Обновления подаются через dp.feed_update, так что меряется вся обработка ботом,
+включая отправку ответов в (поддельный) API.
+"""
+import asyncio
+import contextlib
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import sqlite3
+import sys
+import tempfile
+import time
+import zlib
+from collections import Counter, defaultdict
+from dataclasses import dataclass
+from datetime import date, timedelta
+
+from aiohttp import web
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from aiogram import Bot, types  # noqa: E402
+from aiogram.client.session.aiohttp import AiohttpSession  # noqa: E402
+from aiogram.client.telegram import TelegramAPIServer  # noqa: E402
+
+import msk_quiz_bot  # noqa: E402
+
+BENCH_TOKEN = "123456:BENCH"
+
+sqlite3.register_adapter(date, lambda value: value.isoformat())
+sqlite3.register_converter("DATE", lambda value: date.fromisoformat(value.decode()))
+
+
+# --- Поддельный Telegram Bot API ---
+
+class FakeTelegramApi:
+    """
+    Отвечает ok на любой метод, на sendMessage/editMessageText - правдоподобным Message.
+    Считает вызовы по методам и по чатам (answerCallbackQuery - по чату из id callback'а)
+    и запоминает callback_data последней inline-клавиатуры в каждом чате, чтобы сценарии
+    нажимали настоящие кнопки бота. latency - искусственная задержка ответа в секундах.
+    В чаты из blocked_chats отправка отвечает 403, как для пользователя, заблокировавшего бота.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.blocked_chats: set[int] = set()
+        self.calls: Counter = Counter()
+        self.calls_by_chat: dict[int, Counter] = defaultdict(Counter)
+        self.last_inline_keyboard: dict[int, list[str]] = {}
+        self.base_url: str | None = None
+        self._message_ids = itertools.count(1000)
+        self._runner: web.AppRunner | None = None
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        payload = dict(await request.post())
+        chat_id = payload.get('chat_id')
+        if chat_id is None and 'callback_query_id' in payload:
+            chat_id = payload['callback_query_id'].split(':', 1)[0]
+        chat_id = int(chat_id) if chat_id is not None else None
+
+        self.calls[method] += 1
+        if chat_id is not None:
+            self.calls_by_chat[chat_id][method] += 1
+            markup = payload.get('reply_markup')
+            if markup:
+                keyboard = json.loads(markup).get('inline_keyboard')
+                if keyboard is not None:
+                    self.last_inline_keyboard[chat_id] = [
+                        button['callback_data'] for row in keyboard for button in row if 'callback_data' in button
+                    ]
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if chat_id in self.blocked_chats:
+            return web.json_response(
+                {"ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"}, status=403)
+        result = True
+        if method in ("sendMessage", "editMessageText") and chat_id is not None:
+            result = {
+                "message_id": int(payload.get('message_id') or next(self._message_ids)),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": payload.get('text', ''),
+            }
+        return web.json_response({"ok": True, "result": result})
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, '127.0.0.1', 0).start()
+        host, port = self._runner.addresses[0][:2]
+        self.base_url = f"http://{host}:{port}"
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def chat_calls(self, chat_id: int) -> int:
+        return sum(self.calls_by_chat[chat_id].values())
+
+
+# --- SQLite вместо MySQL ---
+
+EVENTS_DDL = """
+    CREATE TABLE msk_events (
+        id INTEGER PRIMARY KEY,
+        title TEXT, start_time TEXT, type TEXT, price TEXT, category TEXT, difficulty TEXT,
+        location_name TEXT, location_address TEXT, url TEXT, `date` DATE, organizer TEXT
+    );
+    CREATE INDEX msk_events_date ON msk_events (`date`, start_time);
+    CREATE TABLE msk_user_filter_stats (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER, user_name TEXT, filter_type TEXT, filter_value TEXT,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE msk_user_subscriptions (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER, chat_id INTEGER, filter_type TEXT, filter_value TEXT,
+        frequency TEXT DEFAULT 'daily', blocked_at TEXT,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE (user_id, filter_type, filter_value)
+    );
+    CREATE INDEX msk_user_subscriptions_frequency_chat ON msk_user_subscriptions (frequency, chat_id);
+    CREATE TABLE msk_broadcast_runs (
+        run_key TEXT PRIMARY KEY,
+        status TEXT, total_chats INTEGER, last_chat_id INTEGER,
+        delivered INTEGER, failed INTEGER, blocked INTEGER,
+        started_at TEXT DEFAULT CURRENT_TIMESTAMP, updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE msk_subscription_sent (
+        chat_id INTEGER, event_key TEXT, event_date DATE,
+        PRIMARY KEY (chat_id, event_key)
+    );
+    CREATE TABLE msk_user_settings (
+        user_id INTEGER PRIMARY KEY, digest INTEGER NOT NULL, updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+    );
+"""
+
+UPSERT_VALUES_RE = re.compile(r'VALUES\((\w+)\)')
+
+
+def translate_sql(sql: str) -> str:
+    """
+    Запросы бота написаны для MySQL; SQLite понимает их после замены плейсхолдеров и CURDATE(),
+    а ON DUPLICATE KEY UPDATE col = VALUES(col) - после перевода в ON CONFLICT DO UPDATE.
+    """
+    sql = sql.replace('%s', '?').replace('CURDATE()', "date('now', 'localtime')")
+    head, upsert, assignments = sql.partition("ON DUPLICATE KEY UPDATE")
+    if upsert:
+        sql = head + "ON CONFLICT DO UPDATE SET " + UPSERT_VALUES_RE.sub(r'excluded.\1', assignments)
+    return sql
+
+
+class StandInPool:
+    """
+    Подменяет msk_quiz_bot.db_pool: fetch_all / fetch_prepared / execute / execute_many поверх SQLite в памяти.
+    latency - искусственная задержка каждого запроса (сетевой RTT до MySQL) в секундах.
+    """
+
+    def __init__(self, connection: sqlite3.Connection, latency: float = 0.0):
+        self._db = connection
+        self.latency = latency
+        self.queries = 0
+
+    async def open(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+    async def _run(self, sql: str, params) -> sqlite3.Cursor:
+        self.queries += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self._db.execute(translate_sql(sql), tuple(params))
+
+    async def fetch_all(self, sql: str, params: tuple = (), dictionary: bool = False, **kwargs) -> list:
+        cursor = await self._run(sql, params)
+        rows = cursor.fetchall()
+        if dictionary:
+            names = [column[0] for column in cursor.description]
+            return [dict(zip(names, row)) for row in rows]
+        return rows
+
+    async def fetch_prepared(self, sql: str, params: tuple = (), dictionary: bool = False) -> list:
+        # sqlite3 сам кэширует подготовленные запросы по тексту SQL
+        return await self.fetch_all(sql, params, dictionary)
+
+    async def execute(self, sql: str, params: tuple = ()) -> int:
+        cursor = await self._run(sql, params)
+        self._db.commit()
+        return cursor.rowcount
+
+    async def execute_many(self, sql: str, rows: list[tuple]) -> int:
+        self.queries += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        cursor = self._db.executemany(translate_sql(sql), rows)
+        self._db.commit()
+        return cursor.rowcount
+
+
+class BitXor:
+    """Агрегат BIT_XOR из MySQL (для водяных знаков снимка)."""
+
+    def __init__(self):
+        self.value = 0
+
+    def step(self, value) -> None:
+        if value is not None:
+            self.value ^= value
+
+    def finalize(self) -> int:
+        return self.value
+
+
+def create_events_db() -> sqlite3.Connection:
+    connection = sqlite3.connect(":memory:", detect_types=sqlite3.PARSE_DECLTYPES)
+    # Функции MySQL, которых нет в SQLite
+    connection.create_function("CRC32", 1, lambda value: zlib.crc32(str(value).encode()), deterministic=True)
+    connection.create_function(
+        "CONCAT_WS", -1, lambda separator, *values: separator.join(str(value) for value in values if value is not None),
+        deterministic=True)
+    connection.create_aggregate("BIT_XOR", 1, BitXor)
+    connection.executescript(EVENTS_DDL)
+    return connection
+
+
+def pad_names(names, count: int, make_name) -> list[str]:
+    """Сначала переданные имена (без повторов), затем синтетические, пока не наберётся count."""
+    padded = list(dict.fromkeys(name for name in names if name))
+    number = 1
+    while len(padded) < count:
+        padded.append(make_name(number))
+        number += 1
+    return padded
+
+
+def seed_events(connection: sqlite3.Connection, days: int = 30, events_per_day: int = 40,
+                organizers: int = 25, locations: int = 60, categories: int = 12, seed: int = 1,
+                organizer_names=(), location_names=(), category_names=()) -> int:
+    """
+    Заполняет msk_events синтетическими квизами на days дней вперёд, начиная с сегодня.
+    Переданные имена организаторов, баров и тематик (например, из истории статистики)
+    используются в первую очередь и гарантированно получают мероприятия.
+    """
+    rng = random.Random(seed)
+    organizer_names = pad_names(organizer_names, organizers,
+                                lambda i: f"Квиз-команда №{i} & друзья" if i % 7 == 0 else f"Квиз-команда №{i}")
+    location_names = pad_names(location_names, locations, lambda i: f"Бар «Пинта {i}»")
+    category_names = pad_names(category_names, categories, lambda i: f"Тематика {i}")
+    for names in (organizer_names, location_names, category_names):
+        rng.shuffle(names)
+    # По кругу, а не случайно: каждое имя попадает хотя бы в одно мероприятие, если их хватает
+    next_organizer = itertools.cycle(organizer_names).__next__
+    next_location = itertools.cycle(location_names).__next__
+    next_category = itertools.cycle(category_names).__next__
+    rows = []
+    today = date.today()
+    for day in range(days):
+        event_date = today + timedelta(days=day)
+        for number in range(events_per_day):
+            rows.append((
+                f"Игра #{day * events_per_day + number}", f"{rng.randint(12, 21)}:{rng.choice(('00', '30'))}",
+                rng.choice(("Классика", "Музыкальный", "Кино")), f"{rng.randint(5, 12) * 100} ₽",
+                next_category(), rng.choice(("Лёгкая", "Средняя", "Сложная")),
+                next_location(), f"ул. Синтетическая, {rng.randint(1, 200)}",
+                f"https://example.com/quiz/{day}/{number}", event_date, next_organizer(),
+            ))
+    connection.executemany(
+        "INSERT INTO msk_events (title, start_time, type, price, category, difficulty, location_name, "
+        "location_address, url, `date`, organizer) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        rows,
+    )
+    connection.commit()
+    return len(rows)
+
+
+def seed_subscriptions(connection: sqlite3.Connection, users: int, per_user: int = 2,
+                       frequency: str = 'daily', first_user_id: int = 100000, seed: int = 1) -> int:
+    """
+    Подписывает users пользователей (chat_id = user_id) на 1..per_user значений фильтров
+    из msk_events. Значения берутся с перекосом к популярным, как в жизни: у многих
+    подписчиков наборы совпадают, и рассылка склеивает их в одно содержимое.
+    """
+    rng = random.Random(seed)
+    values = [(column, value)
+              for column in msk_quiz_bot.FACET_COLUMNS
+              for (value,) in connection.execute(f"SELECT DISTINCT {column} FROM msk_events ORDER BY {column}")]
+    weights = [1 / (rank + 1) for rank in range(len(values))]
+    rows = []
+    for user_id in range(first_user_id, first_user_id + users):
+        chosen = set(rng.choices(values, weights, k=rng.randint(1, per_user)))
+        rows += [(user_id, user_id, column, value, frequency) for column, value in sorted(chosen)]
+    connection.executemany(
+        "INSERT INTO msk_user_subscriptions (user_id, chat_id, filter_type, filter_value, frequency) VALUES (?, ?, ?, ?, ?)",
+        rows,
+    )
+    connection.commit()
+    return len(rows)
+
+
+# --- Обновления ---
+
+update_ids = itertools.count(1)
+
+
+def make_user(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": "Бенч", "username": f"bench_{user_id}"}
+
+
+def make_message_update(bot: Bot, user_id: int, text: str) -> types.Update:
+    message = {
+        "message_id": next(update_ids),
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": make_user(user_id),
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return types.Update.model_validate({"update_id": next(update_ids), "message": message}, context={"bot": bot})
+
+
+def make_callback_update(bot: Bot, user_id: int, data: str) -> types.Update:
+    update_id = next(update_ids)
+    callback_query = {
+        "id": f"{user_id}:{update_id}",  # FakeTelegramApi узнаёт чат по префиксу id
+        "from": make_user(user_id),
+        "chat_instance": str(user_id),
+        "data": data,
+        "message": {
+            "message_id": next(update_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": 1, "is_bot": True, "first_name": "Бот"},
+            "text": "Выберите:",
+        },
+    }
+    return types.Update.model_validate({"update_id": update_id, "callback_query": callback_query}, context={"bot": bot})
+
+
+# --- Окружение бота ---
+
+@dataclass
+class BotEnvironment:
+    bot: Bot
+    api: FakeTelegramApi
+    pool: StandInPool
+
+    async def feed(self, update: types.Update):
+        """Возвращает результат dp.feed_update (UNHANDLED, если ни один хэндлер не подошёл)."""
+        return await msk_quiz_bot.dp.feed_update(self.bot, update)
+
+
+@contextlib.asynccontextmanager
+async def bot_environment(events_db: sqlite3.Connection, api_latency: float = 0.0, db_latency: float = 0.0,
+                          use_snapshot: bool = True, send_limits: bool = False):
+    """
+    Поднимает поддельный API, подменяет db_pool на StandInPool, FSM-хранилище - на временный
+    файл, и собирает Bot так же, как main(). send_limits=False отключает планировщик отправки:
+    меряется сам бот, а не лимиты Telegram. use_snapshot=False гоняет все выборки через SQL.
+    """
+    api = FakeTelegramApi(latency=api_latency)
+    await api.start()
+    pool = StandInPool(events_db, latency=db_latency)
+    msk_quiz_bot.db_pool = pool
+    tmp = tempfile.TemporaryDirectory()
+    msk_quiz_bot.fsm_storage.path = os.path.join(tmp.name, "fsm_storage.sqlite3")
+
+    bot = Bot(token=BENCH_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(api.base_url)))
+    if send_limits:
+        bot.session.middleware(msk_quiz_bot.send_scheduler)
+    bot.session.middleware(msk_quiz_bot.TelegramMetricsMiddleware())
+
+    msk_quiz_bot.stats_writer.start()
+    if use_snapshot:
+        if not await msk_quiz_bot.event_snapshot.refresh():
+            raise RuntimeError("Не удалось загрузить снимок мероприятий из StandInPool")
+        await msk_quiz_bot.job_scheduler.run_now("today_digest")  # Как при прогреве в main()
+    try:
+        yield BotEnvironment(bot=bot, api=api, pool=pool)
+    finally:
+        await msk_quiz_bot.send_scheduler.stop()
+        await msk_quiz_bot.stats_writer.stop()
+        await msk_quiz_bot.fsm_storage.close()
+        await bot.session.close()
+        await api.stop()
+        tmp.cleanup()
+
+
+# --- Статистика ---
+
+def percentile(sorted_values: list[float], p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def latency_summary(values_ms: list[float]) -> dict:
+    values = sorted(values_ms)
+    return {
+        "count": len(values),
+        "p50_ms": round(percentile(values, 50), 2),
+        "p95_ms": round(percentile(values, 95), 2),
+        "p99_ms": round(percentile(values, 99), 2),
+        "max_ms": round(values[-1], 2) if values else 0.0,
+    }
+
+
+def configure_logging(level: str) -> None:
+    # Бот пишет INFO на каждое сообщение; на тысячах обновлений это заметная доля времени и шума
+    logging.getLogger().setLevel(level.upper())
@@ -0,0 +1,307 @@
+"""
+Воспроизведение реального трафика из истории msk_user_filter_stats: каждая строка
+(команда, нажатие кнопки фильтра, выбор организатора / бара / тематики) превращается
+в обновление Telegram и подаётся в настоящий dp против заглушек из bench/harness.py
+с исходными интервалами между событиями, ускоренными в --speed раз.
+
+Выбор даты в статистику не пишется, поэтому после /by_date и выбора значения фильтра
+пользователь "нажимает" случайную дату из присланной ботом клавиатуры (--no-dates - не нажимать).
+Мероприятия в SQLite-заглушке генерируются с организаторами, барами и тематиками из истории,
+так что нагрузка по ним распределена как в жизни.
+
+Источник - таблица в MySQL (DB_CONFIG из msk_quiz_bot.py) или её выгрузка в CSV
+со столбцами user_id, user_name, filter_type, filter_value и столбцом времени.
+
+Примеры:
+    python bench/replay.py --csv stats.csv --speed 60
+    python bench/replay.py --from-db --since "2025-05-16 18:00" --until "2025-05-16 21:00" --speed 10 --json
+"""
+import argparse
+import asyncio
+import csv
+import json
+import random
+import re
+import sys
+import time
+from collections import Counter, defaultdict
+from dataclasses import dataclass
+from datetime import datetime
+
+from aiogram.dispatcher.event.bases import UNHANDLED
+
+import harness
+import msk_quiz_bot
+
+FILTER_BUTTONS = {'Организатор', 'Бар', 'Тематика'}
+
+# filter_type строки статистики -> (колонка для кода, префикс callback_data выбора, префикс выбора даты)
+FILTER_SELECTIONS = {
+    'filter_organizer': ('organizer', 'select_organizer:', 'select_org_date:'),
+    'filter_location': ('location_name', 'select_location_id:', 'select_loc_date_id:'),
+    'filter_category': ('category', 'select_category_id:', 'select_cat_date_id:'),
+}
+
+IDENTIFIER_RE = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+@dataclass
+class StatsRow:
+    at: datetime
+    user_id: int
+    user_name: str | None
+    filter_type: str
+    filter_value: str
+
+
+def parse_timestamp(value) -> datetime:
+    if isinstance(value, datetime):
+        return value
+    text = str(value).strip()
+    try:
+        return datetime.fromtimestamp(float(text))
+    except ValueError:
+        return datetime.fromisoformat(text)
+
+
+def load_csv(path: str, timestamp_column: str) -> list[StatsRow]:
+    with open(path, newline='', encoding='utf-8') as csv_file:
+        return [
+            StatsRow(parse_timestamp(row[timestamp_column]), int(row['user_id']), row.get('user_name') or None,
+                     row['filter_type'], row['filter_value'])
+            for row in csv.DictReader(csv_file)
+        ]
+
+
+def load_db(timestamp_column: str, since: str | None, until: str | None, limit: int | None) -> list[StatsRow]:
+    import mysql.connector
+
+    if not IDENTIFIER_RE.match(timestamp_column):
+        raise SystemExit(f"Недопустимое имя столбца времени: {timestamp_column}")
+    conditions, params = [], []
+    if since:
+        conditions.append(f"`{timestamp_column}` >= %s")
+        params.append(since)
+    if until:
+        conditions.append(f"`{timestamp_column}` < %s")
+        params.append(until)
+    sql = (f"SELECT `{timestamp_column}`, user_id, user_name, filter_type, filter_value FROM msk_user_filter_stats"
+           f"{' WHERE ' + ' AND '.join(conditions) if conditions else ''} ORDER BY `{timestamp_column}`"
+           f"{' LIMIT %d' % limit if limit else ''}")
+    connection = mysql.connector.connect(**msk_quiz_bot.DB_CONFIG)
+    try:
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
+        return [StatsRow(parse_timestamp(at), int(user_id), user_name, filter_type, filter_value)
+                for at, user_id, user_name, filter_type, filter_value in cursor.fetchall()]
+    finally:
+        connection.close()
+
+
+def schedule(rows: list[StatsRow], speed: float, max_gap: float | None) -> list[tuple[float, StatsRow]]:
+    """Смещение каждой строки от начала воспроизведения в секундах; паузы длиннее max_gap сжимаются."""
+    rows = sorted(rows, key=lambda row: row.at)
+    offsets, offset, previous = [], 0.0, None
+    for row in rows:
+        if previous is not None:
+            gap = (row.at - previous).total_seconds()
+            offset += min(gap, max_gap) if max_gap is not None else gap
+        offsets.append((offset / speed, row))
+        previous = row.at
+    return offsets
+
+
+class ReplayStats:
+    def __init__(self):
+        self.latency_ms: dict[str, list[float]] = defaultdict(list)
+        self.lag_ms: list[float] = []  # Сколько обновление ждало своей очереди сверх расписания
+        self.unhandled: Counter = Counter()
+        self.skipped: Counter = Counter()
+        self.errors: Counter = Counter()
+        self.updates = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+
+class UserReplayer:
+    """Обновления одного пользователя идут строго по порядку, разные пользователи - параллельно."""
+
+    def __init__(self, env: harness.BotEnvironment, user_id: int, click_dates: bool, rng: random.Random, stats: ReplayStats):
+        self.env = env
+        self.user_id = user_id
+        self.click_dates = click_dates
+        self.rng = rng
+        self.stats = stats
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.task = asyncio.create_task(self._run())
+
+    async def _feed(self, kind: str, update) -> None:
+        self.stats.in_flight += 1
+        self.stats.peak_in_flight = max(self.stats.peak_in_flight, self.stats.in_flight)
+        self.env.api.last_inline_keyboard.pop(self.user_id, None)
+        started = time.perf_counter()
+        try:
+            result = await self.env.feed(update)
+            if result is UNHANDLED:
+                self.stats.unhandled[kind] += 1
+        except Exception as e:
+            self.stats.errors[type(e).__name__] += 1
+        finally:
+            self.stats.in_flight -= 1
+        self.stats.latency_ms[kind].append((time.perf_counter() - started) * 1000)
+        self.stats.updates += 1
+
+    async def _click_date(self, kind: str, prefix: str) -> None:
+        buttons = [data for data in self.env.api.last_inline_keyboard.get(self.user_id, ()) if data.startswith(prefix)]
+        if buttons:
+            await self._feed(kind, harness.make_callback_update(self.env.bot, self.user_id, self.rng.choice(buttons)))
+
+    async def _replay(self, row: StatsRow) -> None:
+        bot = self.env.bot
+        if row.filter_type == 'command':
+            await self._feed(row.filter_value, harness.make_message_update(bot, self.user_id, row.filter_value))
+            if row.filter_value == '/by_date' and self.click_dates:
+                await self._click_date('date:', 'date:')
+        elif row.filter_type == 'filter_selection' and row.filter_value in FILTER_BUTTONS:
+            await self._feed(row.filter_value, harness.make_message_update(bot, self.user_id, row.filter_value))
+        elif row.filter_type in FILTER_SELECTIONS:
+            column, select_prefix, date_prefix = FILTER_SELECTIONS[row.filter_type]
+            code = msk_quiz_bot.facet_codes.encode(column, row.filter_value)
+            await self._feed(select_prefix, harness.make_callback_update(bot, self.user_id, f"{select_prefix}{code}"))
+            if self.click_dates:
+                await self._click_date(date_prefix, date_prefix)
+        else:
+            self.stats.skipped[row.filter_type] += 1
+
+    async def _run(self) -> None:
+        while True:
+            due, row = await self.queue.get()
+            self.stats.lag_ms.append(max(0.0, time.perf_counter() - due) * 1000)
+            await self._replay(row)
+            self.queue.task_done()
+
+
+async def replay(args, rows: list[StatsRow]) -> dict:
+    events_db = harness.create_events_db()
+    events = harness.seed_events(
+        events_db, days=args.days, events_per_day=args.events_per_day, seed=args.seed,
+        organizer_names=[row.filter_value for row in rows if row.filter_type == 'filter_organizer'],
+        location_names=[row.filter_value for row in rows if row.filter_type == 'filter_location'],
+        category_names=[row.filter_value for row in rows if row.filter_type == 'filter_category'],
+    )
+    timeline = schedule(rows, args.speed, args.max_gap)
+    stats = ReplayStats()
+    async with harness.bot_environment(
+        events_db, api_latency=args.api_latency / 1000, db_latency=args.db_latency / 1000,
+        use_snapshot=not args.no_snapshot, send_limits=args.send_limits,
+    ) as env:
+        replayers: dict[int, UserReplayer] = {}
+        api_calls_before = sum(env.api.calls.values())
+        started = time.perf_counter()
+        for offset, row in timeline:
+            due = started + offset
+            delay = due - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            replayer = replayers.get(row.user_id)
+            if replayer is None:
+                replayer = replayers[row.user_id] = UserReplayer(
+                    env, row.user_id, not args.no_dates, random.Random(args.seed * 1_000_003 + row.user_id), stats)
+            replayer.queue.put_nowait((due, row))
+        for replayer in replayers.values():
+            await replayer.queue.join()
+            replayer.task.cancel()
+        elapsed = time.perf_counter() - started
+        api_calls = sum(env.api.calls.values()) - api_calls_before
+        db_queries = env.pool.queries
+
+    all_latency = [value for values in stats.latency_ms.values() for value in values]
+    source_span = (timeline[-1][1].at - timeline[0][1].at).total_seconds() if timeline else 0.0
+    return {
+        "config": {
+            "rows": len(rows), "users": len(replayers), "speed": args.speed, "max_gap": args.max_gap,
+            "source_span_seconds": source_span, "events": events, "click_dates": not args.no_dates,
+            "api_latency_ms": args.api_latency, "db_latency_ms": args.db_latency,
+            "snapshot": not args.no_snapshot, "send_limits": args.send_limits,
+        },
+        "seconds": round(elapsed, 3),
+        "updates": stats.updates,
+        "updates_per_sec": round(stats.updates / elapsed, 1) if elapsed else 0.0,
+        "peak_in_flight": stats.peak_in_flight,
+        "latency": harness.latency_summary(all_latency),
+        "latency_by_kind": {kind: harness.latency_summary(values) for kind, values in sorted(stats.latency_ms.items())},
+        "schedule_lag": harness.latency_summary(stats.lag_ms),
+        "traffic_mix": dict(Counter(row.filter_type for row in rows).most_common()),
+        "api_calls": api_calls,
+        "db_queries": db_queries,
+        "unhandled": dict(stats.unhandled),
+        "skipped": dict(stats.skipped),
+        "errors": dict(stats.errors),
+    }
+
+
+def print_result(result: dict) -> None:
+    config = result["config"]
+    print(f"{config['rows']} строк истории ({config['source_span_seconds']:.0f} с) от {config['users']} пользователей, "
+          f"ускорение x{config['speed']}, {config['events']} мероприятий в заглушке")
+    print(f"{result['updates']} обновлений за {result['seconds']} с: {result['updates_per_sec']} обновлений/с, "
+          f"одновременно до {result['peak_in_flight']}")
+    print(f"вызовов API: {result['api_calls']}, запросов к БД: {result['db_queries']}, "
+          f"без хэндлера: {sum(result['unhandled'].values())}, пропущено строк: {sum(result['skipped'].values())}, "
+          f"ошибок: {sum(result['errors'].values())}")
+
+    def row(name, stats):
+        return (f"  {name:<22} n={stats['count']:<6} p50={stats['p50_ms']:>8} мс  p95={stats['p95_ms']:>8} мс  "
+                f"p99={stats['p99_ms']:>8} мс  max={stats['max_ms']:>8} мс")
+
+    print("\nОбработка обновления:")
+    print(row("всего", result["latency"]))
+    for kind, stats in result["latency_by_kind"].items():
+        print(row(kind, stats))
+    print("\nОтставание от расписания:")
+    print(row("очередь пользователя", result["schedule_lag"]))
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Воспроизведение трафика из msk_user_filter_stats")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--csv", help="выгрузка msk_user_filter_stats в CSV")
+    source.add_argument("--from-db", action="store_true", help="читать таблицу из MySQL (DB_CONFIG)")
+    parser.add_argument("--timestamp-column", default="created_at", help="столбец времени события")
+    parser.add_argument("--since", help="с какого момента (только --from-db)")
+    parser.add_argument("--until", help="до какого момента (только --from-db)")
+    parser.add_argument("--limit", type=int, help="не больше стольких строк")
+    parser.add_argument("--speed", type=float, default=1.0, help="во сколько раз ускорить исходные интервалы")
+    parser.add_argument("--max-gap", type=float, help="сжимать паузы в истории до стольких секунд (до ускорения)")
+    parser.add_argument("--no-dates", action="store_true", help="не нажимать дату после выбора фильтра и /by_date")
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--events-per-day", type=int, default=40)
+    parser.add_argument("--api-latency", type=float, default=0.0, help="задержка ответа поддельного API, мс")
+    parser.add_argument("--db-latency", type=float, default=0.0, help="задержка каждого запроса к БД, мс")
+    parser.add_argument("--no-snapshot", action="store_true", help="не загружать снимок: все выборки через SQL")
+    parser.add_argument("--send-limits", action="store_true", help="включить планировщик отправки с лимитами Telegram")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--json", action="store_true", help="вывести результат в JSON")
+    args = parser.parse_args()
+    if args.speed <= 0:
+        parser.error("--speed должен быть больше нуля")
+
+    harness.configure_logging(args.log_level)
+    if args.csv:
+        rows = load_csv(args.csv, args.timestamp_column)[:args.limit]
+    else:
+        rows = load_db(args.timestamp_column, args.since, args.until, args.limit)
+    if not rows:
+        raise SystemExit("В истории нет строк для воспроизведения")
+
+    result = await replay(args, rows)
+    if args.json:
+        json.dump(result, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+    else:
+        print_result(result)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
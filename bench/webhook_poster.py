@@ -0,0 +1,109 @@
+"""
+Имитация Telegram для проверки режима вебхука: шлёт на локальный вебхук бота
+синтетические обновления (команды и нажатия inline-кнопок) с секретным заголовком
+и печатает код ответа, задержку и тело ответа.
+
+Для callback_query в теле ответа должен прийти answerCallbackQuery - значит,
+бот ответил на нажатие прямо в ответе на вебхук, без отдельного запроса к API.
+
+Пример:
+    python msk_quiz_bot.py --mode webhook
+    python bench/webhook_poster.py --secret <WEBHOOK_SECRET> --count 20 --concurrency 5
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import time
+from datetime import date
+
+import aiohttp
+
+update_ids = itertools.count(1)
+
+
+def make_user(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": "Тест", "username": f"poster_{user_id}"}
+
+
+def make_message_update(user_id: int, text: str) -> dict:
+    update = {
+        "update_id": next(update_ids),
+        "message": {
+            "message_id": next(update_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": make_user(user_id),
+            "text": text,
+        },
+    }
+    if text.startswith("/"):
+        command = text.split()[0]
+        update["message"]["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+    return update
+
+
+def make_callback_update(user_id: int, data: str) -> dict:
+    update_id = next(update_ids)
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": make_user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": next(update_ids),
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": 1, "is_bot": True, "first_name": "Бот"},
+                "text": "Выберите дату:",
+            },
+        },
+    }
+
+
+def scripted_updates(user_id: int) -> list[dict]:
+    today = date.today().isoformat()
+    return [
+        make_message_update(user_id, "/today"),
+        make_message_update(user_id, "/by_date"),
+        make_callback_update(user_id, f"date:{today}"),
+    ]
+
+
+async def post_update(session: aiohttp.ClientSession, url: str, secret: str, update: dict) -> None:
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+    started = time.perf_counter()
+    async with session.post(url, json=update, headers=headers) as response:
+        body = await response.text()
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    kind = "callback_query" if "callback_query" in update else "message"
+    print(f"update {update['update_id']:>5} {kind:<15} -> {response.status} за {elapsed_ms:7.1f} мс {body[:200]}")
+    if kind == "callback_query" and response.status == 200 and body:
+        reply = json.loads(body)
+        assert reply.get("method") == "answerCallbackQuery", reply
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--url", default="http://127.0.0.1:8080/webhook")
+    parser.add_argument("--secret", default="")
+    parser.add_argument("--count", type=int, default=1, help="сколько пользователей имитировать")
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--first-user-id", type=int, default=100000)
+    args = parser.parse_args()
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def run_user(session: aiohttp.ClientSession, user_id: int):
+        async with semaphore:
+            for update in scripted_updates(user_id):
+                await post_update(session, args.url, args.secret, update)
+
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*(run_user(session, args.first_user_id + i) for i in range(args.count)))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
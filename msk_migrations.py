@@ -0,0 +1,314 @@
+import argparse
+import logging
+import sys
+from dataclasses import dataclass, field
+from datetime import date
+
+import mysql.connector
+from mysql.connector import Error
+
+from msk_quiz_bot import DATES_LIMIT, DB_CONFIG, FACET_COLUMNS, FacetFilter, facet_queries
+
+# Миграции схемы для msk_events, msk_user_filter_stats и таблиц подписок.
+# Запуск вручную (на большой таблице ALTER может идти долго, поэтому не при старте бота):
+#   python msk_migrations.py status   - какие версии применены
+#   python msk_migrations.py migrate  - применить недостающие
+#   python msk_migrations.py verify   - EXPLAIN для каждой формы запроса бота; код выхода 1 при полном скане
+
+MIGRATIONS_TABLE = "msk_schema_migrations"
+
+# Столбец времени в msk_user_filter_stats (заполняется по умолчанию CURRENT_TIMESTAMP)
+STATS_TIMESTAMP_COLUMN = "created_at"
+
+# Для индекса по TEXT/BLOB MySQL требует длину префикса; 191 символ utf8mb4 укладывается в лимит ключа
+TEXT_INDEX_PREFIX = 191
+
+TEXT_TYPES = {'tinytext', 'text', 'mediumtext', 'longtext', 'tinyblob', 'blob', 'mediumblob', 'longblob'}
+
+
+# --- Шаги миграций ---
+
+@dataclass
+class AddIndex:
+    """Создаёт индекс, если индекса с таким именем ещё нет; столбцы TEXT индексируются по префиксу."""
+    table: str
+    name: str
+    columns: tuple
+    optional: bool = False  # Пропустить, если какого-то столбца нет в таблице (схема не наша)
+
+    def describe(self) -> str:
+        return f"индекс {self.name} на {self.table} ({', '.join(self.columns)})"
+
+    def apply(self, cursor) -> None:
+        cursor.execute(
+            "SELECT 1 FROM information_schema.statistics "
+            "WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s LIMIT 1",
+            (self.table, self.name),
+        )
+        if cursor.fetchall():
+            logging.info(f"Уже есть: {self.describe()}")
+            return
+
+        cursor.execute(
+            "SELECT column_name, data_type FROM information_schema.columns "
+            "WHERE table_schema = DATABASE() AND table_name = %s",
+            (self.table,),
+        )
+        column_types = {name.lower(): data_type.lower() for name, data_type in cursor.fetchall()}
+        missing = [column for column in self.columns if column.lower() not in column_types]
+        if missing:
+            if self.optional:
+                logging.warning(f"Пропускаю {self.describe()}: нет столбцов {', '.join(missing)}")
+                return
+            raise Error(msg=f"Нельзя создать {self.describe()}: нет столбцов {', '.join(missing)}")
+
+        parts = []
+        for column in self.columns:
+            prefix = f"({TEXT_INDEX_PREFIX})" if column_types[column.lower()] in TEXT_TYPES else ""
+            parts.append(f"`{column}`{prefix}")
+        cursor.execute(f"CREATE INDEX `{self.name}` ON `{self.table}` ({', '.join(parts)})")
+        logging.info(f"Создан {self.describe()}")
+
+
+@dataclass
+class CreateTable:
+    """Создаёт таблицу, если её ещё нет (CREATE TABLE IF NOT EXISTS)."""
+    name: str
+    definition: str  # Столбцы и ключи - то, что внутри скобок CREATE TABLE
+
+    def describe(self) -> str:
+        return f"таблица {self.name}"
+
+    def apply(self, cursor) -> None:
+        cursor.execute(f"CREATE TABLE IF NOT EXISTS `{self.name}` ({self.definition})")
+        logging.info(f"Есть {self.describe()}")
+
+
+@dataclass
+class Migration:
+    version: int
+    name: str
+    steps: list = field(default_factory=list)
+
+
+# Версии только добавляются; уже выпущенную миграцию не меняем, а пишем новую.
+MIGRATIONS = [
+    Migration(1, "msk_events: выборки по дате", [
+        # get_events_by_date, список дат, загрузка снимка: WHERE `date` ... ORDER BY `start_time`
+        AddIndex("msk_events", "idx_msk_events_date_start", ("date", "start_time")),
+    ]),
+    Migration(2, "msk_events: фильтры по организатору, бару и тематике", [
+        # Даты по значению фильтра (WHERE X = %s AND `date` >= ...) и мероприятия по значению и дате
+        # (WHERE `date` = %s AND X = %s ORDER BY `start_time`): оба обслуживает (X, date, start_time)
+        AddIndex("msk_events", "idx_msk_events_organizer_date", ("organizer", "date", "start_time")),
+        AddIndex("msk_events", "idx_msk_events_location_date", ("location_name", "date", "start_time")),
+        AddIndex("msk_events", "idx_msk_events_category_date", ("category", "date", "start_time")),
+    ]),
+    Migration(3, "msk_user_filter_stats: выборки по времени и по фильтрам", [
+        # Выгрузка истории за период (bench/replay.py, отчёты)
+        AddIndex("msk_user_filter_stats", "idx_msk_user_filter_stats_time", (STATS_TIMESTAMP_COLUMN,), optional=True),
+        AddIndex("msk_user_filter_stats", "idx_msk_user_filter_stats_type_value", ("filter_type", "filter_value")),
+    ]),
+    Migration(4, "подписки на фильтры и контрольные точки рассылок", [
+        # Список подписок пользователя (WHERE user_id), выборка рассылки (WHERE frequency ... ORDER BY chat_id),
+        # пометка заблокировавших бота (WHERE chat_id IN ...)
+        CreateTable("msk_user_subscriptions", """
+            `id` BIGINT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+            `user_id` BIGINT NOT NULL,
+            `chat_id` BIGINT NOT NULL,
+            `filter_type` VARCHAR(32) NOT NULL,
+            `filter_value` VARCHAR(255) NOT NULL,
+            `frequency` VARCHAR(16) NOT NULL DEFAULT 'daily',
+            `blocked_at` TIMESTAMP NULL,
+            `created_at` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE KEY `uq_msk_user_subscriptions_filter` (`user_id`, `filter_type`, `filter_value`),
+            KEY `idx_msk_user_subscriptions_frequency_chat` (`frequency`, `chat_id`),
+            KEY `idx_msk_user_subscriptions_chat` (`chat_id`)
+            """),
+        CreateTable("msk_broadcast_runs", """
+            `run_key` VARCHAR(64) NOT NULL PRIMARY KEY,
+            `status` VARCHAR(16) NOT NULL,
+            `total_chats` INT NOT NULL DEFAULT 0,
+            `last_chat_id` BIGINT NULL,
+            `delivered` INT NOT NULL DEFAULT 0,
+            `failed` INT NOT NULL DEFAULT 0,
+            `blocked` INT NOT NULL DEFAULT 0,
+            `started_at` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            `updated_at` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+            """),
+        # Что уже разослано чату (WHERE chat_id IN ... AND event_date >= ...) и чистка прошедших дат (WHERE event_date < ...)
+        CreateTable("msk_subscription_sent", """
+            `chat_id` BIGINT NOT NULL,
+            `event_key` CHAR(32) NOT NULL,
+            `event_date` DATE NOT NULL,
+            PRIMARY KEY (`chat_id`, `event_key`),
+            KEY `idx_msk_subscription_sent_date` (`event_date`)
+            """),
+    ]),
+    Migration(5, "личные настройки пользователей", [
+        # Режим /digest: читается по user_id один раз на пользователя, дальше - из кэша бота
+        CreateTable("msk_user_settings", """
+            `user_id` BIGINT NOT NULL PRIMARY KEY,
+            `digest` BOOLEAN NOT NULL,
+            `updated_at` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+            """),
+    ]),
+]
+
+
+# --- Применение ---
+
+def ensure_migrations_table(cursor) -> None:
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS `{MIGRATIONS_TABLE}` (
+            `version` INT NOT NULL PRIMARY KEY,
+            `name` VARCHAR(255) NOT NULL,
+            `applied_at` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        """)
+
+
+def applied_versions(cursor) -> dict[int, str]:
+    cursor.execute(f"SELECT `version`, `applied_at` FROM `{MIGRATIONS_TABLE}` ORDER BY `version`")
+    return {version: str(applied_at) for version, applied_at in cursor.fetchall()}
+
+
+def migrate(connection) -> int:
+    """Применяет недостающие миграции по порядку; возвращает, сколько применено."""
+    cursor = connection.cursor()
+    ensure_migrations_table(cursor)
+    done = applied_versions(cursor)
+    applied = 0
+    for migration in MIGRATIONS:
+        if migration.version in done:
+            continue
+        logging.info(f"Миграция {migration.version}: {migration.name}")
+        # DDL в MySQL не откатывается транзакцией, поэтому каждый шаг сам проверяет, не сделан ли он
+        for step in migration.steps:
+            step.apply(cursor)
+        cursor.execute(f"INSERT INTO `{MIGRATIONS_TABLE}` (`version`, `name`) VALUES (%s, %s)",
+                       (migration.version, migration.name))
+        connection.commit()
+        applied += 1
+    logging.info(f"Применено миграций: {applied}, схема на версии {MIGRATIONS[-1].version}.")
+    return applied
+
+
+def status(connection) -> None:
+    cursor = connection.cursor()
+    ensure_migrations_table(cursor)
+    done = applied_versions(cursor)
+    for migration in MIGRATIONS:
+        mark = f"применена {done[migration.version]}" if migration.version in done else "НЕ применена"
+        print(f"{migration.version:>3}  {mark:<32} {migration.name}")
+
+
+# --- Проверка планов запросов ---
+
+@dataclass
+class QueryShape:
+    name: str
+    kind: str                         # Вид выборки FacetQueryEngine: events / dates / values / watermarks
+    on_date: bool = False             # Конкретная дата (иначе - начиная с сегодня)
+    filter_column: str | None = None  # Колонка фильтра, в которую подставляется реальное значение
+    column: str | None = None         # Для values - чьи значения перечисляем
+    limit: int | None = None
+
+    def statement(self, sample_date: date, sample_value: str) -> tuple[str, tuple]:
+        values = {self.filter_column: sample_value} if self.filter_column else {}
+        if self.on_date:
+            spec = FacetFilter.of(on_date=sample_date, **values)
+        else:
+            spec = FacetFilter.of(date_from=date.today(), **values)
+        return facet_queries.statement(self.kind, spec, self.column, self.limit)
+
+
+def query_shapes() -> list[QueryShape]:
+    """Формы запросов функций get_* и загрузки снимка: SQL строит тот же FacetQueryEngine, что и бот."""
+    shapes = [
+        QueryShape("events_by_date", 'events', on_date=True),
+        QueryShape("distinct_dates", 'dates', limit=DATES_LIMIT),
+        QueryShape("snapshot", 'events'),
+        QueryShape("snapshot_watermarks", 'watermarks'),
+    ]
+    for column in FACET_COLUMNS:
+        shapes += [
+            QueryShape(f"distinct_{column}", 'values', column=column),
+            QueryShape(f"dates_by_{column}", 'dates', filter_column=column, limit=DATES_LIMIT),
+            QueryShape(f"events_by_{column}_and_date", 'events', on_date=True, filter_column=column),
+        ]
+    return shapes
+
+
+def sample_params(cursor, shape: QueryShape) -> tuple[date, str]:
+    """
+    Реальные значения из таблицы, чтобы оптимизатор видел правдоподобную селективность.
+    Если предстоящих мероприятий нет, дата - сегодняшняя: без даты FacetFilter
+    выбросил бы условие по ней, и EXPLAIN проверял бы не тот запрос, что шлёт бот.
+    """
+    if shape.filter_column is None:
+        cursor.execute("SELECT MIN(`date`) FROM `msk_events` WHERE `date` >= CURDATE()")
+        (sample_date,) = cursor.fetchone()
+        return sample_date or date.today(), ""
+    cursor.execute(
+        f"SELECT `date`, `{shape.filter_column}` FROM `msk_events` WHERE `date` >= CURDATE() "
+        f"AND `{shape.filter_column}` IS NOT NULL AND `{shape.filter_column}` != '' LIMIT 1"
+    )
+    row = cursor.fetchone()
+    return row if row else (date.today(), "")
+
+
+def verify(connection) -> bool:
+    """
+    EXPLAIN для каждой формы запроса. Ошибка - type=ALL без единого подходящего индекса
+    (possible_keys пуст): такой запрос дорожает вместе с таблицей. Если индекс есть, но
+    оптимизатор выбрал полный скан (бывает на маленьких таблицах), это только предупреждение.
+    """
+    cursor = connection.cursor(dictionary=True, buffered=True)
+    plain_cursor = connection.cursor(buffered=True)
+    ok = True
+    for shape in query_shapes():
+        sql, params = shape.statement(*sample_params(plain_cursor, shape))
+        cursor.execute(f"EXPLAIN {sql}", params)
+        for row in cursor.fetchall():
+            access, key, possible = row.get('type'), row.get('key'), row.get('possible_keys')
+            line = (f"{shape.name:<36} {row.get('table')}: type={access}, key={key}, "
+                    f"rows={row.get('rows')}, extra={row.get('Extra') or '-'}")
+            if access == 'ALL' and not possible:
+                print(f"FAIL {line}")
+                ok = False
+            elif access in ('ALL', 'index'):
+                print(f"WARN {line}")
+            else:
+                print(f"OK   {line}")
+    return ok
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Миграции схемы и проверка индексов для msk_quiz_bot")
+    parser.add_argument("command", choices=("migrate", "status", "verify"))
+    args = parser.parse_args()
+
+    try:
+        connection = mysql.connector.connect(**DB_CONFIG)
+    except Error as e:
+        logging.error(f"Ошибка подключения к базе данных: {e}")
+        return 2
+    try:
+        if args.command == "migrate":
+            migrate(connection)
+        elif args.command == "status":
+            status(connection)
+        elif not verify(connection):
+            logging.error("Есть запросы без подходящего индекса (полный скан таблицы).")
+            return 1
+    except Error as e:
+        logging.error(f"Ошибка выполнения миграции: {e}")
+        return 2
+    finally:
+        connection.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,17 +1,41 @@
+import argparse
 import asyncio
+import base64
+import bisect
+import contextlib
+import contextvars
+import functools
+import hashlib
+import hmac
+import itertools
+import json
 import logging
+import math
 import mysql.connector
+import mysql.connector.aio
 import re
+import sqlite3
+import threading
+import time
+import weakref
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
 from datetime import datetime, date, timedelta
-from aiogram import Bot, Dispatcher, types, F
-from aiogram.filters import Command
-from aiogram.filters.state import StateFilter
+from zoneinfo import ZoneInfo
+from aiohttp import web
+from aiogram import BaseMiddleware, Bot, Dispatcher, types, F
+from aiogram.filters import Command, CommandObject
 from aiogram.utils.keyboard import InlineKeyboardBuilder, ReplyKeyboardBuilder
-from aiogram.types import BotCommand, ReplyKeyboardRemove
+from aiogram.types import BotCommand, InlineKeyboardButton, ReplyKeyboardRemove
 from aiogram.types import BotCommandScopeDefault
-from aiogram.fsm.context import FSMContext
-from aiogram.fsm.state import StatesGroup, State
-from mysql.connector import Error
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.dispatcher.event.bases import UNHANDLED
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+from aiogram.methods import AnswerCallbackQuery
+from mysql.connector import Error, errors
+from pydantic import ValidationError
 
 # --- Константы и настройки ---
 # !!! ЗАМЕНИТЕ ЗДЕСЬ НА ВАШИ ЗНАЧЕНИЯ !!!
@@ -23,30 +47,636 @@ DB_CONFIG = {
     'password': '', # Пароль пользователя БД
     'database': ''   # Имя вашей базы данных
 }
+
+ADMIN_IDS: set[int] = set()  # user_id администраторов в Telegram (служебные команды, например /slow_queries)
 # !!! ЗАМЕНИТЕ ВЫШЕ НА ВАШИ ЗНАЧЕНИЯ !!!
 
+# Режим получения обновлений: "polling" или "webhook" (можно переопределить ключом --mode)
+BOT_MODE = "polling"
+
+# Настройки вебхука (нужны только в режиме "webhook")
+WEBHOOK_URL = ""                    # Публичный HTTPS-адрес вебхука, например https://bot.example.com/webhook
+WEBHOOK_SECRET = ""                 # Секрет, который Telegram присылает в X-Telegram-Bot-Api-Secret-Token; без него вебхук не запускается
+WEBHOOK_HOST = "0.0.0.0"            # На каком адресе слушать входящие обновления
+WEBHOOK_PORT = 8080
+WEBHOOK_PATH = "/webhook"
+WEBHOOK_REPLY_TIMEOUT = 0.5         # Сколько секунд ждать answerCallbackQuery, чтобы вернуть его в ответе на вебхук
+
+# Настройки FSM-хранилища (состояния фильтров пользователей)
+FSM_STORAGE_PATH = "fsm_storage.sqlite3"  # Файл SQLite рядом с ботом
+FSM_STORAGE_TTL = 24 * 60 * 60       # Через сколько секунд без изменений состояние пользователя забывается
+FSM_STORAGE_MAX_ENTRIES = 100000     # Жёсткий лимит записей (в памяти и в файле)
+FSM_STORAGE_FLUSH_INTERVAL = 1.0     # Как часто (в секундах) сбрасывать изменения в файл
+
+# Обработка входящих обновлений
+UPDATE_MAX_CONCURRENCY = 32         # Сколько обновлений обрабатывать одновременно (разные чаты); 0 - без ограничений и очередей
+UPDATE_CHAT_QUEUE_DEPTH = 5         # Сколько обновлений одного чата может ждать, пока обрабатывается предыдущее
+
+# Настройки пула соединений с БД
+DB_POOL_MIN_SIZE = 2                # Сколько соединений держать открытыми всегда
+DB_POOL_MAX_SIZE = 10               # Максимум одновременно открытых соединений
+DB_POOL_ACQUIRE_TIMEOUT = 5.0       # Сколько секунд ждать свободное соединение
+DB_POOL_HEALTHCHECK_INTERVAL = 30.0 # Через сколько секунд простоя проверять соединение перед выдачей
+DB_PREPARED_CACHE_SIZE = 64         # Сколько серверных prepared statements держать на одном соединении
+
+# Защита от недоступной БД (circuit breaker)
+DB_BREAKER_FAILURE_THRESHOLD = 3    # После стольких ошибок соединения подряд перестаём ходить в БД
+DB_BREAKER_PROBE_INTERVAL = 5.0     # Как часто (в секундах) фоновая проверка пробует БД, пока к ней не ходим
+DB_LAST_GOOD_MAX_SIZE = 2000        # Сколько последних удачных выборок помнить, чтобы отдать их при недоступной БД
+
+# Профилирование SQL-запросов
+SLOW_QUERY_THRESHOLD = 0.2          # Запросы дольше стольких секунд попадают в журнал медленных запросов
+SLOW_QUERY_LOG_SIZE = 500           # Сколько последних медленных запросов держать в памяти
+SQL_EXPLAIN_ENABLED = True          # Снимать EXPLAIN один раз для каждой формы SELECT-запроса
+
+# Настройки записи статистики (msk_user_filter_stats)
+STATS_BUFFER_MAX_SIZE = 10000       # Больше строк в памяти не держим, лишние отбрасываем
+STATS_FLUSH_BATCH_SIZE = 200        # Сколько строк писать одним INSERT
+STATS_FLUSH_INTERVAL = 2.0          # Как часто (в секундах) сбрасывать буфер, даже если он не заполнен
+
+# Настройки отправки сообщений (лимиты Telegram)
+SEND_GLOBAL_RATE = 30.0             # Сообщений в секунду на всего бота
+SEND_GLOBAL_BURST = 30              # Сколько сообщений можно отправить разом после простоя
+SEND_CHAT_RATE = 1.0                # Сообщений в секунду в один личный чат
+SEND_GROUP_CHAT_RATE = 20 / 60      # Сообщений в секунду в одну группу (Telegram: 20 в минуту)
+SEND_CHAT_BURST = 5                 # Всплеск сообщений в один чат (ответ из нескольких карточек)
+SEND_MAX_RETRIES = 3                # Сколько раз повторять отправку после TelegramRetryAfter
+
+# Настройки снимка мероприятий в памяти
+EVENT_SNAPSHOT_TTL = 300.0          # Как часто (в секундах) перечитывать предстоящие мероприятия из БД целиком
+EVENT_SNAPSHOT_SYNC_INTERVAL = 5.0  # Как часто сверять с БД водяные знаки дат и перечитывать изменившиеся даты
+CARD_CACHE_MAX_SIZE = 2000          # Сколько отрисованных карточек мероприятий держать в памяти
+DATE_PICKER_CACHE_MAX_SIZE = 1000   # Сколько готовых клавиатур выбора даты держать в памяти
+DIGEST_PREFERENCES_CACHE_MAX_SIZE = 50000  # Скольких пользователей с прочитанным выбором /digest держать в памяти
+DIGEST_MODE_DEFAULT = True          # Присылать мероприятия дайджестом (несколько карточек в сообщении), пока пользователь не выбрал иное
+
+# Фоновые задачи по расписанию
+SCHEDULER_TIMEZONE = "Europe/Moscow"  # В каком часовом поясе задано время ежедневных задач
+TODAY_DIGEST_BUILD_AT = (0, 1)      # Во сколько (часы, минуты) собирать готовый ответ /today на новый день
+JOB_RETRY_BACKOFF = 30.0            # Через сколько секунд повторить задачу после ошибки не из-за БД (дальше - вдвое дольше)
+JOB_MAX_RETRIES = 4                 # Сколько таких повторов, потом задача ждёт следующего запуска по расписанию
+
+# Подписки и рассылка
+SUBSCRIPTION_PUSH_AT = (10, 0)      # Во сколько (часы, минуты) рассылать подписчикам новые мероприятия
+SUBSCRIPTION_WEEKLY_WEEKDAY = 0     # В какой день недели (0 - понедельник) уходит еженедельная рассылка
+SUBSCRIPTION_HORIZON_DAYS = 7       # На сколько дней вперёд (включая сегодня) мероприятия попадают в рассылку
+SUBSCRIPTION_USER_LIMIT = 20        # Больше подписок у одного пользователя не бывает
+BROADCAST_BATCH_SIZE = 25           # Сколько чатов рассылки отправлять одновременно; после каждой пачки - контрольная точка
+BROADCAST_RATE = 20.0               # Сообщений рассылки в секунду: остаток SEND_GLOBAL_RATE остаётся ответам пользователям
+
+# Настройки метрик (HTTP-эндпоинт в текстовом формате Prometheus)
+METRICS_HOST = "127.0.0.1"          # Только локально: метрики снимает Prometheus на той же машине
+METRICS_PORT = 9101                 # 0 - не запускать эндпоинт
+METRICS_PATH = "/metrics"
+HEALTH_PATH = "/healthz"            # Готовность бота (200 после прогрева, иначе 503) на том же сервере
+
+# Прогрев при запуске
+WARMUP_DEADLINE = 15.0              # Сколько секунд максимум ждать прогрев перед приёмом обновлений
+
 # Уровень логирования: DEBUG - для подробной отладки, INFO - для обычной работы
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 
-# --- Инициализация бота и диспетчера ---
-bot = Bot(token=API_TOKEN)
-dp = Dispatcher()
+# --- Метрики (текстовый формат Prometheus) ---
+
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_metric_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def format_metric_labels(labelnames: tuple, labelvalues: tuple) -> str:
+    if not labelnames:
+        return ""
+    pairs = []
+    for name, value in zip(labelnames, labelvalues):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class Counter:
+    """Монотонный счётчик с метками; значения хранятся по кортежу значений меток."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(labels[name] for name in self.labelnames)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in self._values.items():
+            yield self.name, self.labelnames, key, value
+
+
+class Histogram:
+    """Гистограмма длительностей (в секундах) с накопительными корзинами, как в Prometheus."""
+
+    kind = "histogram"
 
-# --- Определение состояний для FSM ---
-class OrganizerFilterStates(StatesGroup):
-    waiting_for_organizer_selection = State()
-    waiting_for_date_selection = State()
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (),
+                 buckets: tuple = METRICS_LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series: dict[tuple, list] = {}  # метки -> [число попаданий в каждую корзину..., сумма, количество]
 
-class LocationFilterStates(StatesGroup):
-    waiting_for_location_selection = State()
-    waiting_for_date_selection = State()
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(labels[name] for name in self.labelnames)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+        position = bisect.bisect_left(self.buckets, value)
+        if position < len(self.buckets):
+            series[position] += 1
+        series[-2] += value
+        series[-1] += 1
 
-class CategoryFilterStates(StatesGroup):
-    waiting_for_category_selection = State()
-    waiting_for_date_selection = State()
+    def samples(self):
+        bucket_labelnames = self.labelnames + ('le',)
+        for key, series in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                yield f"{self.name}_bucket", bucket_labelnames, key + (format_metric_value(bound),), cumulative
+            yield f"{self.name}_bucket", bucket_labelnames, key + ("+Inf",), series[-1]
+            yield f"{self.name}_sum", self.labelnames, key, series[-2]
+            yield f"{self.name}_count", self.labelnames, key, series[-1]
 
 
+class CallbackMetric:
+    """
+    Значение, которое уже ведёт другой объект (счётчики кэшей, глубина очереди и т.п.):
+    снимается вызовом callback в момент запроса /metrics. С метками callback
+    возвращает словарь {кортеж значений меток: значение}.
+    """
+
+    def __init__(self, kind: str, name: str, documentation: str, callback, labelnames: tuple = ()):
+        self.kind = kind
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+        self.labelnames = tuple(labelnames)
+
+    def samples(self):
+        values = self.callback()
+        if not self.labelnames:
+            values = {(): values}
+        for key, value in values.items():
+            yield self.name, self.labelnames, key, value
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: dict[str, object] = {}
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Метрика {metric.name} уже зарегистрирована")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple = (),
+                  buckets: tuple = METRICS_LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def counter_callback(self, name: str, documentation: str, callback, labelnames: tuple = ()) -> CallbackMetric:
+        return self.register(CallbackMetric("counter", name, documentation, callback, labelnames))
+
+    def gauge_callback(self, name: str, documentation: str, callback, labelnames: tuple = ()) -> CallbackMetric:
+        return self.register(CallbackMetric("gauge", name, documentation, callback, labelnames))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            try:
+                samples = list(metric.samples())
+            except Exception as e:
+                # Сломанная метрика не должна ломать выдачу остальных
+                logging.error(f"Ошибка сбора метрики {metric.name}: {e}")
+                continue
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labelnames, labelvalues, value in samples:
+                lines.append(f"{name}{format_metric_labels(labelnames, labelvalues)} {format_metric_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+handler_latency = metrics.histogram(
+    "msk_bot_handler_duration_seconds", "Время работы хэндлера обновления.", ("handler",))
+query_latency = metrics.histogram(
+    "msk_bot_query_duration_seconds", "Время выполнения функций чтения мероприятий (get_*).", ("query",))
+telegram_request_latency = metrics.histogram(
+    "msk_bot_telegram_request_duration_seconds", "Время запроса к Telegram Bot API (без ожидания в очереди отправки).", ("method",))
+event_cards_sent = metrics.counter(
+    "msk_bot_event_cards_sent_total", "Отправлено карточек мероприятий.", ("mode",))
+errors_total = metrics.counter(
+    "msk_bot_errors_total", "Ошибки по источнику (handler, db, telegram) и типу исключения.", ("source", "type"))
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Внутренний middleware диспетчера: время работы и исключения каждого хэндлера."""
+
+    async def __call__(self, handler, event, data):
+        handler_object = data.get('handler')
+        name = handler_object.callback.__name__ if handler_object is not None else 'unknown'
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            errors_total.inc(source="handler", type=type(e).__name__)
+            raise
+        finally:
+            handler_latency.observe(time.perf_counter() - started, handler=name)
+
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота: число и длительность запросов к API по методам и их ошибки."""
+
+    async def __call__(self, make_request, bot: Bot, method):
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            errors_total.inc(source="telegram", type=type(e).__name__)
+            raise
+        finally:
+            telegram_request_latency.observe(time.perf_counter() - started, method=method.__api_method__)
+
+
+def timed_query(func):
+    """Декоратор для функций get_*: время каждого вызова попадает в query_latency."""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            query_latency.observe(time.perf_counter() - started, query=func.__name__)
+    return wrapper
+
+
+# --- FSM-хранилище в SQLite ---
+
+@dataclass
+class FsmRecord:
+    state: str | None = None
+    data: dict = field(default_factory=dict)
+    expires_at: float = 0.0
+
+    def is_empty(self) -> bool:
+        return self.state is None and not self.data
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    FSM-хранилище в локальном файле SQLite с кэшем в памяти и отложенной записью.
+    Чтения обслуживаются из кэша (при промахе - из файла), записи меняют кэш и попадают
+    в очередь, которая раз в flush_interval секунд пишется в файл одной транзакцией.
+    Каждая запись живёт ttl секунд с последнего изменения, так что брошенные на полпути
+    фильтры исчезают сами; кэш и файл ограничены max_entries записями.
+    Все обращения к файлу идут в отдельном потоке и не блокируют event loop.
+    """
+
+    LOAD_BATCH_SIZE = 500
+
+    def __init__(self, path: str, ttl: float, max_entries: int, flush_interval: float):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.flush_interval = flush_interval
+        self.path = path
+        self._key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._db: sqlite3.Connection | None = None  # Открывается при первом обращении
+        self._db_lock = threading.Lock()
+        self._cache: OrderedDict[str, FsmRecord] = OrderedDict()  # LRU, в т.ч. пустые записи-промахи
+        self._dirty: dict[str, FsmRecord] = {}     # Изменения, ещё не записанные в файл
+        self._flushing: dict[str, FsmRecord] = {}  # Изменения, которые пишутся прямо сейчас
+        self._pending_loads: dict[str, asyncio.Future] = {}  # Ключи, ждущие чтения из файла
+        self._loader: asyncio.Task | None = None
+        self._task: asyncio.Task | None = None
+        self._last_sweep = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    # Работа с файлом (выполняется в потоке, под _db_lock)
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._db is None:
+            db = sqlite3.connect(self.path, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS fsm_storage (
+                    key TEXT PRIMARY KEY,
+                    state TEXT,
+                    data TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                )""")
+            db.execute("CREATE INDEX IF NOT EXISTS fsm_storage_expires_at ON fsm_storage (expires_at)")
+            db.commit()
+            self._db = db
+        return self._db
+
+    def _db_load_many(self, keys: list[str]) -> dict[str, FsmRecord]:
+        placeholders = ", ".join("?" * len(keys))
+        with self._db_lock:
+            rows = self._connection().execute(
+                f"SELECT key, state, data, expires_at FROM fsm_storage WHERE key IN ({placeholders})", keys
+            ).fetchall()
+        return {key: FsmRecord(state=state, data=json.loads(data), expires_at=expires_at)
+                for key, state, data, expires_at in rows}
+
+    def _db_write(self, batch: dict[str, FsmRecord], sweep: bool) -> None:
+        upserts = [(key, r.state, json.dumps(r.data, ensure_ascii=False), r.expires_at)
+                   for key, r in batch.items() if not r.is_empty()]
+        deletes = [(key,) for key, r in batch.items() if r.is_empty()]
+        with self._db_lock:
+            db = self._connection()
+            with db:
+                self._write_batch(db, upserts, deletes, sweep)
+
+    def _write_batch(self, db: sqlite3.Connection, upserts: list, deletes: list, sweep: bool) -> None:
+        if upserts:
+            db.executemany("""
+                INSERT INTO fsm_storage (key, state, data, expires_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET state = excluded.state, data = excluded.data,
+                    expires_at = excluded.expires_at""", upserts)
+        if deletes:
+            db.executemany("DELETE FROM fsm_storage WHERE key = ?", deletes)
+        if sweep:
+            db.execute("DELETE FROM fsm_storage WHERE expires_at < ?", (time.time(),))
+            # Жёсткий лимит: сверх max_entries удаляем записи, которые истекут раньше всех
+            db.execute("""
+                DELETE FROM fsm_storage WHERE key IN (
+                    SELECT key FROM fsm_storage ORDER BY expires_at DESC LIMIT -1 OFFSET ?
+                )""", (self.max_entries,))
+
+    # Кэш
+
+    async def _get_record(self, key: StorageKey) -> FsmRecord:
+        str_key = self._key_builder.build(key)
+        record = self._cache.get(str_key)
+        if record is None:
+            record = self._dirty.get(str_key) or self._flushing.get(str_key)
+        if record is not None:
+            self.cache_hits += 1
+        else:
+            self.cache_misses += 1
+            record = await self._load(str_key) or FsmRecord()
+            # Пока читали файл, запись могла измениться - свежая версия важнее
+            record = self._cache.get(str_key) or self._dirty.get(str_key) or record
+
+        if not record.is_empty() and record.expires_at < time.time():
+            record = FsmRecord()
+        self._remember(str_key, record)
+        return record
+
+    async def _load(self, str_key: str) -> FsmRecord | None:
+        """
+        Промахи кэша, случившиеся одновременно (например, тысячи пользователей сразу после
+        перезапуска), читаются из файла пачками одним запросом вместо потока на каждый ключ.
+        """
+        future = self._pending_loads.get(str_key)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self._pending_loads[str_key] = future
+            if self._loader is None or self._loader.done():
+                self._loader = asyncio.create_task(self._run_loader())
+        # shield: отмена одного ожидающего не должна отменять чтение для остальных
+        return await asyncio.shield(future)
+
+    async def _run_loader(self) -> None:
+        while self._pending_loads:
+            keys = list(itertools.islice(self._pending_loads, self.LOAD_BATCH_SIZE))
+            batch = {key: self._pending_loads.pop(key) for key in keys}
+            try:
+                records = await asyncio.to_thread(self._db_load_many, keys)
+            except sqlite3.Error as e:
+                logging.error(f"Ошибка чтения FSM-хранилища из SQLite: {e}")
+                records = {}
+            for key, future in batch.items():
+                if not future.done():
+                    future.set_result(records.get(key))
+
+    def _remember(self, str_key: str, record: FsmRecord) -> None:
+        self._cache[str_key] = record
+        self._cache.move_to_end(str_key)
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)  # Несохранённое остаётся в _dirty до записи
+
+    def _put_record(self, key: StorageKey, record: FsmRecord) -> None:
+        str_key = self._key_builder.build(key)
+        record.expires_at = time.time() + self.ttl
+        self._remember(str_key, record)
+        self._dirty[str_key] = record
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    @property
+    def entries(self) -> int:
+        return len(self._cache)
+
+    def state_counts(self) -> dict[str, int]:
+        """Сколько пользователей сейчас в каждом состоянии (по записям в памяти)."""
+        now = time.time()
+        counts: dict[str, int] = {}
+        for record in self._cache.values():
+            if record.state is not None and record.expires_at > now:
+                counts[record.state] = counts.get(record.state, 0) + 1
+        return counts
+
+    # Интерфейс BaseStorage
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        record = await self._get_record(key)
+        new_state = state.state if isinstance(state, State) else state
+        self._put_record(key, FsmRecord(state=new_state, data=record.data))
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        return (await self._get_record(key)).state
+
+    async def set_data(self, key: StorageKey, data: dict) -> None:
+        record = await self._get_record(key)
+        self._put_record(key, FsmRecord(state=record.state, data=data.copy()))
+
+    async def get_data(self, key: StorageKey) -> dict:
+        return (await self._get_record(key)).data.copy()
+
+    # Отложенная запись
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self) -> None:
+        now = time.monotonic()
+        sweep = now - self._last_sweep > 60
+        if not self._dirty and not sweep:
+            return
+        self._flushing, self._dirty = self._dirty, {}
+        try:
+            await asyncio.to_thread(self._db_write, self._flushing, sweep)
+            if sweep:
+                self._last_sweep = now
+        except sqlite3.Error as e:
+            logging.error(f"Ошибка записи FSM-хранилища в SQLite: {e}")
+            # Возвращаем несохранённое в очередь, не затирая более свежие изменения
+            self._dirty = {**self._flushing, **self._dirty}
+        finally:
+            self._flushing = {}
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        if self._dirty:
+            await self.flush()
+        with self._db_lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+fsm_storage = SQLiteStorage(
+    FSM_STORAGE_PATH,
+    ttl=FSM_STORAGE_TTL,
+    max_entries=FSM_STORAGE_MAX_ENTRIES,
+    flush_interval=FSM_STORAGE_FLUSH_INTERVAL,
+)
+
+
+# --- Очереди обновлений по чатам ---
+
+update_queue_wait = metrics.histogram(
+    "msk_bot_update_queue_wait_seconds", "Ожидание обновления в очереди чата и общего лимита до начала обработки.")
+updates_dropped = metrics.counter(
+    "msk_bot_updates_dropped_total", "Обновления, отброшенные из очереди чата: повтор ждущего (duplicate) или переполнение (overflow).",
+    ("reason",))
+
+
+@dataclass(eq=False)
+class QueuedUpdate:
+    key: tuple | None     # Для поиска повторов: тот же текст сообщения или та же callback_data
+    turn: asyncio.Future  # True - очередь дошла, False - обновление отброшено
+    queued_at: float
+    started: bool = False  # Получило место в общем лимите и обрабатывается
+
+
+class ChatUpdateQueue(BaseMiddleware):
+    """
+    Внешний middleware для dp.update. Обновления разных чатов обрабатываются параллельно,
+    но не больше max_concurrency одновременно; обновления одного чата - строго по одному,
+    в порядке поступления (тяжёлый ответ одного пользователя не задерживает остальных).
+    В очереди чата ждут не больше max_chat_queue обновлений: повтор уже ждущего обновления
+    вытесняет его как устаревшее, а при переполнении отбрасывается самое старое из ждущих.
+    Первое обновление в очереди чата - то, что обрабатывается (или ждёт общего лимита).
+    """
+
+    def __init__(self, max_concurrency: int, max_chat_queue: int):
+        self.max_concurrency = max_concurrency
+        self.max_chat_queue = max(1, max_chat_queue)
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self._chats: dict[int, deque[QueuedUpdate]] = {}
+        self.in_flight = 0
+        self.queued = 0
+
+    @property
+    def active_chats(self) -> int:
+        return len(self._chats)
+
+    @staticmethod
+    def duplicate_key(update: types.Update) -> tuple | None:
+        if update.message is not None and update.message.text:
+            return ('message', update.message.text)
+        if update.callback_query is not None and update.callback_query.data:
+            return ('callback_query', update.callback_query.data)
+        return None
+
+    @staticmethod
+    def _drop(queue: deque, entry: QueuedUpdate, reason: str) -> None:
+        queue.remove(entry)
+        entry.turn.set_result(False)
+        updates_dropped.inc(reason=reason)
+
+    async def _run(self, handler, event, data, entry: QueuedUpdate):
+        async with self._slots:
+            entry.started = True
+            self.queued -= 1
+            update_queue_wait.observe(time.monotonic() - entry.queued_at)
+            self.in_flight += 1
+            try:
+                return await handler(event, data)
+            finally:
+                self.in_flight -= 1
+
+    async def __call__(self, handler, event: types.Update, data: dict):
+        entry = QueuedUpdate(self.duplicate_key(event), asyncio.get_running_loop().create_future(), time.monotonic())
+        self.queued += 1
+        chat = data.get('event_chat')
+        if chat is None:
+            try:
+                return await self._run(handler, event, data, entry)
+            finally:
+                if not entry.started:
+                    self.queued -= 1
+
+        queue = self._chats.setdefault(chat.id, deque())
+        if entry.key is not None:
+            for waiting in list(itertools.islice(queue, 1, None)):
+                if waiting.key == entry.key:
+                    self._drop(queue, waiting, "duplicate")
+        queue.append(entry)
+        while len(queue) - 1 > self.max_chat_queue:
+            self._drop(queue, queue[1], "overflow")
+        if queue[0] is entry:
+            entry.turn.set_result(True)
+
+        try:
+            if not await entry.turn:
+                logging.debug(f"Обновление {event.update_id} чата {chat.id} отброшено из очереди чата.")
+                return UNHANDLED
+            return await self._run(handler, event, data, entry)
+        finally:
+            if not entry.started:
+                self.queued -= 1
+            if queue and queue[0] is entry:
+                queue.popleft()
+                if queue:
+                    queue[0].turn.set_result(True)
+            elif any(waiting is entry for waiting in queue):  # Отменено, пока ждало очереди
+                queue.remove(entry)
+            if not queue and self._chats.get(chat.id) is queue:
+                del self._chats[chat.id]
+
+
+# --- Инициализация диспетчера (сам бот создаётся в main, чтобы модуль импортировался без токена) ---
+dp = Dispatcher(storage=fsm_storage)
+
+handler_metrics = HandlerMetricsMiddleware()
+dp.message.middleware(handler_metrics)
+dp.callback_query.middleware(handler_metrics)
+
+update_queue = ChatUpdateQueue(max_concurrency=UPDATE_MAX_CONCURRENCY, max_chat_queue=UPDATE_CHAT_QUEUE_DEPTH)
+if UPDATE_MAX_CONCURRENCY:
+    dp.update.outer_middleware(update_queue)
+
 # --- Словари (Русские названия) ---
 RUSSIAN_MONTH_NAMES_GENITIVE = {
     1: "Января", 2: "Февраля", 3: "Марта", 4: "Апреля",
@@ -62,356 +692,1272 @@ RUSSIAN_WEEKDAY_NAMES = {
 # --- Функции для работы с БД ---
 # *** ЭТОТ БЛОК С ФУНКЦИЯМИ БД ДОЛЖЕН НАХОДИТЬСЯ ВЫШЕ БЛОКА ХЭНДЛЕРОВ ***
 
-def create_db_connection():
-    connection = None
-    try:
-        connection = mysql.connector.connect(**DB_CONFIG)
-    except Error as e:
-        logging.error(f"Ошибка подключения к базе данных: {e}")
-        connection = None
-    return connection
-
-def get_events_by_date(target_date: date):
-    events = []
-    connection = create_db_connection()
-    if connection is None:
-        return None
+db_statement_latency = metrics.histogram(
+    "msk_bot_db_statement_duration_seconds", "Время выполнения SQL-запроса по форме запроса (id из /slow_queries).", ("statement",))
+db_slow_queries = metrics.counter(
+    "msk_bot_db_slow_queries_total", "Запросов дольше SLOW_QUERY_THRESHOLD.", ("statement",))
+db_prepared_statements = metrics.counter(
+    "msk_bot_db_prepared_statements_total", "Prepared statements: подготовлено заново (prepare) и использовано повторно (reuse).", ("event",))
+
+
+@dataclass
+class QueryStats:
+    """Накопленная статистика одной формы запроса (SQL без учёта параметров и пробелов)."""
+    shape: str
+    shape_id: str
+    count: int = 0
+    total_time: float = 0.0
+    max_time: float = 0.0
+    max_time_params: tuple = ()
+    rows_total: int = 0
+    slow_count: int = 0
+    explain: list[dict] | None = None  # Результат EXPLAIN, если уже снят
+
+
+@dataclass
+class SlowQuery:
+    at: datetime
+    shape_id: str
+    duration: float
+    rows: int
+    params: tuple
+
+
+class QueryLog:
+    """
+    Журнал SQL-запросов пула: время, число строк и параметры каждого выполнения
+    сводятся в QueryStats по форме запроса; выполнения дольше slow_threshold
+    пишутся в лог и в кольцевой буфер последних медленных запросов.
+    Список плейсхолдеров IN (%s, %s, ...) любой длины - одна форма: иначе каждая
+    длина пачки заводила бы свою запись и свою метку statement в метриках.
+    """
 
-    cursor = connection.cursor(dictionary=True)
-    try:
-        select_events_sql = """
-        SELECT
+    IN_LIST_RE = re.compile(r'\bIN \(%s(?:, ?%s)*\)', re.IGNORECASE)
+
+    def __init__(self, slow_threshold: float, max_slow_entries: int):
+        self.slow_threshold = slow_threshold
+        self.shapes: dict[str, QueryStats] = {}
+        self.slow: deque[SlowQuery] = deque(maxlen=max_slow_entries)
+
+    @staticmethod
+    def normalize(sql: str) -> str:
+        return QueryLog.IN_LIST_RE.sub("IN (...)", " ".join(sql.split()).rstrip(';').rstrip())
+
+    def record(self, sql: str, params: tuple, duration: float, rows: int) -> tuple[QueryStats, bool]:
+        """Учитывает одно выполнение; возвращает статистику формы и признак, что форма встретилась впервые."""
+        shape = self.normalize(sql)
+        stats = self.shapes.get(shape)
+        is_new = stats is None
+        if is_new:
+            shape_id = hashlib.blake2b(shape.encode('utf-8'), digest_size=4).hexdigest()
+            stats = self.shapes[shape] = QueryStats(shape=shape, shape_id=shape_id)
+
+        stats.count += 1
+        stats.total_time += duration
+        stats.rows_total += rows
+        if duration > stats.max_time:
+            stats.max_time = duration
+            stats.max_time_params = tuple(params)
+        db_statement_latency.observe(duration, statement=stats.shape_id)
+
+        if duration >= self.slow_threshold:
+            stats.slow_count += 1
+            db_slow_queries.inc(statement=stats.shape_id)
+            self.slow.append(SlowQuery(datetime.now(), stats.shape_id, duration, rows, tuple(params)))
+            logging.warning(f"Медленный запрос [{stats.shape_id}] {duration * 1000:.1f} мс, строк: {rows}, "
+                            f"параметры: {format_query_params(params)}: {shape}")
+        return stats, is_new
+
+    def top(self, limit: int) -> list[QueryStats]:
+        """Формы запросов, отсортированные по самому долгому выполнению."""
+        return sorted(self.shapes.values(), key=lambda stats: stats.max_time, reverse=True)[:limit]
+
+
+def format_query_params(params, max_length: int = 100) -> str:
+    shown = []
+    for value in params or ():
+        text = repr(value)
+        shown.append(text if len(text) <= max_length else text[:max_length] + "...")
+    return "(" + ", ".join(shown) + ")"
+
+
+def summarize_explain(explain: list[dict] | None) -> str:
+    """Коротко о плане MySQL: для каждой таблицы - тип доступа, индекс и оценка строк."""
+    if explain is None:
+        return "EXPLAIN ещё не снят"
+    parts = []
+    for row in explain:
+        extra = f", {row['Extra']}" if row.get('Extra') else ""
+        parts.append(f"{row.get('table')}: type={row.get('type')}, key={row.get('key')}, rows={row.get('rows')}{extra}")
+    return "; ".join(parts) or "пустой план"
+
+
+class CircuitOpenError(errors.PoolError):
+    """БД считается недоступной: запрос отклонён сразу, без попытки соединиться."""
+
+
+class CircuitBreaker:
+    """
+    Размыкатель для обращений к БД.
+      closed    - запросы идут в БД; failure_threshold ошибок соединения подряд размыкают цепь;
+      open      - запросы сразу получают CircuitOpenError, не дожидаясь таймаутов,
+                  а фоновая проверка раз в probe_interval секунд пробует БД;
+      half_open - идёт проверка; удачная замыкает цепь, неудачная снова размыкает.
+    Ошибками соединения считаются обрывы, отказы в подключении и таймауты пула,
+    но не ошибки в самих запросах.
+    """
+
+    CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+    STATE_CODES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, failure_threshold: int, probe_interval: float, probe):
+        self.failure_threshold = failure_threshold
+        self.probe_interval = probe_interval
+        self._probe = probe  # async () -> bool
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_count = 0
+        self.rejected_count = 0
+        self._probe_task: asyncio.Task | None = None
+
+    @property
+    def closed(self) -> bool:
+        return self.state == self.CLOSED
+
+    def allow(self) -> bool:
+        if self.state == self.CLOSED:
+            return True
+        self.rejected_count += 1
+        return False
+
+    def record_success(self) -> None:
+        self.failures = 0
+
+    def record_failure(self) -> None:
+        if self.state != self.CLOSED:
+            return
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self.opened_count += 1
+            logging.error(f"БД недоступна ({self.failures} ошибок подряд): обращения к ней приостановлены, "
+                          f"проверка раз в {self.probe_interval} с.")
+            if self._probe_task is None:
+                self._probe_task = asyncio.create_task(self._run_probe())
+
+    async def _run_probe(self) -> None:
+        try:
+            while True:
+                await asyncio.sleep(self.probe_interval)
+                self.state = self.HALF_OPEN
+                try:
+                    ok = await self._probe()
+                except Exception as e:
+                    logging.warning(f"Проверка БД не удалась: {e}")
+                    ok = False
+                if ok:
+                    self.state = self.CLOSED
+                    self.failures = 0
+                    logging.info("БД снова доступна: обращения к ней возобновлены.")
+                    return
+                self.state = self.OPEN
+        finally:
+            self._probe_task = None
+
+    async def stop(self) -> None:
+        if self._probe_task is not None:
+            self._probe_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._probe_task
+
+
+class DbPool:
+    """
+    Асинхронный пул соединений с MySQL поверх mysql.connector.aio.
+    Держит от min_size до max_size открытых соединений, проверяет соединение,
+    простоявшее дольше healthcheck_interval, перед выдачей и ждёт свободное
+    соединение не дольше acquire_timeout (иначе PoolError).
+    Каждый запрос учитывается в query_log; для новой формы SELECT-запроса
+    (если explain_queries) в фоне один раз снимается EXPLAIN.
+    fetch_prepared выполняет запрос серверным prepared statement, который готовится
+    один раз на соединение и дальше только исполняется с новыми параметрами.
+    Ошибки соединения учитывает breaker; пока он разомкнут, acquire сразу
+    бросает CircuitOpenError.
+    """
+
+    # Ошибки, после которых БД считается недоступной (а не ошибочным конкретный запрос).
+    # PoolError сюда не входит: нехватка свободных соединений - локальная перегрузка,
+    # а не отказ сервера, и размыкать из-за неё breaker нельзя.
+    OUTAGE_ERRORS = (errors.OperationalError, errors.InterfaceError)
+
+    def __init__(self, config: dict, min_size: int, max_size: int,
+                 acquire_timeout: float, healthcheck_interval: float,
+                 query_log: QueryLog, breaker: CircuitBreaker, explain_queries: bool = False,
+                 prepared_cache_size: int = 64):
+        self._config = config
+        self.breaker = breaker
+        self.query_log = query_log
+        self.prepared_cache_size = prepared_cache_size
+        # соединение -> LRU (SQL, dictionary) -> (курсор с подготовленным запросом, тот же объект SQL)
+        self._prepared: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+        self.explain_queries = explain_queries
+        self._explain_tasks: set[asyncio.Task] = set()
+        self.min_size = min_size
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self.healthcheck_interval = healthcheck_interval
+        self._idle: deque = deque()  # (соединение, время возврата в пул)
+        self._size = 0               # сколько соединений открыто или открывается
+        self._condition = asyncio.Condition()
+        self._maintenance_task: asyncio.Task | None = None
+        self._closed = False
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    @property
+    def idle_count(self) -> int:
+        return len(self._idle)
+
+    async def _connect(self):
+        # autocommit обязателен: иначе долгоживущее соединение видит один и тот же снимок данных
+        try:
+            return await mysql.connector.aio.connect(**self._config, autocommit=True)
+        except (OSError, asyncio.TimeoutError) as e:
+            # aio-коннектор пропускает сетевые ошибки как есть, приводим их к ошибкам mysql.connector
+            raise errors.InterfaceError(f"Ошибка подключения к базе данных: {e!r}") from e
+
+    async def _discard(self, connection) -> None:
+        try:
+            await connection.close()
+        except Exception as e:
+            logging.debug(f"Ошибка при закрытии соединения с БД: {e}")
+
+    async def open(self) -> None:
+        """Открывает min_size соединений заранее и запускает фоновую проверку простаивающих."""
+        self._closed = False
+        while self._size < self.min_size:
+            self._size += 1
+            try:
+                connection = await self._connect()
+            except Error as e:
+                self._size -= 1
+                logging.error(f"Ошибка подключения к базе данных при открытии пула: {e}")
+                break
+            self._idle.append((connection, time.monotonic()))
+        if self._maintenance_task is None:
+            self._maintenance_task = asyncio.create_task(self._maintain())
+        logging.info(f"Пул соединений с БД открыт: {self._size} соединений (min={self.min_size}, max={self.max_size}).")
+
+    async def close(self) -> None:
+        self._closed = True
+        if self._maintenance_task is not None:
+            self._maintenance_task.cancel()
+            self._maintenance_task = None
+        async with self._condition:
+            idle = list(self._idle)
+            self._idle.clear()
+            self._size -= len(idle)
+            self._condition.notify_all()
+        for connection, _ in idle:
+            await self._discard(connection)
+        await self.breaker.stop()
+        logging.info("Пул соединений с БД закрыт.")
+
+    async def probe(self) -> bool:
+        """Отдельное от пула соединение и SELECT 1: соединения в пуле после сбоя могут быть мёртвыми."""
+        connection = await self._connect()
+        try:
+            cursor = await connection.cursor()
+            await cursor.execute("SELECT 1")
+            await cursor.fetchall()
+            return True
+        finally:
+            await self._discard(connection)
+
+    async def _acquire(self):
+        deadline = time.monotonic() + self.acquire_timeout
+        connection, returned_at = None, None
+        async with self._condition:
+            while True:
+                if self._closed:
+                    raise errors.PoolError("Пул соединений с БД закрыт")
+                if self._idle:
+                    connection, returned_at = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise errors.PoolError(f"Нет свободного соединения с БД за {self.acquire_timeout} с")
+                try:
+                    await asyncio.wait_for(self._condition.wait(), remaining)
+                except asyncio.TimeoutError:
+                    raise errors.PoolError(f"Нет свободного соединения с БД за {self.acquire_timeout} с")
+
+        try:
+            if connection is None:
+                connection = await self._connect()
+            elif time.monotonic() - returned_at > self.healthcheck_interval and not await connection.is_connected():
+                logging.warning("Соединение из пула не прошло проверку, переподключаюсь.")
+                await self._discard(connection)
+                connection = await self._connect()
+        except BaseException:
+            await self._release_slot()
+            raise
+        return connection
+
+    async def _release_slot(self) -> None:
+        async with self._condition:
+            self._size -= 1
+            self._condition.notify()
+
+    async def _release(self, connection, discard: bool = False) -> None:
+        if discard or self._closed:
+            await self._discard(connection)
+            await self._release_slot()
+            return
+        async with self._condition:
+            self._idle.append((connection, time.monotonic()))
+            self._condition.notify()
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        """Выдаёт соединение из пула и возвращает его обратно (сломанное - закрывает)."""
+        if not self.breaker.allow():
+            raise CircuitOpenError("БД недоступна, обращения приостановлены")
+        try:
+            connection = await self._acquire()
+        except Error as e:
+            errors_total.inc(source="db", type=type(e).__name__)
+            if isinstance(e, self.OUTAGE_ERRORS) and not self._closed:
+                self.breaker.record_failure()
+            raise
+        discard = False
+        try:
+            yield connection
+        except Error as e:
+            errors_total.inc(source="db", type=type(e).__name__)
+            # После обрыва связи посреди запроса состояние соединения неизвестно
+            discard = isinstance(e, (errors.OperationalError, errors.InterfaceError))
+            if discard:
+                self.breaker.record_failure()
+            raise
+        except asyncio.CancelledError:
+            discard = True
+            raise
+        else:
+            self.breaker.record_success()
+        finally:
+            await self._release(connection, discard)
+
+    async def _maintain(self) -> None:
+        """Периодически пингует простаивающие соединения и добирает пул до min_size."""
+        while True:
+            await asyncio.sleep(self.healthcheck_interval)
+            async with self._condition:
+                idle = list(self._idle)
+                self._idle.clear()
+            alive = []
+            for connection, returned_at in idle:
+                if await connection.is_connected():
+                    alive.append((connection, returned_at))
+                else:
+                    await self._discard(connection)
+                    await self._release_slot()
+            async with self._condition:
+                self._idle.extend(alive)
+                self._condition.notify(len(alive))
+            while not self._closed and self._size < self.min_size:
+                self._size += 1
+                try:
+                    connection = await self._connect()
+                except Error as e:
+                    await self._release_slot()
+                    logging.warning(f"Не удалось пополнить пул соединений с БД: {e}")
+                    break
+                await self._release(connection)
+
+    def _record_query(self, sql: str, params: tuple, started: float, rows: int) -> None:
+        stats, is_new = self.query_log.record(sql, params, time.perf_counter() - started, rows)
+        if is_new and self.explain_queries and stats.shape.upper().startswith("SELECT"):
+            task = asyncio.create_task(self._explain(stats, sql, params))
+            self._explain_tasks.add(task)
+            task.add_done_callback(self._explain_tasks.discard)
+
+    async def _explain(self, stats: QueryStats, sql: str, params: tuple) -> None:
+        try:
+            stats.explain = await self.fetch_all(f"EXPLAIN {sql}", params, dictionary=True, profile=False)
+            logging.info(f"EXPLAIN [{stats.shape_id}] {summarize_explain(stats.explain)}")
+        except Error as e:
+            logging.warning(f"Не удалось снять EXPLAIN для запроса [{stats.shape_id}]: {e}")
+
+    async def fetch_all(self, sql: str, params: tuple = (), dictionary: bool = False, profile: bool = True) -> list:
+        async with self.acquire() as connection:
+            cursor = await connection.cursor(dictionary=dictionary)
+            try:
+                started = time.perf_counter()
+                await cursor.execute(sql, params)
+                rows = await cursor.fetchall()
+                if profile:
+                    self._record_query(sql, params, started, len(rows))
+                return rows
+            finally:
+                await cursor.close()
+
+    async def _prepared_cursor(self, connection, sql: str, dictionary: bool):
+        statements = self._prepared.get(connection)
+        if statements is None:
+            statements = self._prepared[connection] = OrderedDict()
+        key = (sql, dictionary)
+        cached = statements.get(key)
+        if cached is not None:
+            statements.move_to_end(key)
+            db_prepared_statements.inc(event="reuse")
+            return cached
+        cursor = await connection.cursor(prepared=True, dictionary=dictionary)
+        cached = statements[key] = (cursor, sql)
+        db_prepared_statements.inc(event="prepare")
+        if len(statements) > self.prepared_cache_size:
+            _, (evicted, _) = statements.popitem(last=False)
+            await evicted.close()  # Освобождает statement на сервере
+        return cached
+
+    async def fetch_prepared(self, sql: str, params: tuple = (), dictionary: bool = False) -> list:
+        """Как fetch_all, но через закэшированный на соединении серверный prepared statement."""
+        async with self.acquire() as connection:
+            cursor, prepared_sql = await self._prepared_cursor(connection, sql, dictionary)
+            try:
+                started = time.perf_counter()
+                # Курсор готовит запрос заново, только если ему передали другой объект строки
+                await cursor.execute(prepared_sql, params)
+                rows = await cursor.fetchall()
+            except Error:
+                self._prepared.get(connection, {}).pop((sql, dictionary), None)
+                # Закрываем курсор, иначе statement остаётся на сервере, пока живёт соединение
+                with contextlib.suppress(Error):
+                    await cursor.close()
+                raise
+            self._record_query(sql, params, started, len(rows))
+            return rows
+
+    async def execute(self, sql: str, params: tuple = ()) -> int:
+        async with self.acquire() as connection:
+            cursor = await connection.cursor()
+            try:
+                started = time.perf_counter()
+                await cursor.execute(sql, params)
+                self._record_query(sql, params, started, cursor.rowcount)
+                return cursor.rowcount
+            finally:
+                await cursor.close()
+
+    async def execute_many(self, sql: str, rows: list[tuple]) -> int:
+        """Для INSERT ... VALUES коннектор сам склеивает строки в один многострочный INSERT."""
+        async with self.acquire() as connection:
+            cursor = await connection.cursor()
+            try:
+                started = time.perf_counter()
+                await cursor.executemany(sql, rows)
+                # В журнал попадают параметры первой строки пачки
+                self._record_query(sql, rows[0] if rows else (), started, cursor.rowcount)
+                return cursor.rowcount
+            finally:
+                await cursor.close()
+
+
+db_breaker = CircuitBreaker(
+    failure_threshold=DB_BREAKER_FAILURE_THRESHOLD,
+    probe_interval=DB_BREAKER_PROBE_INTERVAL,
+    probe=lambda: db_pool.probe(),
+)
+
+db_pool = DbPool(
+    DB_CONFIG,
+    min_size=DB_POOL_MIN_SIZE,
+    max_size=DB_POOL_MAX_SIZE,
+    acquire_timeout=DB_POOL_ACQUIRE_TIMEOUT,
+    healthcheck_interval=DB_POOL_HEALTHCHECK_INTERVAL,
+    query_log=QueryLog(slow_threshold=SLOW_QUERY_THRESHOLD, max_slow_entries=SLOW_QUERY_LOG_SIZE),
+    breaker=db_breaker,
+    explain_queries=SQL_EXPLAIN_ENABLED,
+    prepared_cache_size=DB_PREPARED_CACHE_SIZE,
+)
+
+
+EVENT_COLUMNS_SQL = """
             title, start_time, type, price, category, difficulty,
-            location_name, location_address, url, `date`, organizer
-        FROM `msk_events`
-        WHERE `date` = %s
-        ORDER BY `start_time`;
-        """
-        cursor.execute(select_events_sql, (target_date,))
-        events = cursor.fetchall()
+            location_name, location_address, url, `date`, organizer"""
 
-    except Error as e:
-        logging.error(f"Ошибка выполнения SQL запроса при получении мероприятий по дате: {e}")
-        events = None
-    finally:
-        if cursor: cursor.close()
-        if connection and connection.is_connected():
-            connection.close()
-    return events
+# Поля, от которых считается контрольная сумма даты (дата - ключ группировки)
+EVENT_CHECKSUM_COLUMNS = (
+    'title', 'start_time', 'type', 'price', 'category', 'difficulty',
+    'location_name', 'location_address', 'url', 'organizer',
+)
 
 
-def get_distinct_event_dates():
-    dates = []
-    connection = create_db_connection()
-    if connection is None:
-        return None
+# --- Индекс фильтров (организатор / место / тематика -> даты -> мероприятия) ---
 
-    cursor = connection.cursor()
-    try:
-        select_dates_sql = """
-        SELECT DISTINCT `date`
-        FROM `msk_events`
-        WHERE `date` >= CURDATE()
-        ORDER BY `date`
-        LIMIT 30;
-        """
-        cursor.execute(select_dates_sql)
-        dates_raw = cursor.fetchall()
-        dates = [d[0] for d in dates_raw]
+DATES_LIMIT = 30  # Сколько ближайших дат показывать в выборе даты (как LIMIT 30 в SQL)
 
-    except Error as e:
-        logging.error(f"Ошибка выполнения SQL запроса при получении уникальных дат: {e}")
-        dates = None
-    finally:
-        if cursor: cursor.close()
-        if connection and connection.is_connected():
-            connection.close()
-    return dates
+FACET_COLUMNS = ('organizer', 'location_name', 'category')
 
+FACET_PAGE_SIZE = 20  # Сколько организаторов/мест/тематик показывать на одной странице клавиатуры
 
-def get_distinct_organizers():
-    organizers = []
-    connection = create_db_connection()
-    if connection is None:
-        return None
 
-    cursor = connection.cursor()
-    try:
-        select_organizers_sql = """
-        SELECT DISTINCT `organizer`
-        FROM `msk_events`
-        WHERE `date` >= CURDATE() AND `organizer` IS NOT NULL AND `organizer` != ''
-        ORDER BY `organizer`;
+def paginate(items: list, page_size: int = FACET_PAGE_SIZE) -> list[list]:
+    """Режет список на страницы; у пустого списка одна пустая страница."""
+    return [items[i:i + page_size] for i in range(0, len(items), page_size)] or [[]]
+
+
+class FacetIndex:
+    """
+    Строится одним проходом по снимку мероприятий. Для каждого значения организатора,
+    места и тематики хранит отсортированный список дат (не больше DATES_LIMIT) и
+    мероприятия по каждой дате, а также общий список дат для /by_date.
+    После построения не меняется - при обновлении данных строится новый индекс.
+    """
+
+    def __init__(self, events_by_date: dict[date, list[dict]]):
+        sorted_dates = sorted(events_by_date)
+        self.dates: list[date] = sorted_dates[:DATES_LIMIT]
+
+        events: dict[str, dict[str, dict[date, list[dict]]]] = {column: {} for column in FACET_COLUMNS}
+        for event_date in sorted_dates:
+            for event in events_by_date[event_date]:
+                for column in FACET_COLUMNS:
+                    value = event.get(column)
+                    if not value:  # NULL и пустые строки в списки фильтров не попадают, как и в SQL
+                        continue
+                    events[column].setdefault(value, {}).setdefault(event_date, []).append(event)
+
+        self._events = events
+        # MySQL сортирует без учёта регистра, повторяем это через casefold
+        self._values = {column: sorted(by_value, key=str.casefold) for column, by_value in events.items()}
+        self._dates = {
+            column: {value: list(by_date)[:DATES_LIMIT] for value, by_date in by_value.items()}
+            for column, by_value in events.items()
+        }
+        self._pages = {column: paginate(values) for column, values in self._values.items()}
+
+    def values(self, column: str) -> list[str]:
+        return self._values[column]
+
+    def pages(self, column: str) -> list[list[str]]:
+        return self._pages[column]
+
+    def dates_for(self, column: str, value: str) -> list[date]:
+        return self._dates[column].get(value, [])
+
+    def events_for(self, column: str, value: str, target_date: date) -> list[dict]:
+        return self._events[column].get(value, {}).get(target_date, [])
+
+    def patched(self, old_events_by_date: dict[date, list[dict]], events_by_date: dict[date, list[dict]],
+                changed_dates: list[date]) -> 'FacetIndex':
+        """
+        Новый индекс после замены мероприятий на changed_dates. Пересчитываются только значения
+        фильтров, которые встречались на этих датах до или после изменения; остальное берётся
+        из текущего индекса как есть (он не меняется и остаётся целым для тех, кто его читает).
         """
-        cursor.execute(select_organizers_sql)
-        organizers_raw = cursor.fetchall()
-        organizers = [o[0] for o in organizers_raw]
+        changed = set(changed_dates)
+        index = FacetIndex.__new__(FacetIndex)
+        index.dates = sorted(events_by_date)[:DATES_LIMIT]
+        index._events = {column: dict(by_value) for column, by_value in self._events.items()}
+        index._dates = {column: dict(by_value) for column, by_value in self._dates.items()}
+        index._values = dict(self._values)
+        index._pages = dict(self._pages)
+
+        for column in FACET_COLUMNS:
+            # значение -> дата -> новые мероприятия на изменившихся датах
+            fresh: dict[str, dict[date, list[dict]]] = {}
+            affected = set()
+            for event_date in sorted(changed):
+                for event in old_events_by_date.get(event_date, ()):
+                    if event.get(column):
+                        affected.add(event[column])
+                for event in events_by_date.get(event_date, ()):
+                    value = event.get(column)
+                    if value:
+                        affected.add(value)
+                        fresh.setdefault(value, {}).setdefault(event_date, []).append(event)
+            if not affected:
+                continue
+
+            by_value, dates_by_value = index._events[column], index._dates[column]
+            for value in affected:
+                by_date = {event_date: events for event_date, events in by_value.get(value, {}).items()
+                           if event_date not in changed}
+                by_date.update(fresh.get(value, {}))
+                if by_date:
+                    by_value[value] = dict(sorted(by_date.items()))
+                    dates_by_value[value] = list(by_value[value])[:DATES_LIMIT]
+                else:
+                    by_value.pop(value, None)
+                    dates_by_value.pop(value, None)
+            if len(by_value) != len(self._values[column]) or not all(value in by_value for value in self._values[column]):
+                index._values[column] = sorted(by_value, key=str.casefold)
+                index._pages[column] = paginate(index._values[column])
+        return index
+
+
+# --- Короткие коды значений фильтров для callback_data ---
+
+class FacetCodes:
+    """
+    Общий на процесс словарь коротких кодов для организаторов, мест и тематик.
+    Код - начало base32 от blake2b(колонка + значение) длиной CODE_LENGTH: он зависит
+    только от значения, поэтому не меняется между обновлениями данных и перезапусками
+    бота, укладывается в лимит callback_data в 64 байта и декодируется без обращения к FSM.
+    Если начала хэшей двух значений совпали (на 50 битах это практически исключено),
+    короткий код достаётся меньшему при сравнении строк значению, а остальные удлиняются.
+    update строит таблицу заново по значениям снимка, так что она не растёт без конца.
+    """
 
-    except Error as e:
-        logging.error(f"Ошибка выполнения SQL запроса при получении уникальных организаторов: {e}")
-        organizers = None
-    finally:
-        if cursor: cursor.close()
-        if connection and connection.is_connected():
-            connection.close()
-    return organizers
+    CODE_LENGTH = 10
 
+    def __init__(self):
+        self._codes: dict[tuple[str, str], str] = {}   # (колонка, значение) -> код
+        self._values: dict[tuple[str, str], str] = {}  # (колонка, код) -> значение
 
-def get_distinct_dates_by_organizer(organizer_name: str):
-    dates = []
-    connection = create_db_connection()
-    if connection is None:
-        return None
+    @classmethod
+    def _assign(cls, codes: dict, values: dict, column: str, value: str) -> str:
+        digest = base64.b32encode(hashlib.blake2b(f"{column}\0{value}".encode(), digest_size=20).digest())
+        digest = digest.decode().lower()
+        length = cls.CODE_LENGTH
+        while (column, digest[:length]) in values:
+            length += 1
+        code = digest[:length]
+        codes[(column, value)] = code
+        values[(column, code)] = value
+        return code
 
-    cursor = connection.cursor()
-    try:
-        select_dates_sql = """
-        SELECT DISTINCT `date`
-        FROM `msk_events`
-        WHERE `date` >= CURDATE() AND `organizer` = %s
-        ORDER BY `date`
-        LIMIT 30;
-        """
-        cursor.execute(select_dates_sql, (organizer_name,))
-        dates_raw = cursor.fetchall()
-        dates = [d[0] for d in dates_raw]
+    def encode(self, column: str, value: str) -> str:
+        code = self._codes.get((column, value))
+        if code is None:
+            code = self._assign(self._codes, self._values, column, value)
+        return code
 
-    except Error as e:
-        logging.error(f"Ошибка выполнения SQL запроса при получении дат по организатору ({organizer_name}): {e}")
-        dates = None
-    finally:
-        if cursor: cursor.close()
-        if connection and connection.is_connected():
-            connection.close()
-    return dates
+    def decode(self, column: str, code: str) -> str | None:
+        return self._values.get((column, code))
 
+    def update(self, index: 'FacetIndex') -> None:
+        """Заменяет таблицу построенной по снимку; значения обходятся по порядку, чтобы коды не зависели от порядка в БД."""
+        codes: dict[tuple[str, str], str] = {}
+        values: dict[tuple[str, str], str] = {}
+        for column in FACET_COLUMNS:
+            for value in sorted(index.values(column)):
+                self._assign(codes, values, column, value)
+        self._codes, self._values = codes, values
 
-def get_events_by_organizer_and_date(organizer_name: str, target_date: date):
-    events = []
-    connection = create_db_connection()
-    if connection is None:
-        return None
 
-    cursor = connection.cursor(dictionary=True)
-    try:
-        select_events_sql = """
-        SELECT
-            title, start_time, type, price, category, difficulty,
-            location_name, location_address, url, `date`, organizer
-        FROM `msk_events`
-        WHERE `date` = %s AND `organizer` = %s
-        ORDER BY `start_time`;
-        """
-        cursor.execute(select_events_sql, (target_date, organizer_name))
-        events = cursor.fetchall()
+facet_codes = FacetCodes()
 
-    except Error as e:
-        logging.error(f"Ошибка выполнения SQL запроса при получении мероприятий по организатору и дате ({organizer_name}, {target_date}): {e}")
-        events = None
-    finally:
-        if cursor: cursor.close()
-        if connection and connection.is_connected():
-            connection.close()
-    return events
 
+# --- Устаревшие данные при недоступной БД ---
 
-def get_distinct_locations():
-    locations = []
-    connection = create_db_connection()
-    if connection is None:
-        return None
+STALE_DATA_NOTE = "⚠️ База данных сейчас недоступна, поэтому показаны сохранённые данные - они могут быть неактуальны."
 
-    cursor = connection.cursor()
-    try:
-        select_locations_sql = """
-        SELECT DISTINCT `location_name`
-        FROM `msk_events`
-        WHERE `date` >= CURDATE() AND `location_name` IS NOT NULL AND `location_name` != ''
-        ORDER BY `location_name`;
-        """
-        cursor.execute(select_locations_sql)
-        locations_raw = cursor.fetchall()
-        locations = [loc[0] for loc in locations_raw]
+# Отдали ли в текущем обновлении данные, которые могут быть устаревшими (ставят функции get_*)
+stale_data: contextvars.ContextVar[bool] = contextvars.ContextVar('stale_data', default=False)
 
-    except Error as e:
-        logging.error(f"Ошибка выполнения SQL запроса при получении уникальных названий мест: {e}")
-        locations = None
-    finally:
-        if cursor: cursor.close()
-        if connection and connection.is_connected():
-            connection.close()
-    return locations
+stale_results = metrics.counter(
+    "msk_bot_stale_results_total",
+    "Выборки, отданные из сохранённого при недоступной БД: последний удачный результат (last_good) или снимок (snapshot).",
+    ("source",))
 
 
-def get_distinct_dates_by_location(location_name: str):
-    dates = []
-    connection = create_db_connection()
-    if connection is None:
-        return None
+def mark_stale_data(source: str) -> None:
+    stale_data.set(True)
+    stale_results.inc(source=source)
 
-    cursor = connection.cursor()
-    try:
-        select_dates_sql = """
-        SELECT DISTINCT `date`
-        FROM `msk_events`
-        WHERE `date` >= CURDATE() AND `location_name` = %s
-        ORDER BY `date`
-        LIMIT 30;
-        """
-        cursor.execute(select_dates_sql, (location_name,))
-        dates_raw = cursor.fetchall()
-        dates = [d[0] for d in dates_raw]
 
-    except Error as e:
-        logging.error(f"Ошибка выполнения SQL запроса при получении дат по месту ({location_name}): {e}")
-        dates = None
-    finally:
-        if cursor: cursor.close()
-        if connection and connection.is_connected():
-            connection.close()
-    return dates
+class StaleDataNoteMiddleware(BaseMiddleware):
+    """После хэндлера, отдавшего возможно устаревшие данные, отправляет пользователю STALE_DATA_NOTE."""
 
+    async def __call__(self, handler, event, data):
+        token = stale_data.set(False)
+        try:
+            result = await handler(event, data)
+            if stale_data.get():
+                message = event if isinstance(event, types.Message) else event.message
+                if message is not None:
+                    try:
+                        await message.answer(STALE_DATA_NOTE)
+                    except Exception as e:
+                        logging.warning(f"Не удалось отправить пометку об устаревших данных: {e}")
+            return result
+        finally:
+            stale_data.reset(token)
 
-def get_events_by_location_and_date(location_name: str, target_date: date):
-    events = []
-    connection = create_db_connection()
-    if connection is None:
-        return None
 
-    cursor = connection.cursor(dictionary=True)
-    try:
-        select_events_sql = """
-        SELECT
-            title, start_time, type, price, category, difficulty,
-            location_name, location_address, url, `date`, organizer
-        FROM `msk_events`
-        WHERE `date` = %s AND `location_name` = %s
-        ORDER BY `start_time`;
+stale_data_note = StaleDataNoteMiddleware()
+dp.message.middleware(stale_data_note)
+dp.callback_query.middleware(stale_data_note)
+
+
+# --- Склейка одинаковых одновременных запросов ---
+
+singleflight_calls = metrics.counter(
+    "msk_bot_singleflight_calls_total",
+    "Выборки из БД: выполненные (leader) и дождавшиеся чужого такого же запроса (coalesced).", ("kind", "role"))
+
+
+class SingleFlight:
+    """
+    Одновременные вызовы с одинаковым ключом ждут один общий результат вместо того,
+    чтобы каждый шёл в БД. Результат не кэшируется: ключ забывается, как только вызов
+    завершился. Исключение получают все ждущие. Вызов идёт отдельной задачей, так что
+    отмена одного из ждущих не отменяет его для остальных.
+    """
+
+    def __init__(self):
+        self._calls: dict[tuple, asyncio.Task] = {}
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._calls)
+
+    def _forget(self, key: tuple, task: asyncio.Task) -> None:
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            task.exception()  # Ошибку уже получили ждущие; если их не осталось - не пишем "never retrieved"
+
+    async def do(self, key: tuple, call, kind: str = ""):
+        task = self._calls.get(key)
+        if task is not None:
+            singleflight_calls.inc(kind=kind, role="coalesced")
+        else:
+            singleflight_calls.inc(kind=kind, role="leader")
+            task = asyncio.ensure_future(call())
+            self._calls[key] = task
+            task.add_done_callback(functools.partial(self._forget, key))
+        return await asyncio.shield(task)
+
+
+# --- Фасетные запросы к msk_events ---
+
+@dataclass(frozen=True)
+class FacetFilter:
+    """
+    Что выбирать из msk_events: точные значения колонок фильтров (только из FACET_COLUMNS)
+    и дата - конкретная (on_date) или диапазон date_from..date_to включительно.
+    Незаданные части не фильтруют. Создаётся через FacetFilter.of(...).
+    """
+    values: tuple = ()  # ((колонка, значение), ...) в порядке FACET_COLUMNS
+    on_date: date | None = None
+    date_from: date | None = None
+    date_to: date | None = None
+
+    @classmethod
+    def of(cls, on_date: date | None = None, date_from: date | None = None, date_to: date | None = None,
+           **values: str) -> 'FacetFilter':
+        unknown = set(values) - set(FACET_COLUMNS)
+        if unknown:
+            raise ValueError(f"Фильтр по колонкам {', '.join(sorted(unknown))} не поддерживается")
+        ordered = tuple((column, values[column]) for column in FACET_COLUMNS if column in values)
+        return cls(ordered, on_date, date_from, date_to)
+
+    def shape(self) -> tuple:
+        """Всё, от чего зависит текст SQL (но не значения параметров)."""
+        return (tuple(column for column, _ in self.values),
+                self.on_date is not None, self.date_from is not None, self.date_to is not None)
+
+    def params(self) -> tuple:
+        dates = tuple(value for value in (self.on_date, self.date_from, self.date_to) if value is not None)
+        return dates + tuple(value for _, value in self.values)
+
+
+class FacetQueryEngine:
+    """
+    Строит SQL для трёх видов выборок по FacetFilter и выполняет его через
+    db_pool.fetch_prepared:
+      events - мероприятия (по дате и времени начала);
+      dates  - различные даты (не больше limit);
+      values - различные непустые значения колонки фильтра (для списка кнопок);
+      watermarks - водяной знак каждой даты: число мероприятий и контрольная сумма их полей.
+    Колонки берутся только из белого списка FACET_COLUMNS, значения идут параметрами.
+    Текст SQL кэшируется по форме фильтра: одной форме - один объект строки,
+    поэтому prepared statement на соединении готовится один раз.
+    Одинаковые одновременные выборки (тот же SQL и параметры) склеиваются в одну.
+    Последние удачные результаты (не больше last_good_max_size) запоминаются: если
+    БД недоступна, выборка отдаёт сохранённый результат и помечает данные устаревшими.
+    Загрузки снимка (allow_stale=False) так не подменяются, иначе сбой выглядел бы как «без изменений».
+    """
+
+    def __init__(self, last_good_max_size: int):
+        self.single_flight = SingleFlight()
+        self.last_good_max_size = last_good_max_size
+        self._last_good: OrderedDict[tuple, list] = OrderedDict()
+
+    KINDS = ('events', 'dates', 'values', 'watermarks')
+
+    # BIT_XOR не зависит от порядка строк: сумма меняется только вместе с данными даты
+    CHECKSUM_SQL = "BIT_XOR(CRC32(CONCAT_WS('|', {})))".format(
+        ", ".join(f"IFNULL(`{column}`, '')" for column in EVENT_CHECKSUM_COLUMNS))
+
+    @staticmethod
+    @functools.lru_cache(maxsize=256)
+    def sql(kind: str, shape: tuple, column: str | None = None, limit: int | None = None) -> str:
+        if kind not in FacetQueryEngine.KINDS:
+            raise ValueError(f"Неизвестный вид выборки {kind!r}")
+        filter_columns, has_date, has_from, has_to = shape
+        conditions = []
+        if has_date:
+            conditions.append("`date` = %s")
+        if has_from:
+            conditions.append("`date` >= %s")
+        if has_to:
+            conditions.append("`date` <= %s")
+        conditions += [f"`{filter_column}` = %s" for filter_column in filter_columns]
+
+        group_sql = ""
+        if kind == 'events':
+            select, order = f"SELECT{EVENT_COLUMNS_SQL}", "`date`, `start_time`"
+        elif kind == 'dates':
+            select, order = "SELECT DISTINCT `date`", "`date`"
+        elif kind == 'watermarks':
+            select, order = f"SELECT `date`, COUNT(*), {FacetQueryEngine.CHECKSUM_SQL}", "`date`"
+            group_sql = "\n        GROUP BY `date`"
+        else:
+            if column not in FACET_COLUMNS:
+                raise ValueError(f"Список значений колонки {column!r} не поддерживается")
+            select, order = f"SELECT DISTINCT `{column}`", f"`{column}`"
+            conditions += [f"`{column}` IS NOT NULL", f"`{column}` != ''"]
+
+        where = f"\n        WHERE {' AND '.join(conditions)}" if conditions else ""
+        limit_sql = f"\n        LIMIT {int(limit)}" if limit is not None else ""
+        # Без ';' в конце: текст уходит на сервер как prepared statement
+        return f"""
+        {select}
+        FROM `msk_events`{where}{group_sql}
+        ORDER BY {order}{limit_sql}
         """
-        cursor.execute(select_events_sql, (target_date, location_name))
-        events = cursor.fetchall()
 
+    def statement(self, kind: str, spec: FacetFilter, column: str | None = None,
+                  limit: int | None = None) -> tuple[str, tuple]:
+        return self.sql(kind, spec.shape(), column, limit), spec.params()
+
+    async def _fetch(self, kind: str, sql: str, params: tuple, dictionary: bool = False,
+                     allow_stale: bool = True) -> list:
+        key = (sql, params, dictionary)
+        try:
+            rows = await self.single_flight.do(
+                key, lambda: db_pool.fetch_prepared(sql, params, dictionary=dictionary), kind)
+        except Error as e:
+            rows = self._last_good.get(key) if allow_stale else None
+            if rows is None:
+                raise
+            logging.warning(f"Ошибка БД ({e}), отдаю последний удачный результат выборки {kind}.")
+            mark_stale_data("last_good")
+            return list(rows)
+        if allow_stale:
+            self._last_good[key] = rows
+            self._last_good.move_to_end(key)
+            if len(self._last_good) > self.last_good_max_size:
+                self._last_good.popitem(last=False)
+        # Строки общие для всех склеенных вызовов, поэтому каждый получает свой список
+        return list(rows)
+
+    async def events(self, spec: FacetFilter, allow_stale: bool = True) -> list[dict]:
+        sql, params = self.statement('events', spec)
+        return await self._fetch('events', sql, params, dictionary=True, allow_stale=allow_stale)
+
+    async def dates(self, spec: FacetFilter, limit: int = DATES_LIMIT) -> list[date]:
+        sql, params = self.statement('dates', spec, limit=limit)
+        return [row[0] for row in await self._fetch('dates', sql, params)]
+
+    async def values(self, column: str, spec: FacetFilter) -> list[str]:
+        sql, params = self.statement('values', spec, column)
+        return [row[0] for row in await self._fetch('values', sql, params)]
+
+    async def watermarks(self, spec: FacetFilter) -> dict[date, tuple[int, int]]:
+        sql, params = self.statement('watermarks', spec)
+        rows = await self._fetch('watermarks', sql, params, allow_stale=False)
+        return {row[0]: (int(row[1]), int(row[2])) for row in rows}
+
+
+facet_queries = FacetQueryEngine(last_good_max_size=DB_LAST_GOOD_MAX_SIZE)
+
+
+# --- Снимок предстоящих мероприятий в памяти ---
+
+snapshot_sync_latency = metrics.histogram(
+    "msk_bot_snapshot_sync_seconds", "Сверка снимка с БД: водяные знаки и перечитывание изменившихся дат.")
+snapshot_changed_dates = metrics.counter(
+    "msk_bot_snapshot_changed_dates_total", "Дат, перечитанных при сверке снимка из-за изменений в БД.")
+
+
+class EventSnapshot:
+    """
+    Все предстоящие мероприятия (`date` >= since) в памяти, сгруппированные по дате.
+    Загружаются одним запросом и перечитываются целиком в фоне раз в ttl секунд;
+    выборки мероприятий по дате и фильтрам отвечаются отсюда без обращения к БД.
+    Между полными загрузками раз в sync_interval секунд сверяются водяные знаки дат
+    (число мероприятий и контрольная сумма полей): перечитываются только изменившиеся
+    даты, индекс фильтров достраивается для затронутых значений.
+    Если очередное обновление не удалось, продолжаем отдавать прежний снимок.
+    Кэши карточек и клавиатур дат не сбрасываются: их ключи - сами данные.
+    """
+
+    def __init__(self, ttl: float, sync_interval: float):
+        self.ttl = ttl
+        self.sync_interval = sync_interval
+        self.since: date | None = None  # С какой даты снимок полон; None - ещё не загружен
+        self.events_by_date: dict[date, list[dict]] = {}
+        self.watermarks: dict[date, tuple[int, int]] = {}  # дата -> (число мероприятий, контрольная сумма)
+        self.index = FacetIndex({})
+        self.loaded_at: float | None = None     # Когда снимок последний раз совпал с БД (полная загрузка или сверка)
+        self.refreshed_at: float | None = None  # Когда снимок последний раз загружался целиком
+        self.on_change: list = []  # Вызываются (без аргументов) после каждой подмены данных снимка
+        self._task: asyncio.Task | None = None
+
+    def covers(self, target_date: date) -> bool:
+        return self.since is not None and target_date >= self.since
+
+    def is_current(self) -> bool:
+        """Снимок загружен сегодня - списки фильтров в нём совпадают с выборкой `date` >= CURDATE()."""
+        return self.since == date.today()
+
+    def events_on(self, target_date: date) -> list[dict]:
+        return self.events_by_date.get(target_date, [])
+
+    def _changed(self) -> None:
+        for callback in self.on_change:
+            try:
+                callback()
+            except Exception as e:
+                logging.error(f"Ошибка обработчика обновления снимка мероприятий: {e}")
+
+    async def refresh(self) -> bool:
+        since = date.today()
+        spec = FacetFilter.of(date_from=since)
+        try:
+            # Водяные знаки до строк: правка между двумя запросами лишь вызовет лишнее перечитывание даты
+            watermarks = await facet_queries.watermarks(spec)
+            rows = await facet_queries.events(spec, allow_stale=False)
+        except Error as e:
+            logging.error(f"Ошибка обновления снимка мероприятий из БД: {e}")
+            return False
+
+        events_by_date: dict[date, list[dict]] = {}
+        for row in rows:
+            events_by_date.setdefault(row['date'], []).append(row)
+        index = FacetIndex(events_by_date)
+        facet_codes.update(index)
+
+        # Подменяем снимок и индекс целиком между двумя await: хэндлеры видят либо старые, либо новые
+        self.events_by_date = events_by_date
+        self.watermarks = watermarks
+        self.index = index
+        self.since = since
+        self.loaded_at = self.refreshed_at = time.monotonic()
+        logging.info(f"Снимок мероприятий обновлён: {len(rows)} мероприятий на {len(events_by_date)} дат.")
+        self._changed()
+        return True
+
+    async def sync(self) -> bool:
+        """Перечитывает только даты, чей водяной знак изменился (и убирает прошедшие)."""
+        if self.since is None:
+            return await self.refresh()
+        started = time.perf_counter()
+        since = date.today()
+        try:
+            watermarks = await facet_queries.watermarks(FacetFilter.of(date_from=since))
+            changed = sorted(
+                event_date for event_date in watermarks.keys() | self.events_by_date.keys()
+                if event_date < since or watermarks.get(event_date) != self.watermarks.get(event_date)
+            )
+            refetch = [event_date for event_date in changed if event_date in watermarks]
+            if len(refetch) > max(1, len(watermarks) // 2):
+                # Импорт переписал большую часть дат - одним запросом дешевле, чем по дате
+                return await self.refresh()
+            fetched = await asyncio.gather(*(facet_queries.events(FacetFilter.of(on_date=event_date), allow_stale=False)
+                                             for event_date in refetch))
+        except Error as e:
+            logging.error(f"Ошибка сверки снимка мероприятий с БД: {e}")
+            return False
+
+        if changed:
+            events_by_date = {event_date: events for event_date, events in self.events_by_date.items()
+                              if event_date not in changed}
+            events_by_date.update((event_date, rows) for event_date, rows in zip(refetch, fetched) if rows)
+            index = self.index.patched(self.events_by_date, events_by_date, changed)
+            facet_codes.update(index)
+
+            self.events_by_date = dict(sorted(events_by_date.items()))
+            self.index = index
+            # Новые и изменённые карточки отрисовываем сразу, а не на первом запросе
+            for rows in fetched:
+                for event in rows:
+                    card_cache.get(event)
+            snapshot_changed_dates.inc(len(changed))
+            logging.info(f"Снимок мероприятий: перечитано дат {len(refetch)}, убрано {len(changed) - len(refetch)}.")
+        self.watermarks = watermarks
+        self.since = since
+        self.loaded_at = time.monotonic()
+        snapshot_sync_latency.observe(time.perf_counter() - started)
+        if changed:
+            self._changed()
+        return True
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    async def _run(self) -> None:
+        if self.loaded_at is not None:  # Первый раз снимок уже загружен при прогреве
+            await asyncio.sleep(self.sync_interval)
+        while True:
+            if self.refreshed_at is None or time.monotonic() - self.refreshed_at >= self.ttl:
+                await self.refresh()
+            else:
+                await self.sync()
+            await asyncio.sleep(self.sync_interval)
+
+
+event_snapshot = EventSnapshot(ttl=EVENT_SNAPSHOT_TTL, sync_interval=EVENT_SNAPSHOT_SYNC_INTERVAL)
+
+
+# Выборки для хэндлеров: из снимка, если он покрывает запрос, иначе через facet_queries.
+# Пока БД недоступна, снимок не обновляется, а вместо ошибки отдаётся сохранённое -
+# такие данные помечаются устаревшими (см. StaleDataNoteMiddleware).
+# Если взять данные неоткуда, возвращают None.
+
+def from_snapshot(result: list) -> list:
+    if not db_breaker.closed:
+        mark_stale_data("snapshot")
+    return result
+
+
+def stale_snapshot_available() -> bool:
+    """Снимок не сегодняшний, но БД недоступна: лучше вчерашние списки, чем ошибка."""
+    if event_snapshot.since is None:
+        return False
+    mark_stale_data("snapshot")
+    return True
+
+
+async def get_facet_values(column: str):
+    if event_snapshot.is_current():
+        return from_snapshot(list(event_snapshot.index.values(column)))
+    try:
+        return await facet_queries.values(column, FacetFilter.of(date_from=date.today()))
     except Error as e:
-        logging.error(f"Ошибка выполнения SQL запроса при получении мероприятий по месту и дате ({location_name}, {target_date}): {e}")
-        events = None
-    finally:
-        if cursor: cursor.close()
-        if connection and connection.is_connected():
-            connection.close()
-    return events
-
-def get_distinct_categories():
-    categories = []
-    connection = create_db_connection()
-    if connection is None:
+        logging.error(f"Ошибка выполнения SQL запроса при получении уникальных значений {column}: {e}")
+        if stale_snapshot_available():
+            return list(event_snapshot.index.values(column))
         return None
 
-    cursor = connection.cursor()
-    try:
-        select_categories_sql = """
-        SELECT DISTINCT `category`
-        FROM `msk_events`
-        WHERE `date` >= CURDATE() AND `category` IS NOT NULL AND `category` != ''
-        ORDER BY `category`;
-        """
-        cursor.execute(select_categories_sql)
-        categories_raw = cursor.fetchall()
-        categories = [cat[0] for cat in categories_raw]
 
+async def get_facet_dates(column: str, value: str):
+    if event_snapshot.is_current():
+        return from_snapshot(list(event_snapshot.index.dates_for(column, value)))
+    try:
+        return await facet_queries.dates(FacetFilter.of(date_from=date.today(), **{column: value}))
     except Error as e:
-        logging.error(f"Ошибка выполнения SQL запроса при получении уникальных категорий: {e}")
-        categories = None
-    finally:
-        if cursor: cursor.close()
-        if connection and connection.is_connected():
-            connection.close()
-    return categories
+        logging.error(f"Ошибка выполнения SQL запроса при получении дат по {column} ({value}): {e}")
+        if stale_snapshot_available():
+            today = date.today()
+            return [event_date for event_date in event_snapshot.index.dates_for(column, value) if event_date >= today]
+        return None
 
 
-def get_distinct_dates_by_category(category_name: str):
-    dates = []
-    connection = create_db_connection()
-    if connection is None:
+async def get_facet_events(column: str, value: str, target_date: date):
+    if event_snapshot.covers(target_date):
+        return from_snapshot(list(event_snapshot.index.events_for(column, value, target_date)))
+    try:
+        return await facet_queries.events(FacetFilter.of(on_date=target_date, **{column: value}))
+    except Error as e:
+        logging.error(f"Ошибка выполнения SQL запроса при получении мероприятий по {column} и дате ({value}, {target_date}): {e}")
         return None
 
-    cursor = connection.cursor()
-    try:
-        select_dates_sql = """
-        SELECT DISTINCT `date`
-        FROM `msk_events`
-        WHERE `date` >= CURDATE() AND `category` = %s
-        ORDER BY `date`
-        LIMIT 30;
-        """
-        cursor.execute(select_dates_sql, (category_name,))
-        dates_raw = cursor.fetchall()
-        dates = [d[0] for d in dates_raw]
 
-    except Error as e:
-        logging.error(f"Ошибка выполнения SQL запроса при получении дат по категории ({category_name}): {e}")
-        dates = None
-    finally:
-        if cursor: cursor.close()
-        if connection and connection.is_connected():
-            connection.close()
-    return dates
+def get_facet_pages(column: str, values: list[str]) -> list[list[str]]:
+    """Страницы для клавиатуры выбора: нарезанные заранее в индексе или, без индекса, на лету."""
+    if event_snapshot.is_current():
+        return event_snapshot.index.pages(column)
+    return paginate(values)
 
 
-def get_events_by_category_and_date(category_name: str, target_date: date):
-    events = []
-    connection = create_db_connection()
-    if connection is None:
+@timed_query
+async def get_events_by_date(target_date: date):
+    if event_snapshot.covers(target_date):
+        return from_snapshot(list(event_snapshot.events_on(target_date)))
+    try:
+        return await facet_queries.events(FacetFilter.of(on_date=target_date))
+    except Error as e:
+        logging.error(f"Ошибка выполнения SQL запроса при получении мероприятий по дате: {e}")
         return None
 
-    cursor = connection.cursor(dictionary=True)
+
+@timed_query
+async def get_distinct_event_dates():
+    if event_snapshot.is_current():
+        return from_snapshot(list(event_snapshot.index.dates))
     try:
-        select_events_sql = """
-        SELECT
-            title, start_time, type, price, category, difficulty,
-            location_name, location_address, url, `date`, organizer
-        FROM `msk_events`
-        WHERE `date` = %s AND `category` = %s
-        ORDER BY `start_time`;
+        return await facet_queries.dates(FacetFilter.of(date_from=date.today()))
+    except Error as e:
+        logging.error(f"Ошибка выполнения SQL запроса при получении уникальных дат: {e}")
+        if stale_snapshot_available():
+            today = date.today()
+            return [event_date for event_date in event_snapshot.index.dates if event_date >= today]
+        return None
+
+
+@timed_query
+async def get_distinct_organizers():
+    return await get_facet_values('organizer')
+
+
+@timed_query
+async def get_distinct_dates_by_organizer(organizer_name: str):
+    return await get_facet_dates('organizer', organizer_name)
+
+
+@timed_query
+async def get_events_by_organizer_and_date(organizer_name: str, target_date: date):
+    return await get_facet_events('organizer', organizer_name, target_date)
+
+
+@timed_query
+async def get_distinct_locations():
+    return await get_facet_values('location_name')
+
+
+@timed_query
+async def get_distinct_dates_by_location(location_name: str):
+    return await get_facet_dates('location_name', location_name)
+
+
+@timed_query
+async def get_events_by_location_and_date(location_name: str, target_date: date):
+    return await get_facet_events('location_name', location_name, target_date)
+
+
+@timed_query
+async def get_distinct_categories():
+    return await get_facet_values('category')
+
+
+@timed_query
+async def get_distinct_dates_by_category(category_name: str):
+    return await get_facet_dates('category', category_name)
+
+
+@timed_query
+async def get_events_by_category_and_date(category_name: str, target_date: date):
+    return await get_facet_events('category', category_name, target_date)
+
+
+# --- Буферизованная запись статистики ---
+
+class StatsWriter:
+    """
+    Копит строки статистики в памяти и пишет их в msk_user_filter_stats пачками
+    (многострочный INSERT через executemany) по достижении batch_size или раз
+    в flush_interval секунд. Буфер ограничен max_size: лишние строки отбрасываются
+    и учитываются в overflow_count, чтобы статистика никогда не тормозила ответы.
+    """
+
+    INSERT_SQL = """
+        INSERT INTO msk_user_filter_stats (user_id, user_name, filter_type, filter_value)
+        VALUES (%s, %s, %s, %s)
         """
-        cursor.execute(select_events_sql, (target_date, category_name))
-        events = cursor.fetchall()
 
-    except Error as e:
-        logging.error(f"Ошибка выполнения SQL запроса при получении мероприятий по категории и дате ({category_name}, {target_date}): {e}")
-        events = None
-    finally:
-        if cursor: cursor.close()
-        if connection and connection.is_connected():
-            connection.close()
-    return events
+    def __init__(self, max_size: int, batch_size: int, flush_interval: float):
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._buffer: deque = deque()
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self.overflow_count = 0  # Строки, не поместившиеся в буфер
+        self.failed_count = 0    # Строки из пачек, которые не удалось записать
+        self.written_count = 0
+
+    @property
+    def pending(self) -> int:
+        return len(self._buffer)
+
+    def add(self, row: tuple) -> None:
+        if len(self._buffer) >= self.max_size:
+            self.overflow_count += 1
+            if self.overflow_count % 1000 == 1:
+                logging.warning(f"Буфер статистики переполнен, отброшено строк: {self.overflow_count}")
+            return
+        self._buffer.append(row)
+        if len(self._buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """
+        Останавливает фоновую запись и дописывает всё, что осталось в буфере.
+        Если БД в этот момент недоступна, оставшиеся строки теряются: они
+        учитываются в failed_count и попадают в лог.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        await self.flush()
+        if self._buffer:
+            self.failed_count += len(self._buffer)
+            logging.error(f"БД недоступна при остановке, статистика не записана ({len(self._buffer)} строк потеряно).")
+            self._buffer.clear()
+
+    async def _run(self) -> None:
+        while True:
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self) -> None:
+        while self._buffer:
+            if not db_breaker.closed:
+                return  # БД недоступна: строки подождут в буфере, а не потеряются
+            batch = [self._buffer.popleft() for _ in range(min(self.batch_size, len(self._buffer)))]
+            try:
+                await db_pool.execute_many(self.INSERT_SQL, batch)
+                self.written_count += len(batch)
+                logging.info(f"Статистика записана: {len(batch)} строк.")
+            except Error as e:
+                self.failed_count += len(batch)
+                logging.error(f"Ошибка при записи статистики в БД ({len(batch)} строк потеряно): {e}")
+
+
+stats_writer = StatsWriter(
+    max_size=STATS_BUFFER_MAX_SIZE,
+    batch_size=STATS_FLUSH_BATCH_SIZE,
+    flush_interval=STATS_FLUSH_INTERVAL,
+)
+
 
 # ОБНОВЛЕНО: Функция для добавления записи о выборе фильтра или команде в таблицу статистики
 def insert_filter_selection(user_id: int, user_name: str | None, interaction_type: str, interaction_value: str):
     """
-    Записывает в таблицу msk_user_filter_stats информацию о действии пользователя.
+    Ставит в очередь на запись в таблицу msk_user_filter_stats информацию о действии пользователя.
+    Возвращается сразу: сама запись выполняется пачками в фоне (см. StatsWriter).
     interaction_type: тип взаимодействия (например, 'command', 'filter_organizer', 'filter_location', 'filter_category').
     interaction_value: значение взаимодействия (например, '/start', '/today', 'Название Организатора', 'Название Бара').
     """
-    connection = create_db_connection()
-    if connection is None:
-        return
-
-    cursor = connection.cursor()
-    try:
-        insert_sql = """
-        INSERT INTO msk_user_filter_stats (user_id, user_name, filter_type, filter_value)
-        VALUES (%s, %s, %s, %s);
-        """
-        cursor.execute(insert_sql, (user_id, user_name, interaction_type, interaction_value))
-        connection.commit()
-        logging.info(f"Статистика записана: user_id={user_id}, user_name='{user_name}', type='{interaction_type}', value='{interaction_value}'")
-
-    except Error as e:
-        logging.error(f"Ошибка при записи статистики в БД: {e}")
-    finally:
-        if cursor: cursor.close()
-        if connection and connection.is_connected():
-            connection.close()
+    stats_writer.add((user_id, user_name, interaction_type, interaction_value))
+    logging.debug(f"Статистика поставлена в очередь: user_id={user_id}, user_name='{user_name}', type='{interaction_type}', value='{interaction_value}'")
 
 
 # --- Вспомогательная функция для HTML-экранирования символов (остается без изменений) ---
@@ -440,196 +1986,1156 @@ def main_reply_keyboard():
     return builder.as_markup(resize_keyboard=True)
 
 
-# Функция для создания Inline клавиатуры со списком Организаторов (без Base64)
-def organizers_inline_keyboard(organizer_list: list[str]):
+# Строка навигации по страницам: « Назад | 2/5 | Вперёд »
+def add_page_navigation(builder: InlineKeyboardBuilder, page: int, pages_count: int, page_prefix: str):
+    if pages_count <= 1:
+        return
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton(text="« Назад", callback_data=f"{page_prefix}:{page - 1}"))
+    buttons.append(InlineKeyboardButton(text=f"{page + 1}/{pages_count}", callback_data="noop"))
+    if page < pages_count - 1:
+        buttons.append(InlineKeyboardButton(text="Вперёд »", callback_data=f"{page_prefix}:{page + 1}"))
+    builder.row(*buttons)
+
+
+# Функция для создания Inline клавиатуры со списком Организаторов (код организатора в callback_data), одна страница
+def organizers_inline_keyboard(organizer_pages: list[list[str]], page: int = 0):
     builder = InlineKeyboardBuilder()
-    if not organizer_list:
+    if not organizer_pages or not organizer_pages[0]:
         return None
+    page = max(0, min(page, len(organizer_pages) - 1))
 
-    for organizer in organizer_list:
-        organizer_escaped_for_callback = organizer.replace(':', '\\:')
-        callback_data = f"select_organizer:{organizer_escaped_for_callback}"
+    for organizer in organizer_pages[page]:
+        callback_data = f"select_organizer:{facet_codes.encode('organizer', organizer)}"
 
         builder.button(text=organizer, callback_data=callback_data)
 
     builder.adjust(2)
+    add_page_navigation(builder, page, len(organizer_pages), "org_page")
     return builder.as_markup()
 
 
-# Функция для создания Inline клавиатуры с датами (для фильтра Организатора, без Base64)
-def dates_inline_keyboard_for_organizer(dates_list: list[date], organizer_name_escaped_for_callback: str):
-    builder = InlineKeyboardBuilder()
-    if not dates_list:
-        return None
-
-    for event_date in dates_list:
-        day = event_date.day
-        month_name = RUSSIAN_MONTH_NAMES_GENITIVE.get(event_date.month, f"Месяц{event_date.month}")
-        weekday_name = RUSSIAN_WEEKDAY_NAMES.get(event_date.weekday(), "День недели")
+# Функция для создания Inline клавиатуры с датами (для фильтра Организатора, с кодом организатора в callback_data)
+def dates_inline_keyboard_for_organizer(dates_list: list[date], organizer_code: str):
+    return date_picker_cache.get('organizer', organizer_code, dates_list)
 
-        button_text = f"{day} {month_name}, {weekday_name}"
 
-        callback_data = f"select_org_date:{organizer_name_escaped_for_callback}:{event_date.strftime('%Y-%m-%d')}"
+# Функция для создания Inline клавиатуры со списком Названий мест (с ID в callback_data), одна страница
+# ID места - его код из facet_codes
+def locations_inline_keyboard_with_ids(location_pages: list[list[str]], page: int = 0):
+    builder = InlineKeyboardBuilder()
+    if not location_pages or not location_pages[0]:
+        return None
+    page = max(0, min(page, len(location_pages) - 1))
 
-        builder.button(text=button_text, callback_data=callback_data)
+    for location_name in location_pages[page]:
+        callback_data = f"select_location_id:{facet_codes.encode('location_name', location_name)}"
+        builder.button(text=location_name, callback_data=callback_data)
 
     builder.adjust(2)
+    add_page_navigation(builder, page, len(location_pages), "loc_page")
     return builder.as_markup()
 
 
-# Функция для создания Inline клавиатуры со списком Названий мест (с ID в callback_data)
-def locations_inline_keyboard_with_ids(location_choices: dict[str, str]):
+# Функция для создания Inline клавиатуры с датами (для фильтра Места, с ID места в callback_data)
+def dates_inline_keyboard_for_location_with_id(dates_list: list[date], location_id: str):
+    return date_picker_cache.get('location', location_id, dates_list)
+
+
+# Функция для создания Inline клавиатуры со списком Категорий (с ID в callback_data), одна страница
+# ID тематики - её код из facet_codes
+def categories_inline_keyboard_with_ids(category_pages: list[list[str]], page: int = 0):
     builder = InlineKeyboardBuilder()
-    if not location_choices:
+    if not category_pages or not category_pages[0]:
         return None
+    page = max(0, min(page, len(category_pages) - 1))
 
-    sorted_locations = sorted(location_choices.items(), key=lambda item: item[1])
-
-    for loc_id, location_name in sorted_locations:
-        callback_data = f"select_location_id:{loc_id}"
-        builder.button(text=location_name, callback_data=callback_data)
+    for category_name in category_pages[page]:
+        callback_data = f"select_category_id:{facet_codes.encode('category', category_name)}"
+        builder.button(text=category_name, callback_data=callback_data)
 
     builder.adjust(2)
+    add_page_navigation(builder, page, len(category_pages), "cat_page")
     return builder.as_markup()
 
 
-# Функция для создания Inline клавиатуры с датами (для фильтра Места, с ID места в callback_data)
-def dates_inline_keyboard_for_location_with_id(dates_list: list[date], location_id: str):
-    builder = InlineKeyboardBuilder()
-    if not dates_list:
-        return None
+# Функция для создания Inline клавиатуры с датами (для фильтра Категории, с ID категории в callback_data)
+def dates_inline_keyboard_for_category_with_id(dates_list: list[date], category_id: str):
+    return date_picker_cache.get('category', category_id, dates_list)
 
-    for event_date in dates_list:
-        day = event_date.day
-        month_name = RUSSIAN_MONTH_NAMES_GENITIVE.get(event_date.month, f"Месяц{event_date.month}")
-        weekday_name = RUSSIAN_WEEKDAY_NAMES.get(event_date.weekday(), "День недели")
 
-        button_text = f"{day} {month_name}, {weekday_name}"
+# Функция для создания Inline клавиатуры с датами (оригинальная, для /by_date из меню)
+def dates_inline_keyboard(dates_list: list[date]):
+    return date_picker_cache.get('by_date', '', dates_list)
 
-        callback_data = f"select_loc_date_id:{location_id}:{event_date.strftime('%Y-%m-%d')}"
 
-        builder.button(text=button_text, callback_data=callback_data)
+# --- Кэш клавиатур выбора даты ---
 
-    builder.adjust(2)
-    return builder.as_markup()
+# Начало callback_data кнопки даты для каждого вида выбора; дальше идёт дата в формате YYYY-MM-DD
+DATE_PICKER_CALLBACK_PREFIXES = {
+    'by_date': "date:",
+    'organizer': "select_org_date:{filter_id}:",
+    'location': "select_loc_date_id:{filter_id}:",
+    'category': "select_cat_date_id:{filter_id}:",
+}
 
+# Вид клавиатуры выбора даты -> колонка фильтра; под такой клавиатурой есть кнопка подписки
+DATE_PICKER_FACETS = {'organizer': 'organizer', 'location': 'location_name', 'category': 'category'}
 
-# Функция для создания Inline клавиатуры со списком Категорий (с ID в callback_data)
-def categories_inline_keyboard_with_ids(category_choices: dict[str, str]):
-    builder = InlineKeyboardBuilder()
-    if not category_choices:
-        return None
 
-    sorted_categories = sorted(category_choices.items(), key=lambda item: item[1])
+@functools.lru_cache(maxsize=1024)
+def date_button_label(event_date: date) -> str:
+    day = event_date.day
+    month_name = RUSSIAN_MONTH_NAMES_GENITIVE.get(event_date.month, f"Месяц{event_date.month}")
+    weekday_name = RUSSIAN_WEEKDAY_NAMES.get(event_date.weekday(), "День недели")
+    return f"{day} {month_name}, {weekday_name}"
 
-    for cat_id, category_name in sorted_categories:
-        callback_data = f"select_category_id:{cat_id}"
-        builder.button(text=category_name, callback_data=callback_data)
+
+def build_dates_keyboard(dates_list: list[date], callback_prefix: str, subscribe_data: str | None = None):
+    builder = InlineKeyboardBuilder()
+    for event_date in dates_list:
+        builder.button(text=date_button_label(event_date), callback_data=f"{callback_prefix}{event_date.isoformat()}")
 
     builder.adjust(2)
+    if subscribe_data is not None:
+        builder.row(InlineKeyboardButton(text="🔔 Подписаться", callback_data=subscribe_data))
     return builder.as_markup()
 
 
-# Функция для создания Inline клавиатуры с датами (для фильтра Категории, с ID категории в callback_data)
-def dates_inline_keyboard_for_category_with_id(dates_list: list[date], category_id: str):
-    builder = InlineKeyboardBuilder()
-    if not dates_list:
-        return None
+class DatePickerCache:
+    """
+    LRU-кэш готовых клавиатур выбора даты по ключу (вид фильтра, id фильтра, список дат).
+    InlineKeyboardMarkup в aiogram неизменяемый, поэтому одну разметку можно отдавать всем.
+    Список дат входит в ключ, поэтому после обновления снимка изменившийся набор дат
+    получает новую запись, а прежние вытесняются по LRU; целиком кэш сбрасывается
+    только при смене дня.
+    """
 
-    for event_date in dates_list:
-        day = event_date.day
-        month_name = RUSSIAN_MONTH_NAMES_GENITIVE.get(event_date.month, f"Месяц{event_date.month}")
-        weekday_name = RUSSIAN_WEEKDAY_NAMES.get(event_date.weekday(), "День недели")
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._markups: OrderedDict[tuple, object] = OrderedDict()
+        self._day = date.today()
+        self.hits = 0
+        self.misses = 0
 
-        button_text = f"{day} {month_name}, {weekday_name}"
+    def get(self, kind: str, filter_id: str, dates_list: list[date]):
+        if not dates_list:
+            return None
+        today = date.today()
+        if today != self._day:
+            self.clear()
+            self._day = today
 
-        callback_data = f"select_cat_date_id:{category_id}:{event_date.strftime('%Y-%m-%d')}"
+        key = (kind, filter_id, tuple(dates_list))
+        markup = self._markups.get(key)
+        if markup is not None:
+            self._markups.move_to_end(key)
+            self.hits += 1
+            return markup
 
-        builder.button(text=button_text, callback_data=callback_data)
+        self.misses += 1
+        callback_prefix = DATE_PICKER_CALLBACK_PREFIXES[kind].format(filter_id=filter_id)
+        subscribe_data = f"sub_add:{kind}:{filter_id}" if kind in DATE_PICKER_FACETS else None
+        markup = build_dates_keyboard(dates_list, callback_prefix, subscribe_data)
+        self._markups[key] = markup
+        if len(self._markups) > self.max_size:
+            self._markups.popitem(last=False)
+        return markup
 
-    builder.adjust(2)
-    return builder.as_markup()
+    def clear(self) -> None:
+        self._markups.clear()
 
 
-# Функция для создания Inline клавиатуры с датами (оригинальная, для /by_date из меню)
-def dates_inline_keyboard(dates_list: list[date]):
-    builder = InlineKeyboardBuilder()
-    if not dates_list:
-        return None
+date_picker_cache = DatePickerCache(max_size=DATE_PICKER_CACHE_MAX_SIZE)
 
-    for event_date in dates_list:
-        day = event_date.day
-        month_name = RUSSIAN_MONTH_NAMES_GENITIVE.get(event_date.month, f"Месяц{event_date.month}")
-        weekday_name = RUSSIAN_WEEKDAY_NAMES.get(event_date.weekday(), "День недели")
 
-        button_text = f"{day} {month_name}, {weekday_name}"
+# --- Кэш отрисованных карточек мероприятий ---
 
-        callback_data = f"date:{event_date.strftime('%Y-%m-%d')}"
+URL_RE = re.compile(r'https?://\S+')
 
-        builder.button(text=button_text, callback_data=callback_data)
+CARD_FIELDS = (
+    'date', 'organizer', 'title', 'location_name', 'start_time', 'type',
+    'price', 'category', 'difficulty', 'location_address', 'url',
+)
 
-    builder.adjust(2)
-    return builder.as_markup()
+
+class CardCache:
+    """
+    LRU-кэш HTML-текстов карточек. Ключ - значения всех полей карточки, так что
+    изменённое в БД мероприятие получает новую запись, а устаревшая вытесняется
+    по LRU; при обновлении снимка кэш не сбрасывается. Счётчики hits/misses
+    показывают, сколько отрисовок сэкономлено.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._cards: OrderedDict[tuple, str] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, event: dict) -> str:
+        key = tuple(event.get(field) for field in CARD_FIELDS)
+        card = self._cards.get(key)
+        if card is not None:
+            self._cards.move_to_end(key)
+            self.hits += 1
+            return card
+
+        self.misses += 1
+        card = render_event_card(event)
+        self._cards[key] = card
+        if len(self._cards) > self.max_size:
+            self._cards.popitem(last=False)
+        return card
+
+    def clear(self) -> None:
+        self._cards.clear()
+
+
+def render_event_card(event: dict) -> str:
+    """
+    Форматирует данные одного мероприятия с использованием HTML.
+    """
+    event_date_str = event.get('date').strftime('%d.%m.%Y') if isinstance(event.get('date'), date) else 'Не указана'
+
+    organizer_html = escape_html(event.get('organizer', 'Не указан'))
+    title_html = escape_html(event.get('title', 'Без названия'))
+    location_name_html = escape_html(event.get('location_name', 'Не указано'))
+
+    start_time_html = escape_html(event.get('start_time', 'Не указано'))
+    event_type_html = escape_html(event.get('type', 'Не указан'))
+    price_html = escape_html(event.get('price', 'Не указана'))
+    category_html = escape_html(event.get('category', 'Не указана'))
+    difficulty_html = escape_html(event.get('difficulty', 'Не указана'))
+    location_address_html = escape_html(event.get('location_address', 'Не указан'))
+    event_date_str_html = escape_html(event_date_str)
+
+    url_raw = event.get('url')
+    url_line = f"🔗 Подробнее: Нет ссылки"
+
+    if url_raw and isinstance(url_raw, str) and url_raw.strip():
+        link_text_html = escape_html("Перейти")
+        if URL_RE.match(url_raw.strip()):
+            url_line = f"🔗 Подробнее: <a href=\"{url_raw.strip()}\">{link_text_html}</a>"
+        else:
+            logging.warning(f"URL '{url_raw}' не подходит для прямого форматирования ссылки. Вывожу как текст.")
+            url_line = f"🔗 Подробнее: {escape_html(url_raw)}"
+
+    return (
+        f"<b>{organizer_html}</b>\n\n"
+        f"📅 Дата: {event_date_str_html}\n"
+        f"📚 Название: <b>{title_html}</b>\n"
+        f"⏰ Время: {start_time_html}\n"
+        f"🏷️ Тип: {event_type_html}\n"
+        f"💰 Цена: {price_html}\n"
+        f"🗂️ Категория: {category_html}\n"
+        f"💪 Сложность: {difficulty_html}\n"
+        f"📍 Место: <b>{location_name_html}</b>\n"
+        f"🗺️ Адрес: {location_address_html}\n"
+        f"{url_line}\n"
+    )
+
+
+card_cache = CardCache(max_size=CARD_CACHE_MAX_SIZE)
+
+
+# --- Планировщик исходящих сообщений (лимиты Telegram) ---
+
+class TokenBucket:
+    """Ведро токенов: не больше rate отправок в секунду со всплеском до capacity."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0  # До этого момента отправка запрещена (после TelegramRetryAfter)
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Через сколько секунд появится токен (0 - можно отправлять сейчас)."""
+        self._refill(now)
+        token_delay = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(token_delay, self.blocked_until - now)
+
+    def take(self, now: float) -> None:
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity and now >= self.blocked_until
+
+
+class SendScheduler(BaseRequestMiddleware):
+    """
+    Middleware сессии бота: каждый запрос к Telegram с chat_id (answer, edit_text и т.д.)
+    ждёт своей очереди. Разрешения выдаются по кругу между чатами (честная очередь),
+    с учётом общего ведра токенов на бота и отдельного ведра на каждый чат.
+    На TelegramRetryAfter чат ставится на паузу на указанное время и запрос повторяется.
+    Запросы без chat_id (answerCallbackQuery, setMyCommands) идут без очереди.
+    """
+
+    def __init__(self, global_rate: float, global_burst: float, chat_rate: float,
+                 group_chat_rate: float, chat_burst: float, max_retries: int):
+        self.chat_rate = chat_rate
+        self.group_chat_rate = group_chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_burst)
+        self._chat_buckets: dict[int | str, TokenBucket] = {}
+        self._queues: dict[int | str, deque] = {}  # chat_id -> ожидающие отправки (Future)
+        self._ready_chats: deque = deque()        # Круговая очередь чатов, у которых есть ожидающие
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self.sent_count = 0
+        self.retry_after_count = 0
+        self.peak_queue_depth = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    @property
+    def waiting_chats(self) -> int:
+        return len(self._queues)
+
+    async def __call__(self, make_request, bot: Bot, method):
+        chat_id = getattr(method, 'chat_id', None)
+        if chat_id is None:
+            return await make_request(bot, method)
+
+        for attempt in range(self.max_retries + 1):
+            await self._wait_turn(chat_id)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                self.retry_after_count += 1
+                if attempt == self.max_retries:
+                    raise
+                logging.warning(f"Telegram просит подождать {e.retry_after} с перед отправкой в чат {chat_id}, повторяю.")
+                self._chat_bucket(chat_id).blocked_until = time.monotonic() + e.retry_after
+
+    def _chat_bucket(self, chat_id: int | str) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            # Отрицательные id - группы и каналы, для них Telegram разрешает меньше
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            bucket = TokenBucket(self.group_chat_rate if is_group else self.chat_rate, self.chat_burst)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def _wait_turn(self, chat_id: int | str) -> None:
+        future = asyncio.get_running_loop().create_future()
+        queue = self._queues.get(chat_id)
+        if queue is None:
+            queue = self._queues[chat_id] = deque()
+            self._ready_chats.append(chat_id)
+        queue.append(future)
+        self.peak_queue_depth = max(self.peak_queue_depth, self.queue_depth)
+
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        self._wakeup.set()
+        await future  # При отмене Future отменяется и пропускается планировщиком
+
+    def _dispatch(self) -> float | None:
+        """
+        Один круг по чатам с ожидающими отправками: каждому чату, у которого есть токен,
+        выдаётся одно разрешение. Возвращает, через сколько секунд повторить (None - очередь пуста).
+        """
+        next_try = None
+        for _ in range(len(self._ready_chats)):
+            now = time.monotonic()
+            global_delay = self._global.delay(now)
+            if global_delay > 0:
+                return global_delay
+
+            chat_id = self._ready_chats.popleft()
+            queue = self._queues[chat_id]
+            while queue and queue[0].done():
+                queue.popleft()
+            if not queue:
+                del self._queues[chat_id]
+                continue
+
+            bucket = self._chat_bucket(chat_id)
+            chat_delay = bucket.delay(now)
+            if chat_delay > 0:
+                self._ready_chats.append(chat_id)
+                next_try = chat_delay if next_try is None else min(next_try, chat_delay)
+                continue
+
+            bucket.take(now)
+            self._global.take(now)
+            queue.popleft().set_result(None)
+            self.sent_count += 1
+            if queue:
+                self._ready_chats.append(chat_id)
+            else:
+                del self._queues[chat_id]
+            next_try = 0.0
+        return next_try
+
+    def _prune_buckets(self) -> None:
+        now = time.monotonic()
+        for chat_id in [c for c, b in self._chat_buckets.items() if c not in self._queues and b.is_idle(now)]:
+            del self._chat_buckets[chat_id]
+
+    async def _run(self) -> None:
+        while True:
+            self._wakeup.clear()
+            next_try = self._dispatch()
+            if next_try is None:
+                if len(self._chat_buckets) > 10000:
+                    self._prune_buckets()
+                await self._wakeup.wait()
+            elif next_try == 0:
+                await asyncio.sleep(0)
+            else:
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self._wakeup.wait(), next_try)
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+
+send_scheduler = SendScheduler(
+    global_rate=SEND_GLOBAL_RATE,
+    global_burst=SEND_GLOBAL_BURST,
+    chat_rate=SEND_CHAT_RATE,
+    group_chat_rate=SEND_GROUP_CHAT_RATE,
+    chat_burst=SEND_CHAT_BURST,
+    max_retries=SEND_MAX_RETRIES,
+)
 
 
 # --- Функция для отправки "карточки" мероприятия (с HTML) ---
-async def send_event_card(message: types.Message, event: dict):
+async def send_html_text(message: types.Message, text_html: str):
      """
-     Форматирует данные одного мероприятия с использованием HTML.
+     Отправляет HTML-текст (карточку или дайджест); при ошибке разметки - простым текстом.
      """
-     event_date_str = event.get('date').strftime('%d.%m.%Y') if isinstance(event.get('date'), date) else 'Не указана'
-
-     organizer_html = escape_html(event.get('organizer', 'Не указан'))
-     title_html = escape_html(event.get('title', 'Без названия'))
-     location_name_html = escape_html(event.get('location_name', 'Не указано'))
-
-     start_time_html = escape_html(event.get('start_time', 'Не указано'))
-     event_type_html = escape_html(event.get('type', 'Не указан'))
-     price_html = escape_html(event.get('price', 'Не указана'))
-     category_html = escape_html(event.get('category', 'Не указана'))
-     difficulty_html = escape_html(event.get('difficulty', 'Не указана'))
-     location_address_html = escape_html(event.get('location_address', 'Не указан'))
-     event_date_str_html = escape_html(event_date_str)
-
-     url_raw = event.get('url')
-     url_line = f"🔗 Подробнее: Нет ссылки"
-
-     if url_raw and isinstance(url_raw, str) and url_raw.strip():
-         link_text_html = escape_html("Перейти")
-         if re.match(r'https?://\S+', url_raw.strip()):
-              url_line = f"🔗 Подробнее: <a href=\"{url_raw.strip()}\">{link_text_html}</a>"
-         else:
-              logging.warning(f"URL '{url_raw}' не подходит для прямого форматирования ссылки. Вывожу как текст.")
-              url_line = f"🔗 Подробнее: {escape_html(url_raw)}"
-
-     card_text_html = (
-         f"<b>{organizer_html}</b>\n\n"
-         f"📅 Дата: {event_date_str_html}\n"
-         f"📚 Название: <b>{title_html}</b>\n"
-         f"⏰ Время: {start_time_html}\n"
-         f"🏷️ Тип: {event_type_html}\n"
-         f"💰 Цена: {price_html}\n"
-         f"🗂️ Категория: {category_html}\n"
-         f"💪 Сложность: {difficulty_html}\n"
-         f"📍 Место: <b>{location_name_html}</b>\n"
-         f"🗺️ Адрес: {location_address_html}\n"
-         f"{url_line}\n"
-     )
-
      try:
-         await message.answer(card_text_html, parse_mode="HTML")
+         await message.answer(text_html, parse_mode="HTML")
          logging.info("Сообщение с карточкой отправлено в режиме HTML.")
      except Exception as e:
          logging.error(f"Ошибка отправки сообщения с карточкой мероприятия в режиме HTML: {e}")
-         logging.error(f"Проблемный текст сообщения (HTML):\n{card_text_html}")
+         logging.error(f"Проблемный текст сообщения (HTML):\n{text_html}")
          try:
-             await message.answer(f"Не удалось отформатировать информацию о мероприятии:\n{card_text_html}", parse_mode=None)
+             await message.answer(f"Не удалось отформатировать информацию о мероприятии:\n{text_html}", parse_mode=None)
              logging.info("Отправлен простой текст сообщения (с HTML тегами) после ошибки форматирования.")
          except Exception as e_plain:
               logging.error(f"Не удалось отправить сообщение с карточкой даже как простой текст: {e_plain}")
               await message.answer("Не удалось отправить информацию о мероприятии.")
 
-     await asyncio.sleep(0.2)
+
+async def send_event_card(message: types.Message, event: dict):
+     """
+     Отправляет карточку мероприятия (HTML берётся из card_cache).
+     """
+     await send_html_text(message, card_cache.get(event))
+     event_cards_sent.inc(mode="card")
+
+
+# --- Дайджест: несколько карточек в одном сообщении ---
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+DIGEST_CARD_SEPARATOR = "\n"
+
+DIGEST_ARGS = {
+    'on': True, 'вкл': True, 'дайджест': True, 'digest': True,
+    'off': False, 'выкл': False, 'карточки': False, 'cards': False,
+}
+
+
+def telegram_text_length(text: str) -> int:
+    # Telegram считает длину сообщения в UTF-16 единицах (эмодзи занимают две)
+    return len(text.encode('utf-16-le')) // 2
+
+
+def pack_cards_into_messages(cards: list[str], limit: int = TELEGRAM_MESSAGE_LIMIT) -> list[str]:
+    """
+    Склеивает карточки в как можно меньшее число сообщений не длиннее limit.
+    Режет только по границам карточек; карточка длиннее limit уходит отдельным сообщением.
+    """
+    messages = []
+    current, current_length = [], 0
+    separator_length = telegram_text_length(DIGEST_CARD_SEPARATOR)
+    for card in cards:
+        card_length = telegram_text_length(card)
+        added_length = card_length + (separator_length if current else 0)
+        if current and current_length + added_length > limit:
+            messages.append(DIGEST_CARD_SEPARATOR.join(current))
+            current, current_length = [], 0
+            added_length = card_length
+        current.append(card)
+        current_length += added_length
+    if current:
+        messages.append(DIGEST_CARD_SEPARATOR.join(current))
+    return messages
+
+
+def parse_digest_arg(args: str | None) -> bool | None:
+    if not args:
+        return None
+    return DIGEST_ARGS.get(args.strip().lower())
+
+
+class DigestPreferences:
+    """
+    Личный выбор режима пользователями (/digest), сохранённый в msk_user_settings.
+    Прочитанное из БД, в том числе «выбора нет», держится в LRU-кэше на max_size
+    пользователей: БД спрашивается один раз на пользователя, а память не растёт.
+    Пока БД недоступна, у кого выбор не прочитан, действует DIGEST_MODE_DEFAULT.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._enabled: OrderedDict[int, bool | None] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _remember(self, user_id: int, enabled: bool | None) -> None:
+        self._enabled[user_id] = enabled
+        self._enabled.move_to_end(user_id)
+        if len(self._enabled) > self.max_size:
+            self._enabled.popitem(last=False)
+
+    async def get(self, user_id: int) -> bool | None:
+        """Выбор пользователя; None - не выбирал (или БД недоступна)."""
+        if user_id in self._enabled:
+            self._enabled.move_to_end(user_id)
+            self.hits += 1
+            return self._enabled[user_id]
+        self.misses += 1
+        try:
+            rows = await db_pool.fetch_all("SELECT digest FROM msk_user_settings WHERE user_id = %s", (user_id,))
+        except Error as e:
+            logging.error(f"Ошибка при получении режима дайджеста пользователя {user_id}: {e}")
+            return None
+        enabled = bool(rows[0][0]) if rows else None
+        self._remember(user_id, enabled)
+        return enabled
+
+    async def set(self, user_id: int, enabled: bool) -> bool:
+        try:
+            await db_pool.execute(
+                "INSERT INTO msk_user_settings (user_id, digest) VALUES (%s, %s) "
+                "ON DUPLICATE KEY UPDATE digest = VALUES(digest)",
+                (user_id, enabled))
+        except Error as e:
+            logging.error(f"Ошибка при сохранении режима дайджеста пользователя {user_id}: {e}")
+            return False
+        self._remember(user_id, enabled)
+        return True
+
+
+digest_preferences = DigestPreferences(max_size=DIGEST_PREFERENCES_CACHE_MAX_SIZE)
+
+
+async def digest_enabled(user_id: int, override: bool | None = None) -> bool:
+    if override is not None:
+        return override
+    enabled = await digest_preferences.get(user_id)
+    return DIGEST_MODE_DEFAULT if enabled is None else enabled
+
+
+async def send_events(message: types.Message, events: list[dict], user_id: int, digest: bool | None = None):
+    """
+    Отправляет найденные мероприятия: дайджестом (карточки, упакованные в сообщения до 4096 символов)
+    или по одной карточке на сообщение - в зависимости от выбора пользователя или команды.
+    """
+    if await digest_enabled(user_id, digest):
+        cards = [card_cache.get(event) for event in events]
+        for text_html in pack_cards_into_messages(cards):
+            await send_html_text(message, text_html)
+        event_cards_sent.inc(len(cards), mode="digest")
+    else:
+        for event in events:
+            await send_event_card(message, event)
+
+
+# --- Планировщик фоновых задач ---
+
+def is_db_outage(error: BaseException) -> bool:
+    """Ошибка из-за недоступной БД (обрыв связи или разомкнутый breaker), а не из-за запроса или кода."""
+    return isinstance(error, DbPool.OUTAGE_ERRORS) or (isinstance(error, Error) and not db_breaker.closed)
+
+
+@dataclass(eq=False)
+class Job:
+    name: str
+    action: object                          # async () -> None
+    daily_at: tuple[int, int] | None = None  # (часы, минуты) в часовом поясе планировщика
+    interval: float | None = None           # Или раз в столько секунд
+    retry_after: float | None = None        # Повторять после ошибки, а не ждать расписания; пока БД недоступна - раз в столько секунд
+    wakeup: asyncio.Event = field(default_factory=asyncio.Event)
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+    last_run_at: float | None = None        # Время начала последнего запуска (unix)
+    last_duration: float | None = None
+    succeeded: int = 0
+    failed: int = 0
+    failures: int = 0                       # Ошибок подряд
+
+
+class JobScheduler:
+    """
+    Фоновые задачи внутри процесса: ежедневно в заданное время (в часовом поясе tz),
+    раз в interval секунд и вне расписания по trigger(). Запуски одной задачи не
+    пересекаются; trigger во время выполнения даёт ещё один запуск сразу после него.
+    Ошибка задачи пишется в лог и не мешает следующим запускам. Задача с retry_after
+    после ошибки повторяется вне расписания: пока БД недоступна (is_db_outage) - каждые
+    retry_after секунд, до восстановления, с одной записью в логе на весь сбой; после
+    прочих ошибок (баг, нет таблицы) - не больше max_retries раз с паузой от retry_backoff
+    секунд, удваивающейся с каждым повтором, а дальше - по расписанию.
+    """
+
+    def __init__(self, tz: ZoneInfo, retry_backoff: float, max_retries: int):
+        self.tz = tz
+        self.retry_backoff = retry_backoff
+        self.max_retries = max_retries
+        self.jobs: dict[str, Job] = {}
+        self._tasks: list[asyncio.Task] = []
+
+    def add(self, name: str, action, daily_at: tuple[int, int] | None = None,
+            interval: float | None = None, retry_after: float | None = None) -> Job:
+        job = self.jobs[name] = Job(name, action, daily_at, interval, retry_after)
+        return job
+
+    def trigger(self, name: str) -> None:
+        self.jobs[name].wakeup.set()
+
+    def today(self) -> date:
+        """Сегодняшняя дата в часовом поясе расписания (может не совпадать с date.today() сервера)."""
+        return datetime.now(self.tz).date()
+
+    def _next_delay(self, job: Job) -> float | None:
+        if job.daily_at is not None:
+            now = datetime.now(self.tz)
+            hour, minute = job.daily_at
+            run_at = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+            if run_at <= now:
+                run_at += timedelta(days=1)
+            return (run_at - now).total_seconds()
+        return job.interval  # None - только по trigger
+
+    async def run_now(self, name: str) -> Exception | None:
+        """
+        Выполняет задачу сейчас (ожидающий trigger этим запуском считается выполненным).
+        Возвращает ошибку задачи или None.
+        """
+        job = self.jobs[name]
+        error = None
+        async with job.lock:
+            job.wakeup.clear()
+            job.last_run_at = time.time()
+            started = time.perf_counter()
+            try:
+                await job.action()
+                job.succeeded += 1
+            except Exception as e:
+                job.failed += 1
+                error = e
+            job.last_duration = time.perf_counter() - started
+            job.failures = job.failures + 1 if error is not None else 0
+        if error is None:
+            logging.info(f"Фоновая задача {name} выполнена за {job.last_duration * 1000:.0f} мс.")
+        elif not is_db_outage(error):
+            logging.error(f"Ошибка фоновой задачи {name}: {error}", exc_info=error)
+        elif job.failures == 1:
+            logging.warning(f"Фоновая задача {name} не выполнена: БД недоступна ({error}). Повторы - без записи в лог.")
+        return error
+
+    async def _run_job(self, job: Job) -> None:
+        delay = self._next_delay(job)
+        retries = 0  # Повторы после ошибок, не связанных с недоступностью БД
+        while True:
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(job.wakeup.wait(), delay)
+            error = await self.run_now(job.name)
+            delay = self._next_delay(job)
+            if error is None or job.retry_after is None:
+                retries = 0
+            elif is_db_outage(error):
+                delay = job.retry_after
+            elif retries < self.max_retries:
+                delay = self.retry_backoff * 2 ** retries
+                retries += 1
+                logging.info(f"Фоновая задача {job.name} будет повторена через {delay:.0f} с "
+                             f"(повтор {retries} из {self.max_retries}).")
+            else:
+                retries = 0
+                logging.warning(f"Фоновая задача {job.name}: повторы после ошибки исчерпаны, следующий запуск - по расписанию.")
+
+    def start(self) -> None:
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._run_job(job)) for job in self.jobs.values()]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+        self._tasks = []
+
+
+job_scheduler = JobScheduler(ZoneInfo(SCHEDULER_TIMEZONE), retry_backoff=JOB_RETRY_BACKOFF, max_retries=JOB_MAX_RETRIES)
+
+
+# --- Готовый ответ на /today ---
+
+today_responses_served = metrics.counter(
+    "msk_bot_today_prerendered_total", "Ответы /today: готовый (hit) или собранный по запросу (miss).", ("result",))
+
+
+@dataclass
+class TodayResponse:
+    day: date
+    header: str             # "Ищу мероприятия на сегодня..."
+    summary: str            # Сколько найдено или что ничего нет
+    cards: list[str]        # Карточки по одной на сообщение
+    digest: list[str]       # Те же карточки, упакованные в сообщения дайджеста
+
+    @property
+    def count(self) -> int:
+        return len(self.cards)
+
+
+class TodayDigest:
+    """
+    Ответ на /today одинаков для всех в течение дня, поэтому собирается заранее фоновой
+    задачей (после полуночи и после каждого обновления снимка) и отправляется как есть.
+    «Сегодня» и здесь, и в хэндлере /today берётся из job_scheduler.today(): в том же
+    часовом поясе, в котором задача запускается после полуночи.
+    Пока БД недоступна, готовый ответ не используется: обычный путь пометит данные устаревшими.
+    """
+
+    def __init__(self):
+        self.response: TodayResponse | None = None
+
+    def get(self, today: date) -> TodayResponse | None:
+        response = self.response
+        if response is None or response.day != today or not db_breaker.closed:
+            return None
+        return response
+
+    async def rebuild(self) -> None:
+        today = job_scheduler.today()
+        events = await get_events_by_date(today)
+        if events is None:
+            if self.response is not None and self.response.day != today:
+                self.response = None
+            raise RuntimeError("нет данных о мероприятиях на сегодня")
+        day_text = today.strftime('%d.%m.%Y')
+        cards = [card_cache.get(event) for event in events]
+        self.response = TodayResponse(
+            day=today,
+            header=f"Ищу мероприятия на сегодня ({day_text})...",
+            summary=f"Найдено мероприятий на {day_text}: {len(events)}" if events
+            else f"На сегодня ({day_text}) мероприятий не найдено.",
+            cards=cards,
+            digest=pack_cards_into_messages(cards),
+        )
+
+
+today_digest = TodayDigest()
+job_scheduler.add("today_digest", today_digest.rebuild, daily_at=TODAY_DIGEST_BUILD_AT)
+event_snapshot.on_change.append(lambda: job_scheduler.trigger("today_digest"))
+
+
+async def send_today_response(message: types.Message, response: TodayResponse, user_id: int, digest: bool | None = None):
+    await message.answer(response.header)
+    await message.answer(response.summary)
+    if not response.count:
+        return
+    if await digest_enabled(user_id, digest):
+        for text_html in response.digest:
+            await send_html_text(message, text_html)
+        event_cards_sent.inc(response.count, mode="digest")
+    else:
+        for text_html in response.cards:
+            await send_html_text(message, text_html)
+        event_cards_sent.inc(response.count, mode="card")
+
+
+# --- Подписки и рассылка новых мероприятий ---
+
+SUBSCRIPTION_FREQUENCIES = {'daily': "каждый день", 'weekly': "раз в неделю"}
+SUBSCRIPTION_DEFAULT_FREQUENCY = 'daily'
+
+# Колонка фильтра (filter_type подписки) -> подпись для пользователя
+SUBSCRIPTION_FILTER_LABELS = {'organizer': "Организатор", 'location_name': "Бар", 'category': "Тематика"}
+
+# Обновления подписок по списку id / chat_id одним UPDATE ... IN (...) не длиннее стольких значений
+SUBSCRIPTION_UPDATE_CHUNK = 500
+
+# Длина msk_user_subscriptions.filter_value (VARCHAR(255)) в символах: длиннее значение не сохранить
+SUBSCRIPTION_VALUE_MAX_LENGTH = 255
+
+# Подпись подписки в ответе на нажатие кнопки (Telegram принимает не больше 200 символов)
+SUBSCRIPTION_ANSWER_LABEL_LENGTH = 100
+
+BROADCAST_HEADER = "🔔 <b>Новые мероприятия по вашим подпискам</b> (настроить: /subscribe)"
+
+# Поля, по которым мероприятие узнаётся в рассылке: правка цены или ссылки не делает его новым
+EVENT_IDENTITY_FIELDS = ('date', 'start_time', 'organizer', 'title', 'location_name')
+
+broadcast_chats = metrics.counter(
+    "msk_bot_broadcast_chats_total", "Чаты рассылки по исходу: delivered, failed, blocked (бот заблокирован).", ("result",))
+broadcast_payloads = metrics.counter(
+    "msk_bot_broadcast_payloads_total", "Разные варианты сообщений рассылки (каждый отрисовывается один раз).")
+
+
+async def add_subscription(user_id: int, chat_id: int, filter_type: str, filter_value: str) -> str | None:
+    """
+    Подписывает на значение фильтра с частотой, которую пользователь уже выбрал (иначе по умолчанию).
+    Возвращает 'added', 'exists', 'limit' или 'too_long' (значение длиннее SUBSCRIPTION_VALUE_MAX_LENGTH);
+    None - ошибка БД.
+    """
+    if len(filter_value) > SUBSCRIPTION_VALUE_MAX_LENGTH:
+        return 'too_long'
+    try:
+        # Пользователь пишет боту - значит, не заблокировал его: рассылка ему снова возможна
+        await db_pool.execute(
+            "UPDATE msk_user_subscriptions SET chat_id = %s, blocked_at = NULL WHERE user_id = %s", (chat_id, user_id))
+        rows = await db_pool.fetch_all(
+            "SELECT filter_type, filter_value, frequency FROM msk_user_subscriptions WHERE user_id = %s ORDER BY id",
+            (user_id,))
+        if any(row[0] == filter_type and row[1] == filter_value for row in rows):
+            return 'exists'
+        if len(rows) >= SUBSCRIPTION_USER_LIMIT:
+            return 'limit'
+        frequency = rows[0][2] if rows else SUBSCRIPTION_DEFAULT_FREQUENCY
+        await db_pool.execute(
+            "INSERT INTO msk_user_subscriptions (user_id, chat_id, filter_type, filter_value, frequency) "
+            "VALUES (%s, %s, %s, %s, %s)",
+            (user_id, chat_id, filter_type, filter_value, frequency))
+        return 'added'
+    except Error as e:
+        logging.error(f"Ошибка при добавлении подписки {filter_type}='{filter_value}' для {user_id}: {e}")
+        return None
+
+
+async def get_user_subscriptions(user_id: int):
+    try:
+        return await db_pool.fetch_all(
+            "SELECT id, filter_type, filter_value, frequency FROM msk_user_subscriptions WHERE user_id = %s ORDER BY id",
+            (user_id,), dictionary=True)
+    except Error as e:
+        logging.error(f"Ошибка при получении подписок пользователя {user_id}: {e}")
+        return None
+
+
+async def delete_subscription(user_id: int, subscription_id: int) -> bool | None:
+    try:
+        return await db_pool.execute(
+            "DELETE FROM msk_user_subscriptions WHERE id = %s AND user_id = %s", (subscription_id, user_id)) > 0
+    except Error as e:
+        logging.error(f"Ошибка при удалении подписки {subscription_id} пользователя {user_id}: {e}")
+        return None
+
+
+async def set_subscription_frequency(user_id: int, frequency: str) -> bool | None:
+    try:
+        return await db_pool.execute(
+            "UPDATE msk_user_subscriptions SET frequency = %s WHERE user_id = %s", (frequency, user_id)) > 0
+    except Error as e:
+        logging.error(f"Ошибка при смене частоты рассылки пользователя {user_id}: {e}")
+        return None
+
+
+def event_identity(event: dict) -> str:
+    """Ключ мероприятия для msk_subscription_sent (в msk_events нет поля, общего для бота и импорта)."""
+    fields = "\0".join("" if event.get(field) is None else str(event.get(field)) for field in EVENT_IDENTITY_FIELDS)
+    return hashlib.blake2b(fields.encode(), digest_size=16).hexdigest()
+
+
+async def fetch_sent_events(chat_ids: list[int], date_from: date) -> set[tuple[int, str]]:
+    """Пары (chat_id, ключ мероприятия), уже разосланные этим чатам на даты с date_from; ошибки БД не ловит."""
+    sent = set()
+    for start in range(0, len(chat_ids), SUBSCRIPTION_UPDATE_CHUNK):
+        chunk = chat_ids[start:start + SUBSCRIPTION_UPDATE_CHUNK]
+        placeholders = ", ".join(["%s"] * len(chunk))
+        rows = await db_pool.fetch_all(
+            f"SELECT chat_id, event_key FROM msk_subscription_sent WHERE event_date >= %s AND chat_id IN ({placeholders})",
+            (date_from, *chunk))
+        sent.update((chat_id, event_key) for chat_id, event_key in rows)
+    return sent
+
+
+async def update_subscriptions_in(assignment: str, params: tuple, column: str, keys: list[int]) -> None:
+    """UPDATE msk_user_subscriptions SET <assignment> WHERE <column> IN (...) кусками; ошибки БД не ловит."""
+    for start in range(0, len(keys), SUBSCRIPTION_UPDATE_CHUNK):
+        chunk = keys[start:start + SUBSCRIPTION_UPDATE_CHUNK]
+        placeholders = ", ".join(["%s"] * len(chunk))
+        await db_pool.execute(
+            f"UPDATE msk_user_subscriptions SET {assignment} WHERE `{column}` IN ({placeholders})", params + tuple(chunk))
+
+
+@dataclass
+class BroadcastRun:
+    key: str                         # Например daily:2026-10-19; одна рассылка на ключ
+    total: int = 0                   # Чатов в рассылке
+    last_chat_id: int | None = None  # Контрольная точка: чаты до него включительно уже обработаны
+    delivered: int = 0
+    failed: int = 0
+    blocked: int = 0
+    done: bool = False
+    payloads: int = 0                # Разных вариантов содержимого отрисовано в этом запуске (не сохраняется)
+
+    @property
+    def processed(self) -> int:
+        return self.delivered + self.failed + self.blocked
+
+
+class BroadcastEngine:
+    """
+    Рассылка по многим чатам. План - чат -> ключ содержимого: чаты с одинаковым ключом
+    получают одни и те же сообщения, поэтому render вызывается один раз на ключ.
+    Чаты обходятся по возрастанию chat_id пачками по batch_size. Сообщения уходят через
+    bot.send_message, то есть через SendScheduler с лимитами Telegram, а собственное ведро
+    на rate сообщений в секунду оставляет часть общего лимита ответам пользователям;
+    небольшая пачка не даёт рассылке занять очередь планировщика тысячами чатов.
+    После каждой пачки вызывается on_batch (chat_id -> исход) и в msk_broadcast_runs
+    сохраняется прогресс: та же рассылка после падения продолжается с контрольной точки
+    (повторно может уйти только последняя пачка), а законченная больше не запускается.
+    Исход по чату: delivered, blocked (бот заблокирован пользователем) или failed.
+    """
+
+    def __init__(self, batch_size: int, rate: float):
+        self.batch_size = batch_size
+        self._bucket = TokenBucket(rate, max(1.0, rate))
+        self.current: BroadcastRun | None = None  # Идущая рассылка (для метрик)
+
+    async def load_run(self, key: str) -> BroadcastRun | None:
+        rows = await db_pool.fetch_all(
+            "SELECT total_chats, last_chat_id, delivered, failed, blocked, status FROM msk_broadcast_runs WHERE run_key = %s",
+            (key,))
+        if not rows:
+            return None
+        total, last_chat_id, delivered, failed, blocked, status = rows[0]
+        return BroadcastRun(key, total, last_chat_id, delivered, failed, blocked, status == 'done')
+
+    async def save_run(self, run: BroadcastRun) -> None:
+        await db_pool.execute(
+            "INSERT INTO msk_broadcast_runs (run_key, status, total_chats, last_chat_id, delivered, failed, blocked) "
+            "VALUES (%s, %s, %s, %s, %s, %s, %s) "
+            "ON DUPLICATE KEY UPDATE status = VALUES(status), total_chats = VALUES(total_chats), "
+            "last_chat_id = VALUES(last_chat_id), delivered = VALUES(delivered), "
+            "failed = VALUES(failed), blocked = VALUES(blocked)",
+            (run.key, 'done' if run.done else 'running', run.total, run.last_chat_id,
+             run.delivered, run.failed, run.blocked))
+
+    async def _pace(self) -> None:
+        while (wait := self._bucket.delay(time.monotonic())) > 0:
+            await asyncio.sleep(wait)
+        self._bucket.take(time.monotonic())
+
+    async def _deliver(self, bot: Bot, chat_id: int, texts: list[str]) -> str:
+        for text_html in texts:
+            await self._pace()
+            try:
+                await bot.send_message(chat_id, text_html, parse_mode="HTML")
+            except TelegramForbiddenError:
+                return 'blocked'
+            except Exception as e:
+                logging.warning(f"Рассылка: не удалось отправить сообщение в чат {chat_id}: {e}")
+                return 'failed'
+        return 'delivered'
+
+    async def run(self, bot: Bot, key: str, plan: dict[int, object], render, on_batch=None) -> BroadcastRun:
+        """
+        render(ключ содержимого) -> список HTML-сообщений; on_batch - async (dict chat_id -> исход).
+        Ошибка БД при чтении или записи контрольной точки прерывает рассылку (Error): без неё
+        повторный запуск разослал бы уже отправленное.
+        """
+        run = await self.load_run(key)
+        if run is not None and run.done:
+            logging.info(f"Рассылка {key} уже закончена, пропускаю.")
+            return run
+        if run is None:
+            run = BroadcastRun(key)
+        else:
+            logging.info(f"Рассылка {key}: продолжаю после chat_id {run.last_chat_id} ({run.processed} чатов уже обработано).")
+        chats = sorted(chat_id for chat_id in plan if run.last_chat_id is None or chat_id > run.last_chat_id)
+        run.total = run.processed + len(chats)
+        rendered: dict[object, list[str]] = {}
+
+        self.current = run
+        try:
+            for start in range(0, len(chats), self.batch_size):
+                batch = chats[start:start + self.batch_size]
+                for chat_id in batch:
+                    payload = plan[chat_id]
+                    if payload not in rendered:
+                        rendered[payload] = render(payload)
+                        run.payloads += 1
+                        broadcast_payloads.inc()
+                outcomes = await asyncio.gather(*(self._deliver(bot, chat_id, rendered[plan[chat_id]]) for chat_id in batch))
+                for outcome in outcomes:
+                    broadcast_chats.inc(result=outcome)
+                run.delivered += outcomes.count('delivered')
+                run.failed += outcomes.count('failed')
+                run.blocked += outcomes.count('blocked')
+                run.last_chat_id = batch[-1]
+                if on_batch is not None:
+                    await on_batch(dict(zip(batch, outcomes)))
+                await self.save_run(run)
+            run.done = True
+            await self.save_run(run)
+        finally:
+            self.current = None
+        logging.info(f"Рассылка {key} закончена: чатов {run.total}, доставлено {run.delivered}, не доставлено {run.failed}, "
+                     f"бот заблокирован {run.blocked}; разных сообщений в этом запуске {run.payloads}.")
+        return run
+
+
+class SubscriptionPush:
+    """
+    Рассылка подписчикам новых мероприятий по их подпискам (организатор, бар, тематика)
+    в ближайшие horizon_days дней. Ежедневные подписки получают её каждый день,
+    еженедельные - в weekly_weekday.
+    В msk_events нет времени добавления записи, поэтому «новое» - это то, что чату ещё
+    не отправлялось: после доставки ключи мероприятий (event_identity) записываются
+    в msk_subscription_sent. Так мероприятие, добавленное импортом на уже разосланную
+    дату, уйдёт в следующую рассылку, а отправленное не повторится. Записи о прошедших
+    датах удаляются в начале каждой рассылки.
+    Содержимое для чата - все его новые мероприятия; чаты с одинаковым набором
+    получают одни и те же сообщения (см. BroadcastEngine). Чатам без новых мероприятий
+    ничего не отправляется.
+    """
+
+    def __init__(self, engine: BroadcastEngine, tz: ZoneInfo, push_at: tuple[int, int],
+                 weekly_weekday: int, horizon_days: int):
+        self.engine = engine
+        self.tz = tz
+        self.push_at = push_at
+        self.weekly_weekday = weekly_weekday
+        self.horizon_days = horizon_days
+
+    def due_frequencies(self, now: datetime) -> list[str]:
+        """Какие рассылки уже должны были пройти сегодня (на случай, если бот был остановлен в их время)."""
+        hour, minute = self.push_at
+        if now < now.replace(hour=hour, minute=minute, second=0, microsecond=0):
+            return []
+        return ['daily', 'weekly'] if now.weekday() == self.weekly_weekday else ['daily']
+
+    async def run_due(self, bot: Bot) -> None:
+        now = datetime.now(self.tz)
+        for frequency in self.due_frequencies(now):
+            await self.push(bot, frequency, now.date())
+
+    async def matching_events(self, column: str, value: str, date_from: date, date_to: date) -> list[dict]:
+        if event_snapshot.covers(date_from) and db_breaker.closed:
+            return [event
+                    for event_date in event_snapshot.index.dates_for(column, value) if date_from <= event_date <= date_to
+                    for event in event_snapshot.index.events_for(column, value, event_date)]
+        return await facet_queries.events(
+            FacetFilter.of(date_from=date_from, date_to=date_to, **{column: value}), allow_stale=False)
+
+    async def push(self, bot: Bot, frequency: str, today: date) -> BroadcastRun:
+        key = f"{frequency}:{today.isoformat()}"
+        finished = await self.engine.load_run(key)
+        if finished is not None and finished.done:
+            return finished  # Повторный запуск задачи (после ошибки или рестарта): план не собираем
+        horizon = today + timedelta(days=self.horizon_days - 1)
+        await db_pool.execute("DELETE FROM msk_subscription_sent WHERE event_date < %s", (today,))
+        subscriptions = await db_pool.fetch_all(
+            "SELECT chat_id, filter_type, filter_value FROM msk_user_subscriptions "
+            "WHERE frequency = %s AND blocked_at IS NULL ORDER BY chat_id, id",
+            (frequency,), dictionary=True)
+
+        # Одно и то же значение фильтра у многих чатов выбирается один раз
+        found: dict[tuple[str, str], list[dict]] = {}
+        chat_events: dict[int, dict[str, dict]] = {}  # chat_id -> ключ мероприятия -> мероприятие
+        for subscription in subscriptions:
+            events = chat_events.setdefault(subscription['chat_id'], {})
+            if subscription['filter_type'] not in FACET_COLUMNS:
+                continue
+            lookup = (subscription['filter_type'], subscription['filter_value'])
+            if lookup not in found:
+                found[lookup] = await self.matching_events(*lookup, today, horizon)
+            for event in found[lookup]:
+                events[event_identity(event)] = event
+        sent = await fetch_sent_events([chat_id for chat_id, events in chat_events.items() if events], today)
+
+        # Ключ содержимого - набор карточек по порядку; совпадает у чатов с одинаковыми подписками
+        plan: dict[int, tuple] = {}
+        payload_events: dict[tuple, list[dict]] = {}
+        chat_new: dict[int, list[str]] = {}  # Ключи мероприятий, которые запишутся как разосланные
+        for chat_id, events in chat_events.items():
+            new = sorted(((event_key, event) for event_key, event in events.items() if (chat_id, event_key) not in sent),
+                         key=lambda item: (item[1]['date'], str(item[1].get('start_time'))))
+            if not new:
+                continue
+            payload = tuple(tuple(event.get(field) for field in CARD_FIELDS) for _, event in new)
+            payload_events.setdefault(payload, [event for _, event in new])
+            plan[chat_id] = payload
+            chat_new[chat_id] = [event_key for event_key, _ in new]
+        event_dates = {event_key: event['date'] for events in chat_events.values() for event_key, event in events.items()}
+        logging.info(f"Рассылка {key}: подписок {len(subscriptions)}, значений фильтров {len(found)}, "
+                     f"чатов с новыми мероприятиями {len(plan)}, разных вариантов сообщения {len(payload_events)}.")
+
+        def render(payload: tuple) -> list[str]:
+            return pack_cards_into_messages([BROADCAST_HEADER] + [card_cache.get(event) for event in payload_events[payload]])
+
+        async def on_batch(outcomes: dict[int, str]) -> None:
+            delivered = [(chat_id, event_key, event_dates[event_key])
+                         for chat_id, outcome in outcomes.items() if outcome == 'delivered'
+                         for event_key in chat_new[chat_id]]
+            blocked = [chat_id for chat_id, outcome in outcomes.items() if outcome == 'blocked']
+            if delivered:
+                await db_pool.execute_many(
+                    "INSERT INTO msk_subscription_sent (chat_id, event_key, event_date) VALUES (%s, %s, %s) "
+                    "ON DUPLICATE KEY UPDATE event_date = VALUES(event_date)",
+                    delivered)
+            await update_subscriptions_in("blocked_at = CURRENT_TIMESTAMP", (), "chat_id", blocked)
+
+        return await self.engine.run(bot, key, plan, render, on_batch)
+
+
+broadcast_engine = BroadcastEngine(batch_size=BROADCAST_BATCH_SIZE, rate=BROADCAST_RATE)
+subscription_push = SubscriptionPush(
+    broadcast_engine,
+    tz=ZoneInfo(SCHEDULER_TIMEZONE),
+    push_at=SUBSCRIPTION_PUSH_AT,
+    weekly_weekday=SUBSCRIPTION_WEEKLY_WEEKDAY,
+    horizon_days=SUBSCRIPTION_HORIZON_DAYS,
+)
+
+
+def subscription_label(subscription: dict, max_length: int | None = None) -> str:
+    label = f"{SUBSCRIPTION_FILTER_LABELS.get(subscription['filter_type'], subscription['filter_type'])}: {subscription['filter_value']}"
+    return label if max_length is None or len(label) <= max_length else label[:max_length - 1] + "…"
+
+
+def subscriptions_view(subscriptions: list[dict]):
+    """Текст и клавиатура /subscribe: подписки (нажатие отменяет) и выбор частоты рассылки."""
+    if not subscriptions:
+        return ("У вас пока нет подписок.\n\nВыберите организатора, бар или тематику кнопками внизу экрана "
+                "и нажмите «🔔 Подписаться» под списком дат - новые мероприятия будут приходить сами."), None
+    frequency = subscriptions[0]['frequency']
+    lines = [f"Ваши подписки (новые мероприятия приходят {SUBSCRIPTION_FREQUENCIES.get(frequency, frequency)}):"]
+    lines += [f"• {subscription_label(subscription)}" for subscription in subscriptions]
+    lines.append("\nНажмите на подписку, чтобы отменить её.")
+
+    builder = InlineKeyboardBuilder()
+    for subscription in subscriptions:
+        label = subscription_label(subscription, max_length=40)
+        builder.row(InlineKeyboardButton(text=f"❌ {label}", callback_data=f"sub_del:{subscription['id']}"))
+    builder.row(*(InlineKeyboardButton(text=f"{'✅ ' if value == frequency else ''}{title.capitalize()}",
+                                       callback_data=f"sub_freq:{value}")
+                  for value, title in SUBSCRIPTION_FREQUENCIES.items()))
+    return "\n".join(lines), builder.as_markup()
 
 
 # --- Хэндлеры ---
@@ -664,16 +3170,22 @@ async def send_welcome(message: types.Message):
 
 # Хэндлер команды /today ("Квизы сегодня") - Доступна через меню бота
 @dp.message(Command("today"))
-async def handle_today_quizzes_command(message: types.Message):
+async def handle_today_quizzes_command(message: types.Message, command: CommandObject):
     user_id = message.from_user.id
     user_name = message.from_user.username
     insert_filter_selection(user_id, user_name, 'command', '/today') # <-- ЭТА СТРОКА ДОБАВЛЕНА
     logging.info(f"Получен запрос /today (команда) от {user_id} в чате {message.chat.id}")
-    today = date.today()
+    today = job_scheduler.today()  # Как в TodayDigest.rebuild
+
+    response = today_digest.get(today)
+    today_responses_served.inc(result="hit" if response is not None else "miss")
+    if response is not None:
+        await send_today_response(message, response, user_id, digest=parse_digest_arg(command.args))
+        return
 
     await message.answer(f"Ищу мероприятия на сегодня ({today.strftime('%d.%m.%Y')})...")
 
-    events = get_events_by_date(today)
+    events = await get_events_by_date(today)
 
     if events is None:
         await message.answer("Произошла ошибка при получении данных из базы.")
@@ -681,8 +3193,7 @@ async def handle_today_quizzes_command(message: types.Message):
         await message.answer(f"На сегодня ({today.strftime('%d.%m.%Y')}) мероприятий не найдено.")
     else:
         await message.answer(f"Найдено мероприятий на {today.strftime('%d.%m.%Y')}: {len(events)}")
-        for event in events:
-            await send_event_card(message, event)
+        await send_events(message, events, user_id, digest=parse_digest_arg(command.args))
 
 
 # Хэндлер команды /by_date ("Квизы по дате") - Доступна через меню бота
@@ -692,7 +3203,7 @@ async def handle_quizzes_by_date_command(message: types.Message):
     user_name = message.from_user.username
     insert_filter_selection(user_id, user_name, 'command', '/by_date') # <-- ЭТА СТРОКА ДОБАВЛЕНА
     logging.info(f"Получен запрос /by_date (команда) от {user_id} в чате {message.chat.id}")
-    dates = get_distinct_event_dates()
+    dates = await get_distinct_event_dates()
 
     if dates is None:
         await message.answer("Произошла ошибка при получении доступных дат.")
@@ -720,6 +3231,10 @@ async def handle_instruction_command(message: types.Message):
         "- /start: выводит приветственное сообщение.\n"
         "- /today: покажет список мероприятий, запланированных на сегодня.\n"
         "- /by_date: предложит выбрать дату из списка всех доступных мероприятий.\n"
+        "- /digest: включает или выключает дайджест - несколько карточек в одном сообщении "
+        "(разово: /today дайджест или /today карточки).\n"
+        "- /subscribe: ваши подписки. Подписаться на организатора, бар или тематику можно кнопкой "
+        "«🔔 Подписаться» под списком дат - новые мероприятия будут приходить каждый день или раз в неделю.\n"
         "- /instruction: прочитать инструкцию.\n\n"
         "Используйте кнопки внизу экрана для поиска по фильтрам:\n"
         "- Кнопка \"Организатор\" позволяет выбрать квизы по Организатору.\n"
@@ -734,10 +3249,71 @@ async def handle_instruction_command(message: types.Message):
     )
 
 
+# Хэндлер команды /digest - включает/выключает режим дайджеста для пользователя
+@dp.message(Command("digest"))
+async def handle_digest_command(message: types.Message, command: CommandObject):
+    user_id = message.from_user.id
+    user_name = message.from_user.username
+    enabled = parse_digest_arg(command.args)
+    if enabled is None:
+        enabled = not await digest_enabled(user_id)
+    insert_filter_selection(user_id, user_name, 'command', '/digest')
+    if not await digest_preferences.set(user_id, enabled):
+        await message.answer("Не удалось сохранить режим дайджеста, попробуйте позже.")
+        return
+    logging.info(f"Режим дайджеста {'включён' if enabled else 'выключен'} для {user_id} в чате {message.chat.id}")
+
+    if enabled:
+        await message.answer("Режим дайджеста включён: мероприятия будут приходить несколькими карточками в одном сообщении.")
+    else:
+        await message.answer("Режим дайджеста выключен: каждое мероприятие будет приходить отдельной карточкой.")
+
+
+SLOW_QUERIES_DEFAULT_LIMIT = 10
+SLOW_QUERIES_MAX_LIMIT = 50
+
+
+def format_query_stats(position: int, stats: QueryStats) -> str:
+    average_ms = stats.total_time / stats.count * 1000
+    average_rows = stats.rows_total / stats.count
+    shape = stats.shape if len(stats.shape) <= 400 else stats.shape[:400] + "..."
+    return (
+        f"<b>{position}. [{stats.shape_id}]</b> макс. {stats.max_time * 1000:.1f} мс, "
+        f"в среднем {average_ms:.1f} мс, вызовов {stats.count}, медленных {stats.slow_count}, "
+        f"строк в среднем {average_rows:.1f}\n"
+        f"Параметры самого долгого: {escape_html(format_query_params(stats.max_time_params))}\n"
+        f"<pre>{escape_html(shape)}</pre>\n"
+        f"EXPLAIN: {escape_html(summarize_explain(stats.explain))}\n"
+    )
+
+
+# Служебная команда для администраторов: самые медленные формы запросов (/slow_queries 20)
+@dp.message(Command("slow_queries"))
+async def handle_slow_queries_command(message: types.Message, command: CommandObject):
+    if message.from_user.id not in ADMIN_IDS:
+        logging.warning(f"Попытка вызвать /slow_queries не администратором {message.from_user.id}")
+        return
+
+    limit = SLOW_QUERIES_DEFAULT_LIMIT
+    if command.args and command.args.strip().isdigit():
+        limit = max(1, min(int(command.args.strip()), SLOW_QUERIES_MAX_LIMIT))
+
+    query_log = db_pool.query_log
+    top = query_log.top(limit)
+    if not top:
+        await message.answer("Запросов к БД с момента запуска ещё не было.")
+        return
+
+    header = (f"Самые медленные запросы (порог {query_log.slow_threshold * 1000:.0f} мс, "
+              f"медленных в журнале: {len(query_log.slow)}):\n")
+    entries = [header] + [format_query_stats(position, stats) for position, stats in enumerate(top, start=1)]
+    for text_html in pack_cards_into_messages(entries):
+        await message.answer(text_html, parse_mode="HTML")
+
+
 # Хэндлер нажатий на Inline кнопки с датами для оригинального /by_date (callback_data начинается с 'date:')
-# Этот хэндлер срабатывает ТОЛЬКО если бот НЕ находится в каком-либо состоянии FSM
-@dp.callback_query(F.data.startswith('date:'), StateFilter(None))
-async def handle_date_callback(callback: types.CallbackQuery, state: FSMContext):
+@dp.callback_query(F.data.startswith('date:'))
+async def handle_date_callback(callback: types.CallbackQuery):
     # При выборе даты из /by_date мы не фиксируем статистику фильтров, т.к. не знаем, какой фильтр привел к этому (это общий список дат).
     # Но если хотите, можете добавить здесь запись, например:
     # insert_filter_selection(callback.from_user.id, callback.from_user.username, 'date_selection_from_by_date', selected_date_str)
@@ -755,7 +3331,7 @@ async def handle_date_callback(callback: types.CallbackQuery, state: FSMContext)
 
     await callback.answer(f"Запрашиваю мероприятия на {selected_date.strftime('%d.%m.%Y')}...", show_alert=False)
 
-    events = get_events_by_date(selected_date)
+    events = await get_events_by_date(selected_date)
 
     try:
         await callback.message.edit_text(
@@ -773,44 +3349,82 @@ async def handle_date_callback(callback: types.CallbackQuery, state: FSMContext)
         await callback.message.answer(f"На дату {selected_date.strftime('%d.%m.%Y')} мероприятий не найдено.")
     else:
         await callback.message.answer(f"Найдено мероприятий на {selected_date.strftime('%d.%m.%Y')}: {len(events)}")
-        for event in events:
-            await send_event_card(callback.message, event)
+        await send_events(callback.message, events, callback.from_user.id)
 
 
 # --- Хэндлеры для фильтра Организатора ---
 
+# Номер страницы из callback_data вида 'org_page:3'
+def parse_page_callback(callback_data: str) -> int | None:
+    try:
+        return int(callback_data.split(':', 1)[1])
+    except (ValueError, IndexError):
+        logging.error(f"Неверный формат callback_data для листания страниц: {callback_data}")
+        return None
+
+
+async def edit_page_keyboard(callback: types.CallbackQuery, keyboard):
+    try:
+        await callback.message.edit_reply_markup(reply_markup=keyboard)
+    except Exception as e:
+        logging.warning(f"Не удалось перелистнуть страницу клавиатуры: {e}")
+    await callback.answer()
+
+
+# Кнопка с номером страницы ничего не делает, просто гасим "часики"
+@dp.callback_query(F.data == 'noop')
+async def handle_noop_callback(callback: types.CallbackQuery):
+    await callback.answer()
+
+
 @dp.message(F.text == "Организатор")
-async def handle_organizer_button(message: types.Message, state: FSMContext):
+async def handle_organizer_button(message: types.Message):
     user_id = message.from_user.id
     user_name = message.from_user.username
     insert_filter_selection(user_id, user_name, 'filter_selection', 'Организатор') # Запись нажатия на кнопку фильтра
 
     logging.info(f"Нажата кнопка 'Организатор' от {user_id} в чате {message.chat.id}")
 
-    organizers = get_distinct_organizers()
+    organizers = await get_distinct_organizers()
 
     if organizers is None:
         await message.answer("Произошла ошибка при получении списка организаторов.")
-        await state.clear()
     elif not organizers:
         await message.answer("На ближайшие даты мероприятий с указанными организаторами не найдено.")
-        await state.clear()
     else:
-        keyboard = organizers_inline_keyboard(organizers)
+        keyboard = organizers_inline_keyboard(get_facet_pages('organizer', organizers))
         if keyboard:
             await message.answer("Выберите организатора:", reply_markup=keyboard)
-            await state.set_state(OrganizerFilterStates.waiting_for_organizer_selection)
         else:
              await message.answer("На ближайшие даты мероприятий с указанными организаторами не найдено.")
-             await state.clear()
 
 
-@dp.callback_query(OrganizerFilterStates.waiting_for_organizer_selection, F.data.startswith('select_organizer:'))
-async def handle_organizer_selection_callback(callback: types.CallbackQuery, state: FSMContext):
+# Листание страниц списка организаторов: правим клавиатуру в том же сообщении
+@dp.callback_query(F.data.startswith('org_page:'))
+async def handle_organizer_page_callback(callback: types.CallbackQuery):
+    page = parse_page_callback(callback.data)
+    organizers = await get_distinct_organizers()
+    keyboard = organizers_inline_keyboard(get_facet_pages('organizer', organizers or []), page) if page is not None else None
+
+    if keyboard is None:
+        await callback.answer("Список организаторов устарел, нажмите кнопку «Организатор» ещё раз.", show_alert=True)
+        return
+    await edit_page_keyboard(callback, keyboard)
+
+
+@dp.callback_query(F.data.startswith('select_organizer:'))
+async def handle_organizer_selection_callback(callback: types.CallbackQuery):
     try:
-        prefix, organizer_name_escaped = callback.data.split(':', 1)
-        organizer_name = organizer_name_escaped.replace('\\:', ':')
-        logging.info(f"Выбран организатор: '{organizer_name}' от {callback.from_user.id}")
+        prefix, organizer_code = callback.data.split(':', 1)
+        organizer_name = facet_codes.decode('organizer', organizer_code)
+
+        if organizer_name is None:
+            logging.error(f"Код организатора '{organizer_code}' не найден в словаре кодов.")
+            await callback.answer("Ошибка данных организатора!", show_alert=True)
+            await callback.message.answer("Произошла ошибка. Пожалуйста, начните выбор организатора заново.", parse_mode=None)
+            return
+
+        logging.info(f"Выбран организатор (код: {organizer_code}): '{organizer_name}' от {callback.from_user.id}")
 
         # Записываем статистику выбора Организатора
         insert_filter_selection(callback.from_user.id, callback.from_user.username, 'filter_organizer', organizer_name)
@@ -819,7 +3433,6 @@ async def handle_organizer_selection_callback(callback: types.CallbackQuery, sta
         logging.error(f"Ошибка парсинга callback_data для выбора организатора: {callback.data}. Ошибка: {e}")
         await callback.answer("Ошибка данных организатора!", show_alert=True)
         await callback.message.answer("Произошла ошибка. Пожалуйста, начните выбор организатора заново.", parse_mode=None)
-        await state.clear()
         return
 
     try:
@@ -830,32 +3443,34 @@ async def handle_organizer_selection_callback(callback: types.CallbackQuery, sta
          await callback.answer(f"Выбран: {organizer_name}. Ищу даты...", show_alert=False)
 
 
-    dates = get_distinct_dates_by_organizer(organizer_name)
+    dates = await get_distinct_dates_by_organizer(organizer_name)
 
     if dates is None:
         await callback.message.answer("Произошла ошибка при получении списка дат для выбранного организатора.")
-        await state.clear()
     elif not dates:
         await callback.message.answer(f"Мероприятий от '{organizer_name}' на ближайшие даты не найдено.")
-        await state.clear()
     else:
-        keyboard = dates_inline_keyboard_for_organizer(dates, organizer_name_escaped)
+        keyboard = dates_inline_keyboard_for_organizer(dates, organizer_code)
         if keyboard:
             await callback.message.answer("Выберите дату:", reply_markup=keyboard)
-            await state.set_state(OrganizerFilterStates.waiting_for_date_selection)
         else:
              await callback.message.answer(f"Мероприятий от '{organizer_name}' на ближайшие даты не найдено.")
-             await state.clear()
 
 
-@dp.callback_query(OrganizerFilterStates.waiting_for_date_selection, F.data.startswith('select_org_date:'))
-async def handle_organizer_date_selection_callback(callback: types.CallbackQuery, state: FSMContext):
+@dp.callback_query(F.data.startswith('select_org_date:'))
+async def handle_organizer_date_selection_callback(callback: types.CallbackQuery):
     user_id = callback.from_user.id
     user_name = callback.from_user.username
     try:
-        prefix, organizer_name_escaped, selected_date_str = callback.data.split(':', 2)
-        organizer_name = organizer_name_escaped.replace('\\:', ':')
+        prefix, organizer_code, selected_date_str = callback.data.split(':', 2)
         selected_date = datetime.strptime(selected_date_str, '%Y-%m-%d').date()
+
+        organizer_name = facet_codes.decode('organizer', organizer_code)
+        if organizer_name is None:
+            logging.error(f"Код организатора '{organizer_code}' не найден в словаре кодов.")
+            await callback.answer("Ошибка данных организатора!", show_alert=True)
+            return
+
         logging.info(f"Выбрана дата '{selected_date_str}' для организатора '{organizer_name}' от {user_id} (@{user_name})")
 
         # Записываем статистику выбора даты для организатора
@@ -865,7 +3480,6 @@ async def handle_organizer_date_selection_callback(callback: types.CallbackQuery
     except (ValueError, IndexError) as e:
         logging.error(f"Ошибка парсинга callback_data для выбора даты после организатора: {callback.data}. Ошибка: {e}")
         await callback.answer("Ошибка данных даты!", show_alert=True)
-        await state.clear()
         return
 
     try:
@@ -880,7 +3494,7 @@ async def handle_organizer_date_selection_callback(callback: types.CallbackQuery
          await callback.answer(f"Выбрана дата: {selected_date.strftime('%d.%m.%Y')}. Ищу мероприятия...", show_alert=False)
 
 
-    events = get_events_by_organizer_and_date(organizer_name, selected_date)
+    events = await get_events_by_organizer_and_date(organizer_name, selected_date)
 
     if events is None:
         await callback.message.answer("Произошла ошибка при получении данных из базы.")
@@ -894,60 +3508,59 @@ async def handle_organizer_date_selection_callback(callback: types.CallbackQuery
              f"Найдено мероприятий от '{organizer_name}' "
              f"на {selected_date.strftime('%d.%m.%Y')}: {len(events)}"
         )
-        for event in events:
-            await send_event_card(callback.message, event)
+        await send_events(callback.message, events, callback.from_user.id)
 
-    await state.clear()
-    logging.info(f"Состояние FSM сброшено для пользователя {user_id} (@{user_name})")
 
 
 # --- Хэндлеры для фильтра Места ---
 
 @dp.message(F.text == "Бар")
-async def handle_location_button(message: types.Message, state: FSMContext):
+async def handle_location_button(message: types.Message):
     user_id = message.from_user.id
     user_name = message.from_user.username
     insert_filter_selection(user_id, user_name, 'filter_selection', 'Бар') # Запись нажатия на кнопку фильтра
 
     logging.info(f"Нажата кнопка 'Бар' от {user_id} в чате {message.chat.id}")
 
-    locations = get_distinct_locations()
+    locations = await get_distinct_locations()
 
     if locations is None:
         await message.answer("Произошла ошибка при получении списка мест проведения.")
-        await state.clear()
     elif not locations:
         await message.answer("На ближайшие даты мероприятий с указанными местами не найдено.")
-        await state.clear()
     else:
-        location_choices = {f"loc_{i}": loc for i, loc in enumerate(locations)}
-        await state.update_data(location_choices=location_choices)
-        logging.debug(f"Сохранен словарь location_choices в state: {location_choices}")
-
-        keyboard = locations_inline_keyboard_with_ids(location_choices)
+        keyboard = locations_inline_keyboard_with_ids(get_facet_pages('location_name', locations))
 
         if keyboard:
             await message.answer("Выберите место проведения:", reply_markup=keyboard)
-            await state.set_state(LocationFilterStates.waiting_for_location_selection)
         else:
              await message.answer("На ближайшие даты мероприятий с указанными местами не найдено.")
-             await state.clear()
 
 
-@dp.callback_query(LocationFilterStates.waiting_for_location_selection, F.data.startswith('select_location_id:'))
-async def handle_location_selection_callback(callback: types.CallbackQuery, state: FSMContext):
+# Листание страниц списка мест
+@dp.callback_query(F.data.startswith('loc_page:'))
+async def handle_location_page_callback(callback: types.CallbackQuery):
+    page = parse_page_callback(callback.data)
+    locations = await get_distinct_locations()
+    keyboard = locations_inline_keyboard_with_ids(get_facet_pages('location_name', locations or []), page) if page is not None else None
+
+    if keyboard is None:
+        await callback.answer("Список мест устарел, нажмите кнопку «Бар» ещё раз.", show_alert=True)
+        return
+    await edit_page_keyboard(callback, keyboard)
+
+
+@dp.callback_query(F.data.startswith('select_location_id:'))
+async def handle_location_selection_callback(callback: types.CallbackQuery):
     try:
         prefix, location_id = callback.data.split(':', 1)
-        data = await state.get_data()
-        location_choices = data.get('location_choices')
+        location_name = facet_codes.decode('location_name', location_id)
 
-        if location_choices is None or location_id not in location_choices:
-            logging.error(f"Не найден словарь location_choices в state или ID '{location_id}' не найден.")
+        if location_name is None:
+            logging.error(f"Код места '{location_id}' не найден в словаре кодов.")
             await callback.answer("Ошибка данных места!", show_alert=True)
-            await state.clear()
             return
 
-        location_name = location_choices[location_id]
         logging.info(f"Выбрано место (ID: {location_id}): '{location_name}' от {callback.from_user.id}")
 
         # Записываем статистику выбора Места
@@ -957,7 +3570,6 @@ async def handle_location_selection_callback(callback: types.CallbackQuery, stat
     except (ValueError, IndexError) as e:
         logging.error(f"Ошибка парсинга callback_data для выбора места: {callback.data}. Ошибка: {e}")
         await callback.answer("Ошибка данных места!", show_alert=True)
-        await state.clear()
         return
 
     try:
@@ -967,42 +3579,34 @@ async def handle_location_selection_callback(callback: types.CallbackQuery, stat
          logging.warning(f"Не удалось отредактировать сообщение с выбором места: {e}")
          await callback.answer(f"Выбрано: {location_name}. Ищу даты...", show_alert=False)
 
-    dates = get_distinct_dates_by_location(location_name)
+    dates = await get_distinct_dates_by_location(location_name)
 
     if dates is None:
         await callback.message.answer("Произошла ошибка при получении списка дат для выбранного места.")
-        await state.clear()
     elif not dates:
         await callback.message.answer(f"Мероприятий в месте '{location_name}' на ближайшие даты не найдено.")
-        await state.clear()
     else:
         keyboard = dates_inline_keyboard_for_location_with_id(dates, location_id)
         if keyboard:
             await callback.message.answer("Выберите дату:", reply_markup=keyboard)
-            await state.set_state(LocationFilterStates.waiting_for_date_selection)
         else:
              await callback.message.answer(f"Мероприятий в месте '{location_name}' на ближайшие даты не найдено.")
-             await state.clear()
 
 
-@dp.callback_query(LocationFilterStates.waiting_for_date_selection, F.data.startswith('select_loc_date_id:'))
-async def handle_location_date_selection_callback(callback: types.CallbackQuery, state: FSMContext):
+@dp.callback_query(F.data.startswith('select_loc_date_id:'))
+async def handle_location_date_selection_callback(callback: types.CallbackQuery):
     user_id = callback.from_user.id
     user_name = callback.from_user.username
     try:
         prefix, location_id, selected_date_str = callback.data.split(':', 2)
         selected_date = datetime.strptime(selected_date_str, '%Y-%m-%d').date()
 
-        data = await state.get_data()
-        location_choices = data.get('location_choices')
-
-        if location_choices is None or location_id not in location_choices:
-            logging.error(f"Не найден словарь location_choices в state или ID '{location_id}' не найден.")
+        location_name = facet_codes.decode('location_name', location_id)
+        if location_name is None:
+            logging.error(f"Код места '{location_id}' не найден в словаре кодов.")
             await callback.answer("Ошибка данных места!", show_alert=True)
-            await state.clear()
             return
 
-        location_name = location_choices[location_id]
         logging.info(f"Выбрана дата '{selected_date_str}' для места (ID: {location_id}) '{location_name}' от {user_id} (@{user_name})")
 
         # Мы уже записали выбор места, выбор даты не пишем в данном случае, чтобы не дублировать
@@ -1011,7 +3615,6 @@ async def handle_location_date_selection_callback(callback: types.CallbackQuery,
     except (ValueError, IndexError) as e:
         logging.error(f"Ошибка парсинга callback_data для выбора даты после места: {callback.data}. Ошибка: {e}")
         await callback.answer("Ошибка данных даты!", show_alert=True)
-        await state.clear()
         return
 
     try:
@@ -1026,7 +3629,7 @@ async def handle_location_date_selection_callback(callback: types.CallbackQuery,
          await callback.answer(f"Выбрана дата: {selected_date.strftime('%d.%m.%Y')}. Ищу мероприятия...", show_alert=False)
 
 
-    events = get_events_by_location_and_date(location_name, selected_date)
+    events = await get_events_by_location_and_date(location_name, selected_date)
 
     if events is None:
         await callback.message.answer("Произошла ошибка при получении данных из базы.")
@@ -1040,60 +3643,59 @@ async def handle_location_date_selection_callback(callback: types.CallbackQuery,
              f"Найдено мероприятий в месте '{location_name}' "
              f"на {selected_date.strftime('%d.%m.%Y')}: {len(events)}"
         )
-        for event in events:
-            await send_event_card(callback.message, event)
+        await send_events(callback.message, events, callback.from_user.id)
 
-    await state.clear()
-    logging.info(f"Состояние FSM сброшено для пользователя {user_id} (@{user_name})")
 
 
 # --- Хэндлеры для фильтра Тематики ---
 
 @dp.message(F.text == "Тематика")
-async def handle_category_button(message: types.Message, state: FSMContext):
+async def handle_category_button(message: types.Message):
     user_id = message.from_user.id
     user_name = message.from_user.username
     insert_filter_selection(user_id, user_name, 'filter_selection', 'Тематика') # Запись нажатия на кнопку фильтра
 
     logging.info(f"Нажата кнопка 'Тематика' от {user_id} в чате {message.chat.id}")
 
-    categories = get_distinct_categories()
+    categories = await get_distinct_categories()
 
     if categories is None:
         await message.answer("Произошла ошибка при получении списка тематик.")
-        await state.clear()
     elif not categories:
         await message.answer("На ближайшие даты мероприятий с указанными тематиками не найдено.")
-        await state.clear()
     else:
-        category_choices = {f"cat_{i}": cat for i, cat in enumerate(categories)}
-        await state.update_data(category_choices=category_choices)
-        logging.debug(f"Сохранен словарь category_choices в state: {category_choices}")
-
-        keyboard = categories_inline_keyboard_with_ids(category_choices)
+        keyboard = categories_inline_keyboard_with_ids(get_facet_pages('category', categories))
 
         if keyboard:
             await message.answer("Выберите тематику:", reply_markup=keyboard)
-            await state.set_state(CategoryFilterStates.waiting_for_category_selection)
         else:
              await message.answer("На ближайшие даты мероприятий с указанными тематиками не найдено.")
-             await state.clear()
 
 
-@dp.callback_query(CategoryFilterStates.waiting_for_category_selection, F.data.startswith('select_category_id:'))
-async def handle_category_selection_callback(callback: types.CallbackQuery, state: FSMContext):
+# Листание страниц списка тематик
+@dp.callback_query(F.data.startswith('cat_page:'))
+async def handle_category_page_callback(callback: types.CallbackQuery):
+    page = parse_page_callback(callback.data)
+    categories = await get_distinct_categories()
+    keyboard = categories_inline_keyboard_with_ids(get_facet_pages('category', categories or []), page) if page is not None else None
+
+    if keyboard is None:
+        await callback.answer("Список тематик устарел, нажмите кнопку «Тематика» ещё раз.", show_alert=True)
+        return
+    await edit_page_keyboard(callback, keyboard)
+
+
+@dp.callback_query(F.data.startswith('select_category_id:'))
+async def handle_category_selection_callback(callback: types.CallbackQuery):
     try:
         prefix, category_id = callback.data.split(':', 1)
-        data = await state.get_data()
-        category_choices = data.get('category_choices')
+        category_name = facet_codes.decode('category', category_id)
 
-        if category_choices is None or category_id not in category_choices:
-            logging.error(f"Не найден словарь category_choices в state или ID '{category_id}' не найден.")
+        if category_name is None:
+            logging.error(f"Код тематики '{category_id}' не найден в словаре кодов.")
             await callback.answer("Ошибка данных тематики!", show_alert=True)
-            await state.clear()
             return
 
-        category_name = category_choices[category_id]
         logging.info(f"Выбрана тематика (ID: {category_id}): '{category_name}' от {callback.from_user.id}")
 
         # Записываем статистику выбора Тематики
@@ -1102,7 +3704,6 @@ async def handle_category_selection_callback(callback: types.CallbackQuery, stat
     except (ValueError, IndexError) as e:
         logging.error(f"Ошибка парсинга callback_data для выбора тематики: {callback.data}. Ошибка: {e}")
         await callback.answer("Ошибка данных тематики!", show_alert=True)
-        await state.clear()
         return
 
     try:
@@ -1112,42 +3713,34 @@ async def handle_category_selection_callback(callback: types.CallbackQuery, stat
          logging.warning(f"Не удалось отредактировать сообщение с выбором тематики: {e}")
          await callback.answer(f"Выбрана: {category_name}. Ищу даты...", show_alert=False)
 
-    dates = get_distinct_dates_by_category(category_name)
+    dates = await get_distinct_dates_by_category(category_name)
 
     if dates is None:
         await callback.message.answer("Произошла ошибка при получении списка дат для выбранной тематики.")
-        await state.clear()
     elif not dates:
         await callback.message.answer(f"Мероприятий по тематике '{category_name}' на ближайшие даты не найдено.")
-        await state.clear()
     else:
         keyboard = dates_inline_keyboard_for_category_with_id(dates, category_id)
         if keyboard:
             await callback.message.answer("Выберите дату:", reply_markup=keyboard)
-            await state.set_state(CategoryFilterStates.waiting_for_date_selection)
         else:
              await callback.message.answer(f"Мероприятий по тематике '{category_name}' на ближайшие даты не найдено.")
-             await state.clear()
 
 
-@dp.callback_query(CategoryFilterStates.waiting_for_date_selection, F.data.startswith('select_cat_date_id:'))
-async def handle_category_date_selection_callback(callback: types.CallbackQuery, state: FSMContext):
+@dp.callback_query(F.data.startswith('select_cat_date_id:'))
+async def handle_category_date_selection_callback(callback: types.CallbackQuery):
     user_id = callback.from_user.id
     user_name = callback.from_user.username
     try:
         prefix, category_id, selected_date_str = callback.data.split(':', 2)
         selected_date = datetime.strptime(selected_date_str, '%Y-%m-%d').date()
 
-        data = await state.get_data()
-        category_choices = data.get('category_choices')
-
-        if category_choices is None or category_id not in category_choices:
-            logging.error(f"Не найден словарь category_choices в state или ID '{category_id}' не найден.")
+        category_name = facet_codes.decode('category', category_id)
+        if category_name is None:
+            logging.error(f"Код тематики '{category_id}' не найден в словаре кодов.")
             await callback.answer("Ошибка данных тематики!", show_alert=True)
-            await state.clear()
             return
 
-        category_name = category_choices[category_id]
         logging.info(f"Выбрана дата '{selected_date_str}' для тематики (ID: {category_id}) '{category_name}' от {user_id} (@{user_name})")
 
         # Мы уже записали выбор тематики, выбор даты не пишем в данном случае, чтобы не дублировать
@@ -1156,7 +3749,6 @@ async def handle_category_date_selection_callback(callback: types.CallbackQuery,
     except (ValueError, IndexError) as e:
         logging.error(f"Ошибка парсинга callback_data для выбора даты после тематики: {callback.data}. Ошибка: {e}")
         await callback.answer("Ошибка данных даты!", show_alert=True)
-        await state.clear()
         return
 
     try:
@@ -1171,7 +3763,7 @@ async def handle_category_date_selection_callback(callback: types.CallbackQuery,
          await callback.answer(f"Выбрана дата: {selected_date.strftime('%d.%m.%Y')}. Ищу мероприятия...", show_alert=False)
 
 
-    events = get_events_by_category_and_date(category_name, selected_date)
+    events = await get_events_by_category_and_date(category_name, selected_date)
 
     if events is None:
         await callback.message.answer("Произошла ошибка при получении данных из базы.")
@@ -1185,11 +3777,303 @@ async def handle_category_date_selection_callback(callback: types.CallbackQuery,
              f"Найдено мероприятий по тематике '{category_name}' "
              f"на {selected_date.strftime('%d.%m.%Y')}: {len(events)}"
         )
-        for event in events:
-            await send_event_card(callback.message, event)
+        await send_events(callback.message, events, callback.from_user.id)
+
+
+
+# --- Хэндлеры подписок ---
+
+@dp.message(Command("subscribe"))
+async def handle_subscribe_command(message: types.Message):
+    user_id = message.from_user.id
+    user_name = message.from_user.username
+    insert_filter_selection(user_id, user_name, 'command', '/subscribe')
+    logging.info(f"Получен запрос /subscribe (команда) от {user_id} в чате {message.chat.id}")
+
+    subscriptions = await get_user_subscriptions(user_id)
+    if subscriptions is None:
+        await message.answer("Произошла ошибка при получении списка подписок.")
+        return
+    text, keyboard = subscriptions_view(subscriptions)
+    await message.answer(text, reply_markup=keyboard)
+
+
+@dp.callback_query(F.data.startswith('sub_add:'))
+async def handle_subscribe_callback(callback: types.CallbackQuery):
+    user_id = callback.from_user.id
+    try:
+        prefix, kind, filter_id = callback.data.split(':', 2)
+        column = DATE_PICKER_FACETS[kind]
+    except (ValueError, KeyError) as e:
+        logging.error(f"Ошибка парсинга callback_data для подписки: {callback.data}. Ошибка: {e}")
+        await callback.answer("Ошибка данных подписки!", show_alert=True)
+        return
+
+    value = facet_codes.decode(column, filter_id)
+    if value is None:
+        logging.error(f"Код '{filter_id}' ({column}) не найден в словаре кодов.")
+        await callback.answer("Список устарел, выберите фильтр ещё раз.", show_alert=True)
+        return
+
+    result = await add_subscription(user_id, callback.message.chat.id, column, value)
+    label = subscription_label({'filter_type': column, 'filter_value': value}, max_length=SUBSCRIPTION_ANSWER_LABEL_LENGTH)
+    if result is None:
+        await callback.answer("Не удалось оформить подписку, попробуйте позже.", show_alert=True)
+    elif result == 'too_long':
+        logging.warning(f"Подписка на {column} длиной {len(value)} символов не поместится в msk_user_subscriptions.")
+        await callback.answer(f"На это значение подписаться нельзя: название длиннее {SUBSCRIPTION_VALUE_MAX_LENGTH} символов.",
+                              show_alert=True)
+    elif result == 'limit':
+        await callback.answer(f"Подписок не может быть больше {SUBSCRIPTION_USER_LIMIT}. "
+                              f"Лишние можно отменить в /subscribe.", show_alert=True)
+    elif result == 'exists':
+        await callback.answer(f"Вы уже подписаны: {label}", show_alert=False)
+    else:
+        insert_filter_selection(user_id, callback.from_user.username, f'subscribe_{column}', value)
+        logging.info(f"Пользователь {user_id} подписался: {label}")
+        await callback.answer(f"🔔 Подписка оформлена: {label}. Настроить - /subscribe", show_alert=True)
+
+
+async def edit_subscriptions_view(callback: types.CallbackQuery):
+    subscriptions = await get_user_subscriptions(callback.from_user.id)
+    if subscriptions is None:
+        await callback.answer("Произошла ошибка при получении списка подписок.", show_alert=True)
+        return
+    text, keyboard = subscriptions_view(subscriptions)
+    try:
+        await callback.message.edit_text(text, reply_markup=keyboard)
+    except Exception as e:
+        logging.warning(f"Не удалось обновить сообщение со списком подписок: {e}")
+    await callback.answer()
+
+
+@dp.callback_query(F.data.startswith('sub_del:'))
+async def handle_unsubscribe_callback(callback: types.CallbackQuery):
+    try:
+        subscription_id = int(callback.data.split(':', 1)[1])
+    except (ValueError, IndexError) as e:
+        logging.error(f"Ошибка парсинга callback_data для отмены подписки: {callback.data}. Ошибка: {e}")
+        await callback.answer("Ошибка данных подписки!", show_alert=True)
+        return
+    if await delete_subscription(callback.from_user.id, subscription_id) is None:
+        await callback.answer("Не удалось отменить подписку, попробуйте позже.", show_alert=True)
+        return
+    await edit_subscriptions_view(callback)
+
+
+@dp.callback_query(F.data.startswith('sub_freq:'))
+async def handle_subscription_frequency_callback(callback: types.CallbackQuery):
+    frequency = callback.data.split(':', 1)[1]
+    if frequency not in SUBSCRIPTION_FREQUENCIES:
+        logging.error(f"Неизвестная частота рассылки в callback_data: {callback.data}")
+        await callback.answer("Ошибка данных подписки!", show_alert=True)
+        return
+    if await set_subscription_frequency(callback.from_user.id, frequency) is None:
+        await callback.answer("Не удалось изменить частоту рассылки, попробуйте позже.", show_alert=True)
+        return
+    await edit_subscriptions_view(callback)
+
+
+# --- Эндпоинт метрик ---
+
+# Счётчики, которые уже ведут сами компоненты, снимаются в момент запроса /metrics
+metrics.gauge_callback(
+    "msk_bot_fsm_users", "Пользователи в каждом состоянии фильтра.",
+    lambda: {(state,): count for state, count in fsm_storage.state_counts().items()}, ("state",))
+metrics.gauge_callback("msk_bot_fsm_entries", "Записей FSM-хранилища в памяти.", lambda: fsm_storage.entries)
+metrics.counter_callback(
+    "msk_bot_cache_hits_total", "Попадания в кэши.",
+    lambda: {("fsm",): fsm_storage.cache_hits, ("cards",): card_cache.hits, ("date_picker",): date_picker_cache.hits,
+             ("digest_preferences",): digest_preferences.hits},
+    ("cache",))
+metrics.counter_callback(
+    "msk_bot_cache_misses_total", "Промахи кэшей.",
+    lambda: {("fsm",): fsm_storage.cache_misses, ("cards",): card_cache.misses, ("date_picker",): date_picker_cache.misses,
+             ("digest_preferences",): digest_preferences.misses},
+    ("cache",))
+metrics.gauge_callback(
+    "msk_bot_db_circuit_state", "Размыкатель БД: 0 - closed, 1 - half_open (идёт проверка), 2 - open.",
+    lambda: CircuitBreaker.STATE_CODES[db_breaker.state])
+metrics.counter_callback("msk_bot_db_circuit_opened_total", "Сколько раз БД признавалась недоступной.", lambda: db_breaker.opened_count)
+metrics.counter_callback(
+    "msk_bot_db_circuit_rejected_total", "Обращения к БД, отклонённые сразу, пока она недоступна.", lambda: db_breaker.rejected_count)
+metrics.gauge_callback("msk_bot_db_pool_connections", "Открытые соединения пула БД.", lambda: db_pool.size)
+metrics.gauge_callback("msk_bot_db_pool_idle_connections", "Свободные соединения пула БД.", lambda: db_pool.idle_count)
+metrics.counter_callback("msk_bot_stats_written_total", "Строк статистики записано в БД.", lambda: stats_writer.written_count)
+metrics.counter_callback("msk_bot_stats_failed_total", "Строк статистики потеряно при ошибке записи.", lambda: stats_writer.failed_count)
+metrics.counter_callback("msk_bot_stats_dropped_total", "Строк статистики отброшено из-за переполнения буфера.", lambda: stats_writer.overflow_count)
+metrics.gauge_callback("msk_bot_stats_pending", "Строк статистики ждут записи.", lambda: stats_writer.pending)
+metrics.counter_callback("msk_bot_send_permits_total", "Разрешений на отправку выдано планировщиком.", lambda: send_scheduler.sent_count)
+metrics.counter_callback("msk_bot_send_retry_after_total", "Ответов TelegramRetryAfter.", lambda: send_scheduler.retry_after_count)
+metrics.gauge_callback("msk_bot_send_queue_depth", "Запросов ждут очереди на отправку.", lambda: send_scheduler.queue_depth)
+metrics.gauge_callback("msk_bot_send_queue_peak_depth", "Наибольшая глубина очереди отправки с запуска.", lambda: send_scheduler.peak_queue_depth)
+metrics.gauge_callback("msk_bot_send_waiting_chats", "Чатов с ожидающими отправками.", lambda: send_scheduler.waiting_chats)
+metrics.gauge_callback(
+    "msk_bot_snapshot_events", "Мероприятий в снимке в памяти.",
+    lambda: sum(len(events) for events in event_snapshot.events_by_date.values()))
+metrics.gauge_callback(
+    "msk_bot_snapshot_age_seconds",
+    "Сколько секунд назад снимок последний раз совпадал с БД - отставание от правок (-1 - ещё не загружен).",
+    lambda: time.monotonic() - event_snapshot.loaded_at if event_snapshot.loaded_at is not None else -1)
+metrics.gauge_callback("msk_bot_updates_in_flight", "Обновления в обработке.", lambda: update_queue.in_flight)
+metrics.gauge_callback("msk_bot_updates_queued", "Обновления, ждущие очереди чата или общего лимита.", lambda: update_queue.queued)
+metrics.gauge_callback("msk_bot_update_queue_chats", "Чатов с обрабатываемыми или ждущими обновлениями.", lambda: update_queue.active_chats)
+metrics.gauge_callback(
+    "msk_bot_job_last_run_timestamp_seconds", "Когда (unix time) фоновая задача последний раз запускалась.",
+    lambda: {(job.name,): job.last_run_at for job in job_scheduler.jobs.values() if job.last_run_at is not None}, ("job",))
+metrics.gauge_callback(
+    "msk_bot_job_last_duration_seconds", "Длительность последнего запуска фоновой задачи.",
+    lambda: {(job.name,): job.last_duration for job in job_scheduler.jobs.values() if job.last_duration is not None}, ("job",))
+metrics.counter_callback(
+    "msk_bot_job_runs_total", "Запуски фоновых задач по результату.",
+    lambda: {key: value for job in job_scheduler.jobs.values()
+             for key, value in (((job.name, "ok"), job.succeeded), ((job.name, "error"), job.failed))},
+    ("job", "result"))
+metrics.gauge_callback(
+    "msk_bot_broadcast_pending_chats", "Чатов идущей рассылки, которым ещё не отправляли (0 - рассылки нет).",
+    lambda: broadcast_engine.current.total - broadcast_engine.current.processed if broadcast_engine.current else 0)
+metrics.gauge_callback("msk_bot_ready", "1 - прогрев закончен, бот готов.", lambda: int(warm_up.ready))
+metrics.gauge_callback(
+    "msk_bot_warmup_step_seconds", "Длительность шагов прогрева при запуске.",
+    lambda: {(step,): seconds for step, seconds in warm_up.steps.items()}, ("step",))
+
+
+async def handle_metrics_request(request: web.Request) -> web.Response:
+    return web.Response(body=metrics.render().encode('utf-8'),
+                        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+async def handle_health_request(request: web.Request) -> web.Response:
+    status = {
+        "ready": warm_up.ready,
+        "warmup_seconds": round(warm_up.duration, 3) if warm_up.duration is not None else None,
+        "steps": {step: round(seconds, 3) for step, seconds in warm_up.steps.items()},
+        "failed_steps": warm_up.failed,
+    }
+    return web.json_response(status, status=200 if warm_up.ready else 503)
+
+
+async def start_metrics_server() -> web.AppRunner | None:
+    if not METRICS_PORT:
+        return None
+    app = web.Application()
+    app.router.add_get(METRICS_PATH, handle_metrics_request)
+    app.router.add_get(HEALTH_PATH, handle_health_request)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    logging.info(f"Метрики доступны на http://{METRICS_HOST}:{METRICS_PORT}{METRICS_PATH}")
+    return runner
+
+
+# --- Режим вебхука (aiohttp) ---
+
+# Future, в которую хэндлер callback_query "отправляет" свой answerCallbackQuery,
+# пока обрабатывается вебхук: такой ответ уходит телом HTTP-ответа без отдельного запроса к API
+webhook_reply: contextvars.ContextVar[asyncio.Future | None] = contextvars.ContextVar('webhook_reply', default=None)
+
+# Обработка обновлений, начатых из вебхука (ссылки держим, чтобы задачи не собрал GC)
+webhook_tasks: set[asyncio.Task] = set()
+
+
+class WebhookReplyMiddleware(BaseRequestMiddleware):
+    """
+    Перехватывает первый answerCallbackQuery обновления, пришедшего через вебхук, если
+    HTTP-ответ на вебхук ещё не отправлен. Остальные запросы уходят в API как обычно.
+    """
+
+    async def __call__(self, make_request, bot: Bot, method):
+        reply = webhook_reply.get()
+        if reply is not None and not reply.done() and isinstance(method, AnswerCallbackQuery):
+            reply.set_result(method)
+            return True
+        return await make_request(bot, method)
 
-    await state.clear()
-    logging.info(f"Состояние FSM сброшено для пользователя {user_id} (@{user_name})")
+
+def webhook_method_payload(method) -> dict:
+    return {"method": method.__api_method__, **method.model_dump(exclude_none=True)}
+
+
+async def process_webhook_update(bot: Bot, update: types.Update):
+    try:
+        await dp.feed_update(bot, update)
+    except Exception:
+        logging.exception(f"Ошибка обработки обновления {update.update_id} из вебхука:")
+
+
+# Telegram принимает secret_token из 1-256 символов A-Z, a-z, 0-9, _ и -
+WEBHOOK_SECRET_RE = re.compile(r'[A-Za-z0-9_-]{1,256}')
+
+
+def check_webhook_secret() -> None:
+    """Без секрета любой, кто достучится до WEBHOOK_HOST, мог бы присылать боту поддельные обновления."""
+    if not WEBHOOK_SECRET_RE.fullmatch(WEBHOOK_SECRET):
+        raise RuntimeError("Режим вебхука не запускается без WEBHOOK_SECRET "
+                           "(1-256 символов: латинские буквы, цифры, _ и -).")
+
+
+async def handle_webhook_request(request: web.Request) -> web.Response:
+    secret = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    if not hmac.compare_digest(secret.encode('utf-8'), WEBHOOK_SECRET.encode('utf-8')):
+        logging.warning(f"Запрос на вебхук с неверным секретом от {request.remote}")
+        return web.Response(status=401)
+
+    bot = request.app['bot']
+    try:
+        update = types.Update.model_validate(await request.json(), context={'bot': bot})
+    except (ValueError, ValidationError) as e:
+        logging.error(f"Не удалось разобрать обновление из вебхука: {e}")
+        return web.Response(status=400)
+
+    reply = asyncio.get_running_loop().create_future() if update.callback_query else None
+    token = webhook_reply.set(reply)
+    try:
+        # Задача получает копию контекста вместе с webhook_reply
+        task = asyncio.create_task(process_webhook_update(bot, update))
+    finally:
+        webhook_reply.reset(token)
+    webhook_tasks.add(task)
+    task.add_done_callback(webhook_tasks.discard)
+
+    if reply is not None:
+        await asyncio.wait({reply, task}, timeout=WEBHOOK_REPLY_TIMEOUT, return_when=asyncio.FIRST_COMPLETED)
+        if reply.done():
+            return web.json_response(webhook_method_payload(reply.result()))
+        # Хэндлер не ответил вовремя - дальше он ответит обычным запросом к API
+        reply.cancel()
+    return web.Response()
+
+
+def create_webhook_app(bot: Bot) -> web.Application:
+    app = web.Application()
+    app['bot'] = bot
+    app.router.add_post(WEBHOOK_PATH, handle_webhook_request)
+    return app
+
+
+async def run_webhook(bot: Bot):
+    check_webhook_secret()
+    bot.session.middleware(WebhookReplyMiddleware())
+    runner = web.AppRunner(create_webhook_app(bot))
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+    logging.info(f"Вебхук слушает http://{WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+    await bot.set_webhook(
+        WEBHOOK_URL,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types(),
+        drop_pending_updates=True,
+    )
+    logging.info(f"Вебхук зарегистрирован в Telegram: {WEBHOOK_URL}")
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+        if webhook_tasks:
+            await asyncio.wait(webhook_tasks, timeout=10)
 
 
 # --- Функция для регистрации команд меню ---
@@ -1198,31 +4082,167 @@ async def set_default_commands(bot: Bot):
         BotCommand(command="start", description="👋 Привет!"),
         BotCommand(command="today", description="⚡ Все квизы сегодня"),
         BotCommand(command="by_date", description="📅 Квизы по датам"),
+        BotCommand(command="digest", description="🗞 Дайджест вкл/выкл"),
+        BotCommand(command="subscribe", description="🔔 Подписки на новые квизы"),
         BotCommand(command="instruction", description="🔎 Как найти свой квиз")
     ]
     await bot.set_my_commands(commands, scope=types.BotCommandScopeDefault())
     logging.info("Команды меню зарегистрированы.")
 
 
-# Основная функция запуска бота
-async def main():
-    logging.info("Бот запускается...")
+# --- Прогрев при запуске ---
 
-    await set_default_commands(bot)
 
-    try:
-        await bot.delete_webhook(drop_pending_updates=True)
-        logging.info("Удалены ожидающие обновления (drop_pending_updates=True).")
-    except Exception as e:
-        logging.warning(f"Не удалось удалить вебхук или ожидающие обновления: {e}")
+class WarmUp:
+    """
+    Подготовка к первым пользователям: соединения с БД, снимок мероприятий с индексом
+    фильтров, клавиатуры выбора даты, отрисованные карточки, готовый ответ /today и команды меню.
+    Независимые шаги идут параллельно, длительность каждого пишется в лог и в метрики.
+    Ошибка шага прогрев не останавливает - недостающее достроится по первым запросам.
+    ready становится True, когда прогрев закончен; его отдаёт HEALTH_PATH.
+    """
 
-    logging.info("Бот готов к поллингу.")
-    await dp.start_polling(bot)
+    CARDS_YIELD_EVERY = 200  # Чтобы длинный шаг не держал event loop, если обновления уже принимаются
+
+    def __init__(self):
+        self.ready = False
+        self.duration: float | None = None
+        self.steps: dict[str, float] = {}  # шаг -> секунды
+        self.failed: list[str] = []
+
+    async def _step(self, name: str, action) -> bool:
+        started = time.perf_counter()
+        try:
+            ok = await action() is not False
+        except Exception as e:
+            logging.error(f"Прогрев: шаг {name} завершился ошибкой: {e}")
+            ok = False
+        self.steps[name] = time.perf_counter() - started
+        if not ok:
+            self.failed.append(name)
+        logging.info(f"Прогрев: {name} - {self.steps[name] * 1000:.0f} мс{'' if ok else ' (не удалось)'}")
+        return ok
+
+    async def _open_db(self) -> bool:
+        await db_pool.open()
+        return db_pool.size > 0
+
+    async def _load_snapshot(self) -> bool:
+        loaded = await event_snapshot.refresh()
+        event_snapshot.start()  # Дальше снимок обновляется в фоне; если не загрузился, попробует сразу
+        return loaded
+
+    async def _build_date_pickers(self) -> None:
+        index = event_snapshot.index
+        built = 0
+        if index.dates:
+            date_picker_cache.get('by_date', '', index.dates)
+            built += 1
+        for kind, column in DATE_PICKER_FACETS.items():
+            for value in index.values(column):
+                if built >= date_picker_cache.max_size:
+                    return
+                date_picker_cache.get(kind, facet_codes.encode(column, value), index.dates_for(column, value))
+                built += 1
+                await asyncio.sleep(0)  # Клавиатура из 30 кнопок строится миллисекунды, отдаём цикл после каждой
+
+    async def _render_cards(self) -> None:
+        # Ближайшие даты первыми: они нужнее всего, а в кэш помещается не всё
+        rendered = 0
+        for event_date in sorted(event_snapshot.events_by_date):
+            for event in event_snapshot.events_on(event_date):
+                if rendered >= card_cache.max_size:
+                    return
+                card_cache.get(event)
+                rendered += 1
+                if rendered % self.CARDS_YIELD_EVERY == 0:
+                    await asyncio.sleep(0)
+
+    async def _build_today_digest(self) -> bool:
+        return await job_scheduler.run_now("today_digest") is None
+
+    async def _warm_data(self) -> None:
+        await self._step("db_pool", self._open_db)
+        if await self._step("snapshot", self._load_snapshot):
+            await asyncio.gather(self._step("date_pickers", self._build_date_pickers),
+                                 self._step("cards", self._render_cards),
+                                 self._step("today_digest", self._build_today_digest))
+
+    async def run(self, bot: Bot) -> None:
+        started = time.perf_counter()
+        await asyncio.gather(self._warm_data(), self._step("bot_commands", lambda: set_default_commands(bot)))
+        self.duration = time.perf_counter() - started
+        self.ready = True
+        failed = f", не удалось: {', '.join(self.failed)}" if self.failed else ""
+        logging.info(f"Прогрев закончен за {self.duration:.2f} с{failed}.")
+
+
+warm_up = WarmUp()
+
+
+# Основная функция запуска бота
+async def main(mode: str = BOT_MODE):
+    logging.info(f"Бот запускается в режиме {mode}...")
+    if mode == "webhook":
+        check_webhook_secret()  # До прогрева и фоновых задач, а не после них
+
+    bot = Bot(token=API_TOKEN)
+    bot.session.middleware(send_scheduler)
+    bot.session.middleware(TelegramMetricsMiddleware())  # Внутри планировщика: ожидание очереди не считается
+
+    if mode == "polling":
+        try:
+            await bot.delete_webhook(drop_pending_updates=True)
+            logging.info("Удалены ожидающие обновления (drop_pending_updates=True).")
+        except Exception as e:
+            logging.warning(f"Не удалось удалить вебхук или ожидающие обновления: {e}")
+
+    metrics_runner = await start_metrics_server()  # Раньше прогрева: HEALTH_PATH сразу отвечает 503
+    stats_writer.start()
+    # Рассылке нужен бот, поэтому задача регистрируется здесь, а не рядом с SubscriptionPush.
+    # Пока БД недоступна, рассылка падает; повторяем её с частотой проверок размыкателя, пока
+    # сегодняшние рассылки не закончены (законченные run_due пропускает по msk_broadcast_runs).
+    # Другие ошибки повторяются ограниченное число раз (см. JobScheduler)
+    job_scheduler.add("subscriptions", lambda: subscription_push.run_due(bot), daily_at=SUBSCRIPTION_PUSH_AT,
+                      retry_after=DB_BREAKER_PROBE_INTERVAL)
+    job_scheduler.start()
+    warm_up_task = asyncio.create_task(warm_up.run(bot))
+
+    try:
+        # Обновления начинаем принимать после прогрева, но не позже WARMUP_DEADLINE
+        done, _ = await asyncio.wait({warm_up_task}, timeout=WARMUP_DEADLINE)
+        if not done:
+            logging.warning(f"Прогрев не уложился в {WARMUP_DEADLINE} с: начинаю принимать обновления, он закончится в фоне.")
+        # Если бот был остановлен во время сегодняшней рассылки (или прямо в её время), догоняем её
+        job_scheduler.trigger("subscriptions")
+
+        if mode == "webhook":
+            await run_webhook(bot)
+        else:
+            logging.info("Бот готов к поллингу.")
+            await dp.start_polling(bot)
+    finally:
+        warm_up_task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await warm_up_task
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await job_scheduler.stop()
+        await send_scheduler.stop()
+        await event_snapshot.stop()
+        await stats_writer.stop()
+        await db_pool.close()
+        await fsm_storage.close()
+        await bot.session.close()
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Бот-афиша квизов в Москве")
+    parser.add_argument("--mode", choices=("polling", "webhook"), default=BOT_MODE,
+                        help="как получать обновления от Telegram (по умолчанию BOT_MODE)")
+    args = parser.parse_args()
     try:
-        asyncio.run(main())
+        asyncio.run(main(args.mode))
     except (KeyboardInterrupt, SystemExit):
         logging.info("Бот остановлен вручную.")
     except Exception as e: